@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark of IGService.expand_columns against the previous implementation, which mapped a lambda
+over the nested column once per sub-column
+
+    python benchmarks/bench_expand_columns.py [rows]
+"""
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from trading_ig.IGService import IGService
+
+
+def expand_columns_map(data, d_cols, flag_col_prefix=False, col_overlap_allowed=None):
+    """Previous implementation, kept for comparison"""
+    if col_overlap_allowed is None:
+        col_overlap_allowed = []
+    for (col_lev1, lst_col) in d_cols.items():
+        ser = data[col_lev1]
+        del data[col_lev1]
+        for col in lst_col:
+            if col not in data.columns or col in col_overlap_allowed:
+                if flag_col_prefix:
+                    colname = col_lev1 + "_" + col
+                else:
+                    colname = col
+                data[colname] = ser.map(lambda x: x[col], na_action='ignore')
+            else:
+                raise (NotImplementedError("col overlap: %r" % col))
+    return data
+
+
+POSITION_COLS = ["contractSize", "createdDate", "createdDateUTC", "dealId", "dealReference", "size",
+                 "direction", "limitLevel", "level", "currency", "controlledRisk", "stopLevel",
+                 "trailingStep", "trailingStopDistance", "limitedRiskPremium"]
+MARKET_COLS = ["instrumentName", "expiry", "epic", "instrumentType", "lotSize", "high", "low",
+               "percentageChange", "netChange", "bid", "offer", "updateTime", "updateTimeUTC",
+               "delayTime", "streamingPricesAvailable", "marketStatus", "scalingFactor"]
+
+
+def positions_frame(rows):
+    """A positions table as returned by fetch_open_positions, with nested 'position' and 'market'"""
+    rng = np.random.default_rng(0)
+    values = rng.random(rows)
+    positions = [{col: f"{col}{i}" if col.endswith(("Id", "Reference", "Date", "UTC")) else values[i]
+                  for col in POSITION_COLS} for i in range(rows)]
+    markets = [{col: f"{col}{i}" if col in ("instrumentName", "epic", "expiry") else values[i]
+                for col in MARKET_COLS} for i in range(rows)]
+    return pd.DataFrame({"position": positions, "market": markets})
+
+
+def main(rows=5000, repeat=5):
+    d_cols = {"position": POSITION_COLS, "market": MARKET_COLS}
+    df = positions_frame(rows)
+
+    expected = expand_columns_map(df.copy(), d_cols, flag_col_prefix=True)
+    result = IGService.expand_columns(df.copy(), d_cols, flag_col_prefix=True)
+    pd.testing.assert_frame_equal(expected, result, check_dtype=False)
+
+    for name, func in (("map (previous)", expand_columns_map), ("vectorised", IGService.expand_columns)):
+        seconds = min(timeit.repeat(lambda: func(df.copy(), d_cols, flag_col_prefix=True),
+                                    number=1, repeat=repeat))
+        print(f"{name:<16} {rows} rows x {len(POSITION_COLS) + len(MARKET_COLS)} columns: {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
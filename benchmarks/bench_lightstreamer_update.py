@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark of Subscription.notifyupdate against the previous implementation, which rebuilt the
+values of the item as new dicts on every update
+
+    python benchmarks/bench_lightstreamer_update.py [updates]
+"""
+import random
+import sys
+import timeit
+
+from trading_ig.lightstreamer import Subscription
+
+FIELDS = ["UPDATE_TIME", "BID", "OFFER", "CHANGE", "MARKET_STATE", "MID_OPEN", "HIGH", "LOW"]
+ITEMS = ["MARKET:CS.D.MARKET%d.IP" % i for i in range(200)]
+
+
+class PreviousSubscription(Subscription):
+    """Previous implementation, kept for comparison"""
+
+    def notifyupdate(self, item_line):
+        toks = item_line.rstrip("\r\n").split("|")
+        undecoded_item = dict(list(zip(self.field_names, toks[1:])))
+        item_pos = int(toks[0])
+        curr_item = self._items_map.get(item_pos, {})
+        self._items_map[item_pos] = dict(
+            [
+                (k, self._decode(v, curr_item.get(k)))
+                for k, v in list(undecoded_item.items())
+            ]
+        )
+        item_info = {
+            "pos": item_pos,
+            "name": self.item_names[item_pos - 1],
+            "values": self._items_map[item_pos],
+        }
+        for on_item_update in self._listeners:
+            on_item_update(item_info)
+
+
+def update_lines(count):
+    """A snapshot of every item, then MERGE updates where most fields are unchanged"""
+    rng = random.Random(0)
+    lines = ["%d|12:00:00|1.1000|1.1002|0.1|TRADEABLE|1.09|1.12|1.08" % pos
+             for pos in range(1, len(ITEMS) + 1)]
+    for i in range(count):
+        bid = 1.1 + rng.random() / 100
+        lines.append("%d|12:00:%02d|%.5f|%.5f|||||" % (rng.randint(1, len(ITEMS)), i % 60, bid, bid + 0.0002))
+    return lines
+
+
+def main(count=100000, repeat=5):
+    lines = update_lines(count)
+    bids = []
+
+    def on_values(item_update):
+        bids.append(item_update["values"]["BID"])
+
+    def on_value(item_update):
+        bids.append(item_update.value("BID"))
+
+    cases = (
+        ("previous", PreviousSubscription, on_values),
+        ("in place, values", Subscription, on_values),
+        ("in place, value()", Subscription, on_value),
+    )
+    results = []
+    for name, subscription_class, listener in cases:
+        subscription = subscription_class("MERGE", ITEMS, FIELDS)
+        subscription.addlistener(listener)
+        seconds = min(timeit.repeat(lambda: [subscription.notifyupdate(line) for line in lines],
+                                    number=1, repeat=repeat))
+        results.append(bids[-len(lines):])
+        del bids[:]
+        print(f"{name:<18} {len(lines)} updates: {seconds * 1000:8.1f} ms, "
+              f"{seconds / len(lines) * 1e6:.2f} us per update")
+    assert all(result == results[0] for result in results)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
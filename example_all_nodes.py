@@ -34,6 +34,15 @@ def display_epics_for_node(node_id=0, space='', ig_service=None):
             print(f"{space}{node['instrumentName']} ({node['expiry']}): {node['epic']}")
 
 
+def display_all_epics_crawled(path='navigation.json'):
+    """Same as display_all_epics, but fetches nodes in parallel and keeps the tree in path,
+    so running it again only fetches the nodes that are more than a day old"""
+    ig_service = get_session()
+    crawler = ig_service.crawl_market_navigation(path=path, max_workers=4)
+    for epic, market in sorted(crawler.epics().items()):
+        print(f"{market['instrumentName']} ({market['expiry']}): {epic}")
+
+
 def get_session():
     ig_service = IGService(config)
     ig_service.create_session(version='3')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+AsyncIGService against a local stub of the IG REST API
+
+    python -m unittest tests.test_async_ig_service
+"""
+import os
+import tempfile
+import threading
+import types
+import unittest
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+if aiohttp is not None:
+    from trading_ig.AsyncIGService import AsyncIGService
+
+EPIC = "CS.D.EURUSD.MINI.IP"
+
+
+def price(n):
+    return {"snapshotTimeUTC": "2021-01-04T00:%02d:00" % n, "openPrice": {"bid": 1.2 + n / 1000.0}}
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncHistoricalPrices(unittest.IsolatedAsyncioTestCase):
+
+    price_cache = None
+
+    async def asyncSetUp(self):
+        self.allowance = None
+        self.requests = 0
+        app = web.Application()
+        app.router.add_get("/prices/{epic}", self.prices)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, price_cache=self.price_cache)
+        self.ig_service = AsyncIGService(config)
+        self.ig_service.crud_session.BASE_URL = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    async def asyncTearDown(self):
+        await self.ig_service.crud_session.close()
+        if self.ig_service.price_cache is not None:
+            self.ig_service.price_cache.close()
+        await self.runner.cleanup()
+
+    async def prices(self, request):
+        self.requests += 1
+        page = int(request.query["pageNumber"])
+        metadata = {"size": 2, "pageData": {"pageSize": 2, "pageNumber": page, "totalPages": 2}}
+        if self.allowance is not None:
+            metadata["allowance"] = self.allowance
+        return web.json_response({"prices": [price(page * 2 - 1), price(page * 2)], "instrumentType": "CURRENCIES",
+                                  "metadata": metadata})
+
+    async def test_all_pages(self):
+        self.allowance = {"remainingAllowance": 9996, "totalAllowance": 10000, "allowanceExpiry": 600000}
+        data = await self.ig_service.fetch_historical_prices_by_epic(EPIC, pagesize=2, wait=0)
+        self.assertEqual(data["prices"], [price(n) for n in range(1, 5)])
+
+    async def test_without_allowance(self):
+        data = await self.ig_service.fetch_historical_prices_by_epic(EPIC, pagesize=2, wait=0)
+        self.assertEqual(len(data["prices"]), 4)
+        self.assertNotIn("allowance", data["metadata"])
+
+
+class TestAsyncPriceCache(TestAsyncHistoricalPrices):
+    price_cache = ":memory:"
+
+    async def test_cache_hit(self):
+        self.allowance = {"remainingAllowance": 9996, "totalAllowance": 10000, "allowanceExpiry": 600000}
+        miss = await self.ig_service.fetch_historical_prices_by_epic(
+            EPIC, resolution="1Min", start_date="2021-01-04T00:00:00", end_date="2021-01-04T00:04:00", pagesize=2,
+            wait=0)
+        self.assertEqual(self.requests, 2)
+        hit = await self.ig_service.fetch_historical_prices_by_epic(
+            EPIC, resolution="1Min", start_date="2021-01-04T00:00:00", end_date="2021-01-04T00:04:00", pagesize=2,
+            wait=0)
+        self.assertEqual(self.requests, 2)
+        self.assertEqual(hit, miss)
+        self.assertEqual(hit["prices"], [price(n) for n in range(1, 5)])
+        self.assertEqual(hit["instrumentType"], "CURRENCIES")
+        self.assertEqual(hit["metadata"]["pageData"], {"pageSize": 2, "pageNumber": 1, "totalPages": 2})
+
+    async def test_cache_off_event_loop(self):
+        price_cache = self.ig_service.price_cache
+        threads = []
+
+        def on_thread(method):
+            def call(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+            return call
+
+        for name in ("missing", "store", "load_response"):
+            setattr(price_cache, name, on_thread(getattr(price_cache, name)))
+        await self.ig_service.fetch_historical_prices_by_epic(
+            EPIC, resolution="1Min", start_date="2021-01-04T00:00:00", end_date="2021-01-04T00:04:00", pagesize=2,
+            wait=0)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncMarketCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = 0
+        app = web.Application()
+        app.router.add_get("/markets/{epic}", self.market)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "markets.db")
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, market_cache=path)
+        self.ig_service = AsyncIGService(config)
+        self.ig_service.crud_session.BASE_URL = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    async def asyncTearDown(self):
+        await self.ig_service.crud_session.close()
+        self.ig_service.market_cache.close()
+        await self.runner.cleanup()
+
+    async def market(self, request):
+        self.requests += 1
+        return web.json_response({"instrument": {"epic": request.match_info["epic"], "name": "EUR/USD Mini"}})
+
+    async def test_cache_off_event_loop(self):
+        market_cache = self.ig_service.market_cache
+        threads = []
+
+        def on_thread(method):
+            def call(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return method(*args, **kwargs)
+            return call
+
+        for name in ("get", "put"):
+            setattr(market_cache, name, on_thread(getattr(market_cache, name)))
+        miss = await self.ig_service.fetch_market_by_epic(EPIC)
+        hit = await self.ig_service.fetch_market_by_epic(EPIC)
+        self.assertEqual(hit, miss)
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(await self.ig_service.load_markets([EPIC]), {EPIC: miss})
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
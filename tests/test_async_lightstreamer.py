@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+AsyncLSClient against a fake Lightstreamer server replaying recorded stream connections: the
+snapshot and updates of a subscription, PROBE and LOOP (rebinding to the session), END, and the
+update iterators ending when the session can't go on
+
+    python -m unittest tests.test_async_lightstreamer
+"""
+import asyncio
+import unittest
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+from trading_ig.lightstreamer import Subscription
+
+if aiohttp is not None:
+    from trading_ig.async_lightstreamer import AsyncLSClient
+
+# sent once the subscription is in place
+SUBSCRIBED = object()
+# sent once the subscription has been deleted
+UNSUBSCRIBED = object()
+
+# create_session.txt of an IG stream, up to its first LOOP
+CREATE_SESSION = [
+    "OK",
+    "SessionId:Sd2b6f3c0a4e1e1a5T0742409",
+    "ControlAddress:{control_address}",
+    "KeepaliveMillis:5000",
+    "MaxBandwidth:0.0",
+    "RequestLimit:50000",
+    "",
+    "Preamble: a recorded IG stream",
+    SUBSCRIBED,
+    "1,1|1.10000|1.10020|12:00:00",
+    "PROBE",
+    "1,1|1.10010||12:00:01",
+    "LOOP",
+]
+
+# bind_session.txt, the rest of the session
+BIND_SESSION = [
+    "OK",
+    "SessionId:Sd2b6f3c0a4e1e1a5T0742409",
+    "ControlAddress:{control_address}",
+    "KeepaliveMillis:5000",
+    "MaxBandwidth:0.0",
+    "RequestLimit:50000",
+    "",
+    "1,1|#|$|12:00:02",
+    "PROBE",
+    "1,1|1.10030|1.10050|12:00:03",
+    "END",
+]
+
+# the session has gone by the time the client rebinds
+SESSION_NOT_FOUND = [
+    "ERROR",
+    "2",
+    "Requested session not found",
+]
+
+LOGIN_FAILED = [
+    "ERROR",
+    "1",
+    "User/password check failed",
+]
+
+
+class FakeLightstreamer(object):
+    """Replays a recorded stream connection for each create / bind request in turn, and answers
+    control requests with OK"""
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.stream_requests = []
+        self.control_requests = []
+        self.subscribed = asyncio.Event()
+        self.unsubscribed = asyncio.Event()
+        self.port = None
+
+    async def stream(self, request):
+        self.stream_requests.append((request.path, dict(await request.post())))
+        response = web.StreamResponse(headers={"Content-Type": "text/enriched; charset=UTF-8"})
+        await response.prepare(request)
+        for line in self.streams.pop(0):
+            if line is SUBSCRIBED:
+                await self.subscribed.wait()
+                continue
+            if line is UNSUBSCRIBED:
+                await self.unsubscribed.wait()
+                continue
+            await response.write((line.format(control_address="127.0.0.1:%d" % self.port) + "\r\n").encode())
+        await response.write_eof()
+        return response
+
+    async def control(self, request):
+        requests = (await request.text()).split("\r\n")
+        self.control_requests.extend(requests)
+        if any("LS_op=add" in r for r in requests):
+            self.subscribed.set()
+        if any("LS_op=delete" in r for r in requests):
+            self.unsubscribed.set()
+        return web.Response(text="OK\r\n" * len(requests))
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/lightstreamer/create_session.txt", self.stream)
+        app.router.add_post("/lightstreamer/bind_session.txt", self.stream)
+        app.router.add_post("/lightstreamer/control.txt", self.control)
+        return app
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncLSClient(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, *streams):
+        self.server = FakeLightstreamer(*streams)
+        self.runner = web.AppRunner(self.server.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.server.port = self.runner.addresses[0][1]
+        self.client = AsyncLSClient("http://127.0.0.1:%d" % self.server.port, user="ACC", password="CST-a|XST-b")
+        return self.client
+
+    async def asyncTearDown(self):
+        await self.client.disconnect()
+        await self.runner.cleanup()
+
+    async def subscribe(self):
+        self.subscription = subscription = Subscription(
+            "MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID", "OFFER", "UPDATE_TIME"])
+        updates = self.client.updates(subscription)
+        await self.client.subscribe(subscription)
+        return updates
+
+    async def collect(self, updates):
+        async def values():
+            return [(u.value("BID"), u.value("OFFER"), u.value("UPDATE_TIME")) async for u in updates]
+        return await asyncio.wait_for(values(), 5)
+
+    async def test_replayed_session(self):
+        client = await self.start(CREATE_SESSION, BIND_SESSION)
+        await client.connect()
+        updates = await self.subscribe()
+        self.assertEqual(await self.collect(updates), [
+            ("1.10000", "1.10020", "12:00:00"),
+            ("1.10010", "1.10020", "12:00:01"),
+            (None, "", "12:00:02"),
+            ("1.10030", "1.10050", "12:00:03"),
+        ])
+        await asyncio.wait_for(client.wait_closed(), 5)
+
+        create, bind = self.server.stream_requests
+        self.assertEqual(create[0], "/lightstreamer/create_session.txt")
+        self.assertEqual(create[1]["LS_user"], "ACC")
+        self.assertEqual(bind[0], "/lightstreamer/bind_session.txt")
+        self.assertEqual(bind[1]["LS_session"], "Sd2b6f3c0a4e1e1a5T0742409")
+        self.assertIn("LS_schema=BID+OFFER+UPDATE_TIME", self.server.control_requests[0])
+        self.assertEqual(client.counters["loops"], 1)
+        self.assertEqual(client.counters["probes"], 2)
+        self.assertEqual(client.counters["updates"], 4)
+        self.assertEqual(client._session, {})
+        # the ended iterator no longer listens to the subscription
+        self.assertEqual(self.subscription._listeners, [])
+        self.assertEqual(client._updates, {})
+
+    async def test_rebind_failure_ends_updates(self):
+        client = await self.start(CREATE_SESSION, SESSION_NOT_FOUND)
+        await client.connect()
+        updates = await self.subscribe()
+        self.assertEqual(len(await self.collect(updates)), 2)
+        await asyncio.wait_for(client.wait_closed(), 5)
+        self.assertEqual(len(self.server.stream_requests), 2)
+        self.assertIsNone(client._stream)
+        self.assertEqual(client._session, {})
+
+    async def test_connect_error(self):
+        client = await self.start(LOGIN_FAILED)
+        with self.assertRaises(IOError) as raised:
+            await client.connect()
+        self.assertIn("User/password check failed", str(raised.exception))
+
+    async def test_unsubscribe_ends_updates(self):
+        client = await self.start(CREATE_SESSION[:10] + [UNSUBSCRIBED] + CREATE_SESSION[10:], BIND_SESSION)
+        await client.connect()
+        updates = await self.subscribe()
+        first = await asyncio.wait_for(updates.__anext__(), 5)
+        self.assertEqual(first.value("BID"), "1.10000")
+        await client.unsubscribe(1)
+        self.assertIn("LS_op=delete", self.server.control_requests[-1])
+        self.assertEqual(await self.collect(updates), [])
+        self.assertEqual(self.subscription._listeners, [])
+        # the session goes on without it
+        await asyncio.wait_for(client.wait_closed(), 5)
+        self.assertEqual(client.counters["unknown_table"], 3)
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestSubscriptionUpdates(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.client = AsyncLSClient("http://127.0.0.1")
+        self.subscription = Subscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID", "OFFER"])
+
+    async def test_close(self):
+        received = []
+        self.subscription.addlistener(received.append)
+        updates = self.client.updates(self.subscription)
+        self.assertIs(self.client.updates(self.subscription), updates)
+        self.subscription.notifyupdate("1|1.1|1.2")
+        await updates.aclose()
+        self.subscription.notifyupdate("1|1.3|1.4")
+
+        # updates received before closing are still delivered, nothing after
+        self.assertEqual([update.value("BID") async for update in updates], ["1.1"])
+        self.assertEqual(self.subscription._listeners, [received.append])
+        self.assertEqual(len(received), 2)
+
+        # a new iterator for a closed one
+        again = self.client.updates(self.subscription)
+        self.assertIsNot(again, updates)
+        self.subscription.notifyupdate("1|1.5|1.6")
+        again.close()
+        again.close()
+        self.assertEqual([update.value("BID") async for update in again], ["1.5"])
+        self.assertEqual(self.subscription._listeners, [received.append])
+
+
+if __name__ == "__main__":
+    unittest.main()
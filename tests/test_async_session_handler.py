@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+AsyncIGSessionHandler against a local stub of the IG REST API: concurrent requests, v3 token
+refresh (on demand and in the background) and logging in again when a refresh is rejected
+
+    python -m unittest tests.test_async_session_handler
+"""
+import asyncio
+import itertools
+import types
+import unittest
+from unittest import mock
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+from trading_ig.AsyncSessionHandler import AsyncIGSessionHandler
+from trading_ig.SessionHandler import IGSessionHandler
+
+TOKEN_MISSING = {"errorCode": "error.security.client-token-missing"}
+ALLOWANCE_EXCEEDED = {"errorCode": "error.public-api.exceeded-account-allowance"}
+
+
+def config(**settings):
+    """Handler settings, without rate limiting"""
+    return types.SimpleNamespace(
+        api_key="key", username="user", password="secret", acc_number="ACC",
+        rate_limit_enabled=False, **settings)
+
+
+class StubIG(object):
+    """Minimal v3 login, token refresh and authenticated GET, counting calls"""
+
+    def __init__(self, expires_in=60, delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.refresh_fails = False
+        self.refresh_exceeded = 0
+        self.logins = 0
+        self.refreshes = 0
+        self.reads = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+        self._tokens = itertools.count(1)
+        self.access_token = None
+        self.refresh_token = None
+
+    def _oauth(self):
+        n = next(self._tokens)
+        self.access_token = "access-%d" % n
+        self.refresh_token = "refresh-%d" % n
+        return {"access_token": self.access_token, "refresh_token": self.refresh_token, "scope": "profile",
+                "token_type": "Bearer", "expires_in": str(self.expires_in)}
+
+    async def login(self, request):
+        self.logins += 1
+        return web.json_response({"clientId": "1", "accountId": "ACC", "timezoneOffset": 0,
+                                  "lightstreamerEndpoint": "https://localhost", "oauthToken": self._oauth()})
+
+    async def refresh(self, request):
+        self.refreshes += 1
+        body = await request.json()
+        if self.refresh_exceeded:
+            self.refresh_exceeded -= 1
+            return web.json_response(ALLOWANCE_EXCEEDED, status=403)
+        if self.refresh_fails or body.get("refresh_token") != self.refresh_token:
+            return web.json_response(TOKEN_MISSING, status=401)
+        return web.json_response(self._oauth())
+
+    async def accounts(self, request):
+        if request.headers.get("Authorization") != "Bearer %s" % self.access_token:
+            self.rejected += 1
+            return web.json_response(TOKEN_MISSING, status=401)
+        self.reads += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return web.json_response({"accounts": [{"accountId": "ACC"}], "token": self.access_token})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/session", self.login)
+        app.router.add_post("/session/refresh-token", self.refresh)
+        app.router.add_get("/accounts", self.accounts)
+        return app
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncSessionHandler(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, stub, **settings):
+        self.stub = stub
+        self.runner = web.AppRunner(stub.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.handler = AsyncIGSessionHandler("http://127.0.0.1:%d" % port, config(**settings))
+        await self.handler.create_session(version="3")
+        return self.handler
+
+    async def asyncTearDown(self):
+        await self.handler.close()
+        await self.runner.cleanup()
+
+    async def test_concurrent_reads(self):
+        handler = await self.start(StubIG(delay=0.05))
+        results = await asyncio.wait_for(
+            asyncio.gather(*[handler.read("/accounts", None, "1") for _ in range(50)]), 10)
+        self.assertEqual([r["accounts"][0]["accountId"] for r in results], ["ACC"] * 50)
+        self.assertEqual(self.stub.reads, 50)
+        # sent over several pooled connections at once, not one after the other
+        self.assertGreater(self.stub.max_in_flight, 1)
+        self.assertEqual(self.stub.logins, 1)
+
+    async def test_expired_token_refreshed_once(self):
+        handler = await self.start(StubIG(expires_in=0), token_refresh=False)
+        self.stub.expires_in = 60
+        results = await asyncio.wait_for(
+            asyncio.gather(*[handler.read("/accounts", None, "1") for _ in range(20)]), 10)
+        # the first request to find the token expired renews it, the others wait and reuse it
+        self.assertEqual(self.stub.refreshes, 1)
+        self.assertEqual(self.stub.logins, 1)
+        self.assertEqual({r["token"] for r in results}, {"access-2"})
+        self.assertEqual(handler.headers["Authorization"], "Bearer access-2")
+
+    async def test_background_refresh(self):
+        handler = await self.start(StubIG(expires_in=1), token_refresh_margin=0.9)
+        self.stub.expires_in = 60
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.stub.refreshes, 1)
+        self.assertIsNotNone(handler._refresher)
+        data = await handler.read("/accounts", None, "1")
+        self.assertEqual(data["token"], "access-2")
+        self.assertEqual(self.stub.rejected, 0)
+
+    async def test_rejected_refresh_logs_in_again(self):
+        # the refresh runs under the authentication lock: logging in again must not wait for it
+        handler = await self.start(StubIG(expires_in=0), token_refresh=False)
+        self.stub.expires_in = 60
+        self.stub.refresh_fails = True
+        data = await asyncio.wait_for(handler.read("/accounts", None, "1"), 5)
+        self.assertEqual(self.stub.refreshes, 1)
+        self.assertEqual(self.stub.logins, 2)
+        self.assertEqual(data["token"], "access-2")
+
+    async def test_refresh_over_allowance_retried(self):
+        handler = await self.start(StubIG(expires_in=0), token_refresh=False)
+        self.stub.expires_in = 60
+        self.stub.refresh_exceeded = 1
+        with mock.patch("trading_ig.AsyncSessionHandler.TOKEN_REFRESH_RETRY", 0.01):
+            data = await asyncio.wait_for(handler.read("/accounts", None, "1"), 5)
+        # refreshed again rather than logging in again
+        self.assertEqual(self.stub.refreshes, 2)
+        self.assertEqual(self.stub.logins, 1)
+        self.assertEqual(data["token"], "access-2")
+
+    async def test_background_refresh_rejected(self):
+        handler = await self.start(StubIG(expires_in=1), token_refresh_margin=0.9)
+        self.stub.expires_in = 60
+        self.stub.refresh_fails = True
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.stub.refreshes, 1)
+        self.assertEqual(self.stub.logins, 2)
+        data = await asyncio.wait_for(handler.read("/accounts", None, "1"), 5)
+        self.assertEqual(data["token"], "access-2")
+
+    async def test_same_tokens_as_blocking_handler(self):
+        handler = await self.start(StubIG())
+        blocking = IGSessionHandler(handler.BASE_URL, config(token_refresh=False))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, blocking.create_session, "3")
+        finally:
+            blocking.close()
+        self.assertEqual(handler.headers["Authorization"], "Bearer access-1")
+        self.assertEqual(blocking.session.headers["Authorization"], "Bearer access-2")
+        for name in ("X-IG-API-KEY", "IG-ACCOUNT-ID"):
+            self.assertEqual(handler.headers[name], blocking.session.headers[name])
+        self.assertEqual(handler._refresh_token, "refresh-1")
+        self.assertEqual(blocking._refresh_token, "refresh-2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGService.backfill_historical_prices, with the price requests answered by a stub
+
+    python -m unittest tests.test_backfill
+"""
+import threading
+import types
+import unittest
+from datetime import datetime, timedelta
+
+from trading_ig import IGService
+from trading_ig.Exceptions import AllowanceExhaustedException
+from trading_ig.backfill import BackfillJob, DATE_FORMAT, HistoricalBackfill
+
+
+def fetch_historical_prices_by_epic(epic, resolution, start_date, end_date, pagesize):
+    """A bar on every hour of the range, priced by the epic"""
+    start = datetime.strptime(start_date, DATE_FORMAT)
+    end = datetime.strptime(end_date, DATE_FORMAT)
+    if start.minute or start.second:
+        start = start.replace(minute=0, second=0) + timedelta(hours=1)
+    prices = []
+    while start <= end:
+        prices.append({"snapshotTimeUTC": start.strftime(DATE_FORMAT), "epic": epic})
+        start += timedelta(hours=1)
+    return {"prices": prices}
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, token_refresh=False)
+        self.ig_service = IGService(config)
+        self.ig_service.fetch_historical_prices_by_epic = fetch_historical_prices_by_epic
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_results_in_job_order(self):
+        jobs = [
+            ("CS.D.EURUSD.MINI.IP", "HOUR", "2021-01-04T00:00:00", "2021-01-04T09:00:00"),
+            ("CS.D.GBPUSD.MINI.IP", "HOUR", "2021-01-04T00:00:00", "2021-01-04T01:00:00"),
+            # identical jobs each get their result
+            ("CS.D.EURUSD.MINI.IP", "HOUR", "2021-01-04T00:00:00", "2021-01-04T09:00:00"),
+            # nothing to fetch
+            ("CS.D.USDJPY.MINI.IP", "HOUR", "2021-01-04T01:00:00", "2021-01-04T00:00:00"),
+        ]
+        # from a generator, which can only be read once
+        results = self.ig_service.backfill_historical_prices((job for job in jobs), chunk_points=3)
+
+        self.assertEqual([result.job for result in results], [BackfillJob(*job) for job in jobs])
+        self.assertEqual([len(result.prices) for result in results], [10, 2, 10, 0])
+        self.assertEqual([price["snapshotTimeUTC"] for price in results[0].prices],
+                         ["2021-01-04T%02d:00:00" % hour for hour in range(10)])
+        self.assertIsNot(results[0], results[2])
+        self.assertTrue(all(result.failed_chunks == [] for result in results))
+
+    def test_unaligned_start(self):
+        job = ("CS.D.EURUSD.MINI.IP", "HOUR", "2021-01-04T00:30:00", "2021-01-04T09:00:00")
+        chunks = self.ig_service.backfill_historical_prices([job], chunk_points=3)[0]
+        # every bar from 01:00 onwards, including those at chunk boundaries
+        self.assertEqual([price["snapshotTimeUTC"] for price in chunks.prices],
+                         ["2021-01-04T%02d:00:00" % hour for hour in range(1, 10)])
+
+    def test_contiguous_chunks(self):
+        job = BackfillJob("CS.D.EURUSD.MINI.IP", "HOUR", "2021-01-04T00:00:00", "2021-01-04T09:00:00")
+        chunks = HistoricalBackfill(self.ig_service, chunk_points=3).split(job)
+        self.assertEqual([(chunk.start_date.strftime(DATE_FORMAT), chunk.end_date.strftime(DATE_FORMAT))
+                          for chunk in chunks],
+                         [("2021-01-04T00:00:00", "2021-01-04T02:59:59"), ("2021-01-04T03:00:00", "2021-01-04T05:59:59"),
+                          ("2021-01-04T06:00:00", "2021-01-04T08:59:59"), ("2021-01-04T09:00:00", "2021-01-04T09:00:00")])
+
+
+class TestBackfillAllowance(unittest.TestCase):
+
+    def setUp(self):
+        # room for two chunks of 10 points, and no waiting for the weekly reset
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_historical=25, rate_limit_historical_max_wait=0,
+                                       token_refresh=False)
+        self.ig_service = IGService(config)
+        self.fetched = []
+        self.lock = threading.Lock()
+        self.ig_service.fetch_historical_prices_by_epic = self.fetch_historical_prices_by_epic
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def fetch_historical_prices_by_epic(self, epic, **kwargs):
+        with self.lock:
+            self.fetched.append(epic)
+        return fetch_historical_prices_by_epic(epic, **kwargs)
+
+    def test_reserved_before_requests(self):
+        jobs = [(epic, "HOUR", "2021-01-04T00:00:00", "2021-01-04T09:00:00")
+                for epic in ("CS.D.EURUSD.MINI.IP", "CS.D.GBPUSD.MINI.IP", "CS.D.USDJPY.MINI.IP")]
+        results = self.ig_service.backfill_historical_prices(jobs, max_workers=3, chunk_points=10)
+
+        # the third chunk didn't fit in the allowance, and was never requested
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(sorted(len(result.prices) for result in results), [0, 10, 10])
+        failed = [error for result in results for _, error in result.failed_chunks]
+        self.assertEqual(len(failed), 1)
+        self.assertIsInstance(failed[0], AllowanceExhaustedException)
+        self.assertEqual(self.ig_service.crud_session.rate_limiter.historical_allowance, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGService.execute_orders and AsyncIGService.execute_orders, with the submissions and confirmations
+answered by stubs
+
+    python -m unittest tests.test_batch_orders
+"""
+import asyncio
+import threading
+import types
+import unittest
+
+from trading_ig import IGService
+from trading_ig.dealing import close_order, open_order
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if aiohttp is not None:
+    from trading_ig.AsyncIGService import AsyncIGService
+
+CONFIG = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                               rate_limit_enabled=False, token_refresh=False)
+
+ORDERS = [
+    open_order(epic="CS.D.EURUSD.MINI.IP", direction="BUY", size=1),
+    open_order(epic="CS.D.GBPUSD.MINI.IP", direction="BUY", size=1),
+    close_order(deal_id="DIAAAA", direction="SELL", size=1),
+    open_order(epic="CS.D.USDJPY.MINI.IP", direction="SELL", size=2),
+]
+
+
+def deal_reference(order):
+    """Reference of a deal, or the failure of its submission"""
+    if order.params.get("epic") == "CS.D.GBPUSD.MINI.IP":
+        raise IOError("Submission failed")
+    return "REF-" + order.params.get("epic", order.params.get("deal_id"))
+
+
+def confirmation(reference):
+    """Confirmation of a deal, or the failure to fetch it"""
+    if reference == "REF-DIAAAA":
+        raise IOError("Confirmation failed")
+    return {"dealReference": reference, "dealStatus": "ACCEPTED"}
+
+
+class TestExecuteOrders(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = IGService(CONFIG)
+        self.confirmed = []
+        self.lock = threading.Lock()
+        self.ig_service._submit_order = deal_reference
+        self.ig_service.fetch_deal_by_deal_reference = self.fetch_deal_by_deal_reference
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def fetch_deal_by_deal_reference(self, reference):
+        with self.lock:
+            self.confirmed.append(reference)
+        return confirmation(reference)
+
+    def test_results_in_order(self):
+        results = self.ig_service.execute_orders(iter(ORDERS), max_workers=3)
+        self.assertEqual([result.order for result in results], ORDERS)
+        self.assertEqual([result.deal_reference for result in results],
+                         ["REF-CS.D.EURUSD.MINI.IP", None, "REF-DIAAAA", "REF-CS.D.USDJPY.MINI.IP"])
+        self.assertEqual([type(result.error) for result in results], [type(None), OSError, OSError, type(None)])
+        self.assertEqual(results[0].confirmation["dealReference"], "REF-CS.D.EURUSD.MINI.IP")
+        self.assertIsNone(results[2].confirmation)
+        self.assertEqual(sorted(self.confirmed), ["REF-CS.D.EURUSD.MINI.IP", "REF-CS.D.USDJPY.MINI.IP", "REF-DIAAAA"])
+
+    def test_without_confirmations(self):
+        results = self.ig_service.execute_orders(ORDERS, confirm=False)
+        self.assertEqual([result.confirmation for result in results], [None] * 4)
+        self.assertEqual(self.confirmed, [])
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncExecuteOrders(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.ig_service = AsyncIGService(CONFIG)
+        self.confirmed = []
+        self.ig_service._submit_order = self.submit_order
+        self.ig_service.fetch_deal_by_deal_reference = self.fetch_deal_by_deal_reference
+
+    async def asyncTearDown(self):
+        await self.ig_service.crud_session.close()
+
+    async def submit_order(self, order):
+        await asyncio.sleep(0)
+        if order.params.get("epic") == "CS.D.USDJPY.MINI.IP":
+            raise asyncio.CancelledError()
+        return deal_reference(order)
+
+    async def fetch_deal_by_deal_reference(self, reference):
+        self.confirmed.append(reference)
+        return confirmation(reference)
+
+    async def test_results_in_order(self):
+        results = await self.ig_service.execute_orders(ORDERS, max_workers=2)
+        self.assertEqual([result.order for result in results], ORDERS)
+        self.assertEqual([result.deal_reference for result in results],
+                         ["REF-CS.D.EURUSD.MINI.IP", None, "REF-DIAAAA", None])
+        self.assertEqual([type(result.error) for result in results],
+                         [type(None), OSError, OSError, asyncio.CancelledError])
+        self.assertEqual(results[0].confirmation["dealStatus"], "ACCEPTED")
+        # a cancelled submission has no deal reference to confirm
+        self.assertEqual(sorted(self.confirmed), ["REF-CS.D.EURUSD.MINI.IP", "REF-DIAAAA"])
+
+
+if __name__ == "__main__":
+    unittest.main()
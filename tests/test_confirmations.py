@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+DealConfirmationRegistry resolving deal confirmations from updates of the TRADE item, pushed
+through an LSClient whose control requests are stubbed: updates kept until they are asked for,
+repeated field values ignored, and waits that time out
+
+    python -m unittest tests.test_confirmations
+"""
+import json
+import threading
+import unittest
+from unittest import mock
+
+from trading_ig import confirmations
+from trading_ig.confirmations import CONFIRMS, OPU, DealConfirmationRegistry
+from trading_ig.lightstreamer import BLOCK, CONFLATE, Dispatcher, LSClient, Subscription
+
+
+def confirms_line(table, deal_reference, **fields):
+    """TRADE update carrying the confirmation of a deal, as a stream message"""
+    confirm = dict(fields, dealReference=deal_reference)
+    return "{0},1|{1}||".format(table, json.dumps(confirm))
+
+
+def opu_line(table, deal_id, **fields):
+    """TRADE update carrying an open position update, with the confirmation left unchanged"""
+    opu = dict(fields, dealId=deal_id)
+    return "{0},1||{1}|".format(table, json.dumps(opu))
+
+
+def stub_client(dispatcher=None):
+    """LSClient accepting every control request, without a server"""
+    ls_client = LSClient("http://push.lightstreamer.test", dispatcher=dispatcher)
+    ls_client._control_batch = mock.Mock(side_effect=lambda requests: ["OK"] * len(requests))
+    return ls_client
+
+
+class TestConflatingDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(workers=1, overflow=CONFLATE)
+        self.ls_client = stub_client(self.dispatcher)
+
+    def tearDown(self):
+        self.dispatcher.stop(5)
+
+    def test_distinct_subscriptions_block(self):
+        merge = Subscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID"])
+        distinct = Subscription("DISTINCT", ["TRADE:ACC"], ["CONFIRMS"])
+        self.assertEqual(self.dispatcher.register(merge).overflow, CONFLATE)
+        self.assertEqual(self.dispatcher.register(distinct).overflow, BLOCK)
+        with self.assertRaises(ValueError):
+            self.dispatcher.register(distinct, overflow=CONFLATE)
+
+    def test_no_confirmation_conflated(self):
+        # the only worker is held up by a listener of another subscription, so the confirmations
+        # queue up behind it
+        release = threading.Event()
+        busy = Subscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID"])
+        busy.addlistener(lambda item_update: release.wait(5))
+        self.ls_client.subscribe(busy)
+        registry = DealConfirmationRegistry(self.ls_client, "ACC", timeout=5)
+        registry.start()
+        self.assertEqual(registry.subscription_key, 2)
+
+        self.ls_client._forward_update_message("1,1|1.10000")
+        for i in range(3):
+            self.ls_client._forward_update_message(confirms_line(2, "REF%d" % i, dealStatus="ACCEPTED"))
+        release.set()
+
+        for i in range(3):
+            self.assertEqual(registry.wait("REF%d" % i)["dealReference"], "REF%d" % i)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.ls_client = stub_client()
+        self.registry = DealConfirmationRegistry(self.ls_client, "ACC", timeout=5)
+        self.table = self.registry.start()
+
+    def push(self, line):
+        self.ls_client._forward_update_message(line)
+
+    def test_waiting(self):
+        future = self.registry.future("REF")
+        self.assertFalse(future.done())
+        self.push(confirms_line(self.table, "REF", dealStatus="ACCEPTED"))
+        self.assertEqual(future.result(0)["dealStatus"], "ACCEPTED")
+        self.assertEqual(self.registry._futures, {})
+
+    def test_buffered_until_asked_for(self):
+        # the stream is faster than the REST call returning the deal reference
+        self.push(confirms_line(self.table, "REF", dealStatus="REJECTED"))
+        self.assertEqual(self.registry.wait("REF", timeout=0)["dealStatus"], "REJECTED")
+        # handed out once
+        self.assertIsNone(self.registry.wait("REF", timeout=0))
+
+    def test_buffer_bounded(self):
+        with mock.patch.object(confirmations, "MAX_BUFFERED", 3):
+            for i in range(5):
+                self.push(confirms_line(self.table, "REF%d" % i))
+        self.assertEqual(list(self.registry._buffered[CONFIRMS]), ["REF2", "REF3", "REF4"])
+
+    def test_repeated_value_ignored(self):
+        self.push(confirms_line(self.table, "REF", dealStatus="ACCEPTED"))
+        self.assertIsNotNone(self.registry.wait("REF", timeout=0))
+        # the unchanged CONFIRMS field repeats its last value alongside the position update
+        self.push(opu_line(self.table, "DIAAAA", dealReference="REF", status="OPEN"))
+        self.assertEqual(dict(self.registry._buffered[CONFIRMS]), {})
+        self.assertIsNone(self.registry.wait("REF", timeout=0))
+
+    def test_position_by_deal_id_or_reference(self):
+        self.push(opu_line(self.table, "DIAAAA", dealReference="REF", status="OPEN"))
+        self.assertEqual(self.registry.wait("DIAAAA", timeout=0, kind=OPU)["status"], "OPEN")
+        self.assertEqual(self.registry.wait("REF", timeout=0, kind=OPU)["dealId"], "DIAAAA")
+
+    def test_timeout(self):
+        self.assertIsNone(self.registry.wait("REF", timeout=0.05))
+        # nothing left waiting, a late confirmation is buffered instead
+        self.assertEqual(self.registry._futures, {})
+        self.push(confirms_line(self.table, "REF"))
+        self.assertIn("REF", self.registry._buffered[CONFIRMS])
+
+    def test_stop_cancels_waits(self):
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.registry.wait("REF")))
+        waiter.start()
+        while not self.registry._futures:
+            waiter.join(0.01)
+        self.registry.stop()
+        waiter.join(5)
+        self.assertEqual(results, [None])
+        self.assertFalse(self.registry.active)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Fetching deal confirmations: IG 'not found' errors, polling '/confirms' until the deal is processed,
+and the time spent waiting on the stream and polling altogether
+
+    python -m unittest tests.test_deal_confirms
+"""
+import time
+import types
+import unittest
+from unittest import mock
+
+from trading_ig import IGService
+from trading_ig.confirmations import DealConfirmationRegistry
+from trading_ig.Exceptions import NotFoundException
+
+from tests.test_confirmations import stub_client
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if aiohttp is not None:
+    from trading_ig.AsyncIGService import AsyncIGService
+
+CONFIG = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                               rate_limit_enabled=False, token_refresh=False)
+NOT_FOUND = NotFoundException("error.confirms.deal-not-found")
+CONFIRMATION = {"dealReference": "REF", "dealStatus": "ACCEPTED"}
+
+
+class TestParseResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = IGService(CONFIG)
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_not_found(self):
+        with self.assertRaises(NotFoundException) as raised:
+            self.ig_service.crud_session._parse_response(
+                404, "Not Found", b'{"errorCode": "error.confirms.deal-not-found"}')
+        self.assertEqual(str(raised.exception), "error.confirms.deal-not-found")
+
+    def test_other_not_found_errors(self):
+        # only a deal confirmation still being processed is polled again
+        for error_code in ("error.service.marketdata.instrument.epic.unavailable",
+                           "error.position.notfound", "error.service.accounts.account-not-found"):
+            with self.assertRaises(Exception) as raised:
+                self.ig_service.crud_session._parse_response(
+                    404, "Not Found", ('{"errorCode": "%s"}' % error_code).encode())
+            self.assertNotIsInstance(raised.exception, NotFoundException, error_code)
+            self.assertEqual(str(raised.exception), error_code)
+
+    def test_other_error(self):
+        with self.assertRaises(Exception) as raised:
+            self.ig_service.crud_session._parse_response(
+                400, "Bad Request", b'{"errorCode": "validation.null-not-allowed.request"}')
+        self.assertNotIsInstance(raised.exception, NotFoundException)
+
+
+class TestFetchDeal(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = IGService(CONFIG)
+        self.read = mock.Mock()
+        self.ig_service.crud_session.read = self.read
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_polls_until_found(self):
+        self.read.side_effect = [NOT_FOUND, NOT_FOUND, CONFIRMATION]
+        self.assertEqual(self.ig_service.fetch_deal_by_deal_reference("REF"), CONFIRMATION)
+        self.assertEqual(self.read.call_count, 3)
+        self.assertEqual(self.read.call_args[0][0], "/confirms/REF")
+
+    def test_other_errors_not_retried(self):
+        self.read.side_effect = [Exception("error.public-api.failure.kyc.required"), CONFIRMATION]
+        with self.assertRaises(Exception):
+            self.ig_service.fetch_deal_by_deal_reference("REF")
+        self.assertEqual(self.read.call_count, 1)
+
+    def test_gives_up_after_timeout(self):
+        self.read.side_effect = NOT_FOUND
+        started = time.monotonic()
+        with self.assertRaises(NotFoundException):
+            self.ig_service.fetch_deal_by_deal_reference("REF", timeout=0.3)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_stream_within_timeout(self):
+        # the stream would be waited on for 5 seconds, and then REST polled for the whole timeout
+        registry = DealConfirmationRegistry(stub_client(), "ACC", timeout=5)
+        registry.start()
+        self.ig_service.deal_confirmations = registry
+        self.read.side_effect = NOT_FOUND
+        started = time.monotonic()
+        with self.assertRaises(NotFoundException):
+            self.ig_service.fetch_deal_by_deal_reference("REF", timeout=0.3)
+        self.assertLess(time.monotonic() - started, 1)
+        # one last look once the stream has timed out
+        self.assertEqual(self.read.call_count, 1)
+
+
+@unittest.skipIf(aiohttp is None, "requires aiohttp")
+class TestAsyncFetchDeal(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.ig_service = AsyncIGService(CONFIG)
+        self.read = mock.AsyncMock()
+        self.ig_service.crud_session.read = self.read
+
+    async def asyncTearDown(self):
+        await self.ig_service.crud_session.close()
+
+    async def test_polls_until_found(self):
+        self.read.side_effect = [NOT_FOUND, CONFIRMATION]
+        self.assertEqual(await self.ig_service.fetch_deal_by_deal_reference("REF"), CONFIRMATION)
+        self.assertEqual(self.read.await_count, 2)
+
+    async def test_stream_within_timeout(self):
+        registry = DealConfirmationRegistry(stub_client(), "ACC", timeout=5)
+        registry.start()
+        self.ig_service.deal_confirmations = registry
+        self.read.side_effect = NOT_FOUND
+        started = time.monotonic()
+        with self.assertRaises(NotFoundException):
+            await self.ig_service.fetch_deal_by_deal_reference("REF", timeout=0.3)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.read.await_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Dealing helpers: order templates rendering the same body as create_open_position, polling delays for
+deal confirmations, and deals sent over the dedicated dealing connection pool
+
+    python -m unittest tests.test_dealing
+"""
+import json
+import types
+import unittest
+from unittest import mock
+
+from trading_ig import IGService
+from trading_ig.dealing import POSITION_FIELDS, OrderTemplate, confirm_poll_delays
+from trading_ig.SessionHandler import IGSessionHandler
+
+STATIC = dict(epic="CS.D.EURUSD.MINI.IP", currency_code="USD", expiry="-", order_type="MARKET",
+              force_open=True, guaranteed_stop=False)
+DYNAMIC = dict(direction="BUY", size=1.5, stop_distance=20, limit_distance=None, level=None, limit_level=None,
+               quote_id=None, stop_level=None, trailing_stop=False, trailing_stop_increment=None)
+
+
+def config(**settings):
+    return types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                 rate_limit_enabled=False, token_refresh=False, **settings)
+
+
+def response(body):
+    return mock.Mock(status_code=200, reason="OK", content=json.dumps(body).encode(), headers={})
+
+
+class TestOrderTemplate(unittest.TestCase):
+
+    def test_same_as_json_dumps(self):
+        template = OrderTemplate(**STATIC)
+        body = {POSITION_FIELDS[name]: value for name, value in STATIC.items()}
+        body.update((POSITION_FIELDS[name], DYNAMIC.get(name)) for name in template.dynamic)
+        self.assertEqual(template.render(**DYNAMIC), json.dumps(body))
+
+    def test_fields_left_out_null(self):
+        template = OrderTemplate(**STATIC)
+        body = json.loads(template.render(direction="SELL", size=1))
+        self.assertEqual(set(body), set(POSITION_FIELDS.values()))
+        self.assertIsNone(body["stopDistance"])
+        self.assertEqual(json.loads(template.render()), dict(body, direction=None, size=None))
+        # without static fields
+        self.assertEqual(json.loads(OrderTemplate().render(**dict(STATIC, **DYNAMIC))),
+                         {POSITION_FIELDS[name]: value for name, value in dict(STATIC, **DYNAMIC).items()})
+
+    def test_unknown_or_static_fields(self):
+        with self.assertRaises(TypeError):
+            OrderTemplate(epics="CS.D.EURUSD.MINI.IP")
+        with self.assertRaises(TypeError):
+            OrderTemplate(**STATIC).render(epic="CS.D.GBPUSD.MINI.IP")
+
+    def test_same_body_as_create_open_position(self):
+        ig_service = IGService(config())
+        self.addCleanup(ig_service.crud_session.close)
+        ig_service.crud_session._send = mock.Mock(return_value=response({"dealReference": "REF"}))
+        ig_service.fetch_deal_by_deal_reference = mock.Mock(return_value={"dealStatus": "ACCEPTED"})
+
+        ig_service.create_open_position(**dict(STATIC, **DYNAMIC))
+        ig_service.create_open_position_from_template(OrderTemplate(**STATIC), **DYNAMIC)
+        plain, templated = [call[1]["body"] for call in ig_service.crud_session._send.call_args_list]
+        self.assertEqual(json.loads(templated), json.loads(plain))
+
+
+class TestConfirmPollDelays(unittest.TestCase):
+
+    def test_within_timeout(self):
+        for timeout in (0, 0.04, 0.05, 0.3, 1, 5, 12.5):
+            delays = list(confirm_poll_delays(timeout))
+            self.assertLessEqual(sum(delays), timeout, timeout)
+            # one more poll would be past the timeout
+            next_delay = min(delays[-1] * 2, 0.5) if delays else 0.05
+            self.assertGreater(sum(delays) + next_delay, timeout, timeout)
+
+    def test_doubling_up_to_maximum(self):
+        self.assertEqual(list(confirm_poll_delays(2, initial=0.1, maximum=0.5)), [0.1, 0.2, 0.4, 0.5, 0.5])
+
+
+class TestDealingConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = IGSessionHandler("http://127.0.0.1", config())
+        self.addCleanup(self.handler.close)
+        self.handler._update_headers({"Authorization": "Bearer token"})
+        self.handler.session.request = mock.Mock(return_value=response({}))
+        self.handler.dealing_session.request = mock.Mock(return_value=response({}))
+
+    def sent_over(self, endpoint):
+        self.handler.session.request.reset_mock()
+        self.handler.dealing_session.request.reset_mock()
+        self.handler._send("POST", endpoint, body="{}", headers={"VERSION": "2"})
+        if self.handler.dealing_session.request.called:
+            self.assertFalse(self.handler.session.request.called)
+            return "dealing", self.handler.dealing_session.request.call_args
+        return "main", self.handler.session.request.call_args
+
+    def test_deals_over_dealing_pool(self):
+        for endpoint in ("/positions/otc", "/positions/otc/DIAAAA", "/workingorders/otc",
+                         "/workingorders/otc/DIAAAB", "/confirms/REF"):
+            pool, call = self.sent_over(endpoint)
+            self.assertEqual(pool, "dealing", endpoint)
+            # with the authentication headers of the main session
+            self.assertEqual(call[1]["headers"]["Authorization"], "Bearer token")
+            self.assertEqual(call[1]["headers"]["VERSION"], "2")
+
+    def test_others_over_main_pool(self):
+        for endpoint in ("/positions", "/workingorders", "/accounts", "/markets", "/prices/CS.D.EURUSD.MINI.IP",
+                         "/session"):
+            self.assertEqual(self.sent_over(endpoint)[0], "main", endpoint)
+
+    def test_single_pool(self):
+        handler = IGSessionHandler("http://127.0.0.1", config(dealing_connection="False"))
+        self.addCleanup(handler.close)
+        self.assertIsNone(handler.dealing_session)
+        handler.session.request = mock.Mock(return_value=response({}))
+        handler._send("POST", "/positions/otc", body="{}", headers={"VERSION": "2"})
+        self.assertTrue(handler.session.request.called)
+
+    def test_warm_up(self):
+        self.handler.warm_up(connections=3)
+        self.assertEqual(self.handler.dealing_session.request.call_count, 3)
+        self.assertEqual(self.handler.dealing_session.request.call_args[0], ("HEAD", "http://127.0.0.1"))
+        self.assertFalse(self.handler.session.request.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
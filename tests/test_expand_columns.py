@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGService.expand_columns against the implementation it replaced, which mapped a lambda over the
+nested column once per sub-column: the same frame, with missing records and None fields
+
+    python -m unittest tests.test_expand_columns
+"""
+import unittest
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from trading_ig.IGService import IGService
+
+NAN = float("nan")
+
+
+def expand_columns_map(data, d_cols, flag_col_prefix=False, col_overlap_allowed=None):
+    """Previous implementation"""
+    if col_overlap_allowed is None:
+        col_overlap_allowed = []
+    for (col_lev1, lst_col) in d_cols.items():
+        ser = data[col_lev1]
+        del data[col_lev1]
+        for col in lst_col:
+            if col not in data.columns or col in col_overlap_allowed:
+                if flag_col_prefix:
+                    colname = col_lev1 + "_" + col
+                else:
+                    colname = col
+                data[colname] = ser.map(lambda x: x[col], na_action='ignore')
+            else:
+                raise (NotImplementedError("col overlap: %r" % col))
+    return data
+
+
+D_COLS = {"position": ["dealId", "size", "direction", "limitLevel", "trailingStep"],
+          "market": ["epic", "bid", "offer", "marketStatus"]}
+
+
+def positions():
+    return pd.DataFrame({
+        "position": [
+            {"dealId": "DIAAAA", "size": 1.0, "direction": "BUY", "limitLevel": None, "trailingStep": None},
+            {"dealId": "DIAAAB", "size": 2.5, "direction": "SELL", "limitLevel": 1.25, "trailingStep": None},
+            # a record IG left out
+            NAN,
+            {"dealId": None, "size": 3.0, "direction": "BUY", "limitLevel": 1.5, "trailingStep": None},
+        ],
+        "market": [
+            {"epic": "CS.D.EURUSD.MINI.IP", "bid": 1.1, "offer": 1.2, "marketStatus": "TRADEABLE"},
+            {"epic": "CS.D.GBPUSD.MINI.IP", "bid": None, "offer": None, "marketStatus": "CLOSED"},
+            {"epic": "IX.D.FTSE.DAILY.IP", "bid": 7000, "offer": 7001, "marketStatus": "TRADEABLE"},
+            None,
+        ],
+    })
+
+
+@unittest.skipIf(pd is None, "requires pandas")
+class TestExpandColumns(unittest.TestCase):
+
+    def assert_same(self, d_cols, **kwargs):
+        expected = expand_columns_map(positions(), d_cols, **kwargs)
+        result = IGService.expand_columns(positions(), d_cols, **kwargs)
+        pd.testing.assert_frame_equal(result, expected)
+        return result
+
+    def test_same_as_map(self):
+        result = self.assert_same(D_COLS)
+        self.assertEqual(list(result.columns), D_COLS["position"] + D_COLS["market"])
+        self.assertEqual(result["size"].dtype, "float64")
+        self.assertTrue(result["limitLevel"].isna()[[0, 2]].all())
+        self.assertTrue(result["bid"].isna()[[1, 3]].all())
+
+    def test_prefix(self):
+        result = self.assert_same(D_COLS, flag_col_prefix=True)
+        self.assertIn("position_dealId", result.columns)
+        self.assertIn("market_epic", result.columns)
+
+    def test_single_sub_column(self):
+        result = self.assert_same({"position": ["size"], "market": ["epic"]})
+        self.assertEqual(list(result.columns), ["size", "epic"])
+
+    def test_overlap(self):
+        d_cols = {"position": ["size"], "market": ["size"]}
+        with self.assertRaises(NotImplementedError):
+            expand_columns_map(positions(), d_cols)
+        with self.assertRaises(NotImplementedError):
+            IGService.expand_columns(positions(), d_cols)
+        # an allowed overlap replaces the column
+        frames = []
+        for expand in (expand_columns_map, IGService.expand_columns):
+            data = positions()
+            data["epic"] = "-"
+            frames.append(expand(data, {"market": ["epic"]}, col_overlap_allowed=["epic"]))
+        pd.testing.assert_frame_equal(frames[1], frames[0])
+        self.assertEqual(frames[1]["epic"][0], "CS.D.EURUSD.MINI.IP")
+
+    def test_missing_sub_column(self):
+        # the previous implementation raised KeyError, the missing field is now NaN
+        data = positions()
+        del data["position"][0]["direction"]
+        result = IGService.expand_columns(data, {"position": ["dealId", "direction"]})
+        self.assertTrue(pd.isna(result["direction"][0]))
+        self.assertEqual(result["direction"][1], "SELL")
+        self.assertEqual(result["dealId"][0], "DIAAAA")
+
+
+if __name__ == "__main__":
+    unittest.main()
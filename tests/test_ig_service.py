@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGService with the REST API answered by a stub: paginated results fetched concurrently and put back
+together in page order, and historical prices requested with the arguments of earlier releases
+
+    python -m unittest tests.test_ig_service
+"""
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from trading_ig import IGService
+
+CONFIG = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                               rate_limit_enabled=False, token_refresh=False)
+
+
+class StubPages(object):
+    """Pages of two activities each, later pages answered sooner so they complete out of order"""
+
+    def __init__(self, total_pages):
+        self.total_pages = total_pages
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def read(self, endpoint, params, version):
+        page = params["pageNumber"]
+        with self._lock:
+            self.requested.append(page)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.01 * (self.total_pages - page))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        metadata = {"pageData": {"pageSize": 2, "pageNumber": page, "totalPages": self.total_pages}}
+        return {"activities": [page * 2 - 1, page * 2], "metadata": metadata}
+
+
+class TestFetchAllPages(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = IGService(CONFIG)
+        self.pages = StubPages(6)
+        self.ig_service.crud_session.read = self.pages.read
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_page_order(self):
+        data = self.ig_service._fetch_all_pages("/history/activity", {"pageSize": 2}, "3", "activities", max_workers=5)
+        self.assertEqual(data["activities"], list(range(1, 13)))
+        # metadata of the first page
+        self.assertEqual(data["metadata"]["pageData"]["pageNumber"], 1)
+        self.assertEqual(self.pages.requested[0], 1)
+        self.assertEqual(sorted(self.pages.requested), [1, 2, 3, 4, 5, 6])
+        self.assertGreater(self.pages.max_in_flight, 1)
+
+    def test_bounded_workers(self):
+        data = self.ig_service._fetch_all_pages("/history/activity", {"pageSize": 2}, "3", "activities", max_workers=2)
+        self.assertEqual(data["activities"], list(range(1, 13)))
+        self.assertLessEqual(self.pages.max_in_flight, 2)
+
+    def test_wait_one_page_at_a_time(self):
+        data = self.ig_service._fetch_all_pages(
+            "/history/activity", {"pageSize": 2}, "3", "activities", max_workers=5, wait=0.001)
+        self.assertEqual(data["activities"], list(range(1, 13)))
+        self.assertEqual(self.pages.requested, [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.pages.max_in_flight, 1)
+
+    def test_single_page(self):
+        self.pages.total_pages = 1
+        data = self.ig_service._fetch_all_pages("/history/activity", {"pageSize": 2}, "3", "activities")
+        self.assertEqual(data["activities"], [1, 2])
+        self.assertEqual(self.pages.requested, [1])
+
+
+class TestHistoricalPrices(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = IGService(CONFIG)
+        self.read = mock.Mock(return_value={
+            "prices": [], "metadata": {"pageData": {"pageSize": 20, "pageNumber": 1, "totalPages": 1}}})
+        self.ig_service.crud_session.read = self.read
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_positional_date_range(self):
+        self.ig_service.fetch_historical_prices_by_epic(
+            "CS.D.EURUSD.MINI.IP", "2021-01-04T00:00:00", "2021-01-05T00:00:00")
+        endpoint, params, version = self.read.call_args[0]
+        self.assertEqual(endpoint, "/prices/CS.D.EURUSD.MINI.IP")
+        self.assertEqual(params, {"from": "2021-01-04T00:00:00", "to": "2021-01-05T00:00:00", "pageSize": 20,
+                                  "pageNumber": 1})
+
+    def test_resolution(self):
+        self.ig_service.fetch_historical_prices_by_epic(
+            "CS.D.EURUSD.MINI.IP", "2021-01-04T00:00:00", "2021-01-05T00:00:00", resolution="1H")
+        self.assertEqual(self.read.call_args[0][1]["resolution"], "HOUR")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Parsing of item updates, control requests of LSClient through the proxy of the environment, as the
+stream connection, conflated subscriptions, the recovery of lost sessions, and stream lines split
+across reads
+
+    python -m unittest tests.test_lightstreamer
+"""
+import io
+import os
+import queue
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl
+
+from trading_ig.lightstreamer import (
+    ConflatingSubscription, ControlConnection, LineBuffer, LSClient, StreamReader, Subscription, parse_url)
+
+
+FIELDS = ["UPDATE_TIME", "BID", "OFFER", "MARKET_STATE"]
+ITEMS = ["MARKET:CS.D.EURUSD.MINI.IP", "MARKET:CS.D.GBPUSD.MINI.IP"]
+
+
+def baseline_values(lines):
+    """Values of every update, as parsed before items were updated in place"""
+    items = {}
+    updates = []
+    for line in lines:
+        toks = line.rstrip("\r\n").split("|")
+        item_pos = int(toks[0])
+        current = items.get(item_pos, {})
+        items[item_pos] = {field: Subscription._decode(value, current.get(field))
+                           for field, value in zip(FIELDS, toks[1:])}
+        updates.append((item_pos, items[item_pos]))
+    return updates
+
+
+class TestItemUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.subscription = Subscription("MERGE", ITEMS, FIELDS)
+        self.updates = []
+        self.subscription.addlistener(self.updates.append)
+
+    def values(self, *lines):
+        for line in lines:
+            self.subscription.notifyupdate(line)
+        return [dict(item_update["values"]) for item_update in self.updates[-len(lines):]]
+
+    def test_unchanged_values(self):
+        self.assertEqual(self.values("1|12:00:00|1.10000|1.10020|TRADEABLE", "1|12:00:01|1.10010||", "1||||\r\n"), [
+            {"UPDATE_TIME": "12:00:00", "BID": "1.10000", "OFFER": "1.10020", "MARKET_STATE": "TRADEABLE"},
+            {"UPDATE_TIME": "12:00:01", "BID": "1.10010", "OFFER": "1.10020", "MARKET_STATE": "TRADEABLE"},
+            {"UPDATE_TIME": "12:00:01", "BID": "1.10010", "OFFER": "1.10020", "MARKET_STATE": "TRADEABLE"},
+        ])
+
+    def test_items_apart(self):
+        self.values("1|12:00:00|1.10000|1.10020|TRADEABLE", "2|12:00:01|1.30000||EDIT")
+        first, second = self.updates
+        self.assertEqual((first["pos"], first["name"]), (1, ITEMS[0]))
+        self.assertEqual((second["pos"], second["name"]), (2, ITEMS[1]))
+        self.assertEqual(second["values"], {"UPDATE_TIME": "12:00:01", "BID": "1.30000", "OFFER": None,
+                                            "MARKET_STATE": "EDIT"})
+
+    def test_null_and_empty(self):
+        self.assertEqual(self.values("1|12:00:00|1.10000|1.10020|TRADEABLE", "1||#|$|")[1],
+                         {"UPDATE_TIME": "12:00:00", "BID": None, "OFFER": "", "MARKET_STATE": "TRADEABLE"})
+        # and unchanged from then on
+        self.assertEqual(self.values("1|12:00:01|||")[0],
+                         {"UPDATE_TIME": "12:00:01", "BID": None, "OFFER": "", "MARKET_STATE": "TRADEABLE"})
+
+    def test_escaped_values(self):
+        # a value starting with # or $ is sent with another one in front
+        self.assertEqual(self.values("1|##|$$|#$1|$#EDIT")[0],
+                         {"UPDATE_TIME": "#", "BID": "$", "OFFER": "$1", "MARKET_STATE": "#EDIT"})
+        self.assertEqual(self.values("1|12:00:00|1.1|1.2|€ ±")[0]["MARKET_STATE"], "€ ±")
+
+    def test_unchanged_runs(self):
+        self.assertEqual(self.values("1|12:00:00|1.10000|1.10020|TRADEABLE", "1|^3|CLOSED", "1|12:00:01|^2|#")[1:], [
+            {"UPDATE_TIME": "12:00:00", "BID": "1.10000", "OFFER": "1.10020", "MARKET_STATE": "CLOSED"},
+            {"UPDATE_TIME": "12:00:01", "BID": "1.10000", "OFFER": "1.10020", "MARKET_STATE": None},
+        ])
+
+    def test_same_as_baseline(self):
+        lines = ["1|12:00:00|1.10000|1.10020|TRADEABLE", "2|12:00:00|#|$|EDIT", "1|12:00:01|1.10010||",
+                 "2||1.30000|1.30020|TRADEABLE", "1|||#|$", "1|$$1|##|$#|", "2||||\r\n", "1|12:00:02|1.1||"]
+        for line in lines:
+            self.subscription.notifyupdate(line)
+        self.assertEqual([(item_update["pos"], item_update["values"]) for item_update in self.updates],
+                         baseline_values(lines))
+
+    def test_item_update(self):
+        self.values("1|12:00:00|1.10000|1.10020|TRADEABLE")
+        item_update = self.updates[0]
+        self.assertEqual(item_update.value("OFFER"), "1.10020")
+        self.assertEqual(item_update.field_values, ("12:00:00", "1.10000", "1.10020", "TRADEABLE"))
+        self.assertEqual(dict(item_update), {"pos": 1, "name": ITEMS[0], "values": item_update.values})
+        # a later update doesn't change an earlier one
+        self.values("1|12:00:01|1.10010||")
+        self.assertEqual(item_update["values"]["BID"], "1.10000")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers control requests, as the Lightstreamer server or a proxy forwarding them, and
+    refuses tunnels"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.requests.append((self.command, self.path, self.headers.get("Proxy-Authorization")))
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "4")
+        self.end_headers()
+        self.wfile.write(b"OK\r\n")
+
+    def do_CONNECT(self):
+        self.server.requests.append((self.command, self.path, self.headers.get("Proxy-Authorization")))
+        self.send_response(502)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def proxy_environment(**variables):
+    """os.environ without proxy settings, but the given ones"""
+    environment = {k: v for k, v in os.environ.items() if not k.lower().endswith("_proxy")}
+    environment.update(variables)
+    return mock.patch.dict(os.environ, environment, clear=True)
+
+
+class TestControlConnectionProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.address = "127.0.0.1:%d" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, url):
+        connection = ControlConnection(parse_url(url), timeout=5)
+        try:
+            return connection.post("lightstreamer/control.txt", "LS_op=destroy")
+        finally:
+            connection.close()
+
+    def test_direct(self):
+        with proxy_environment():
+            self.assertEqual(self.post("http://%s" % self.address), "OK\r\n")
+        self.assertEqual(self.server.requests, [("POST", "/lightstreamer/control.txt", None)])
+
+    def test_forwarded_by_proxy(self):
+        with proxy_environment(http_proxy="http://user:p%%40ss@%s" % self.address):
+            self.assertEqual(self.post("http://push.lightstreamer.test/ls/"), "OK\r\n")
+        self.assertEqual(self.server.requests, [
+            ("POST", "http://push.lightstreamer.test/ls/lightstreamer/control.txt", "Basic dXNlcjpwQHNz")])
+
+    def test_tunnelled_through_proxy(self):
+        with proxy_environment(https_proxy=self.address):
+            with self.assertRaises(OSError):
+                self.post("https://push.lightstreamer.test")
+        self.assertEqual(self.server.requests, [("CONNECT", "push.lightstreamer.test:443", None)])
+
+    def test_no_proxy(self):
+        with proxy_environment(http_proxy="http://proxy.invalid:3128", no_proxy="127.0.0.1"):
+            self.assertEqual(self.post("http://%s" % self.address), "OK\r\n")
+        self.assertEqual(self.server.requests, [("POST", "/lightstreamer/control.txt", None)])
+
+
+class TestConflatingSubscription(unittest.TestCase):
+
+    def test_listener_stops_flushes(self):
+        subscription = ConflatingSubscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID", "OFFER"],
+                                              max_frequency=100)
+        received = threading.Event()
+
+        def on_update(item_update):
+            # as a listener unsubscribing, on the flusher thread
+            subscription.stop()
+            received.set()
+
+        subscription.addlistener(on_update)
+        flusher = subscription._flusher
+        with self.assertNoLogs("trading_ig.lightstreamer", "ERROR"):
+            subscription.notifyupdate("1|1.10000|1.10020")
+            self.assertTrue(received.wait(5))
+            flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+        self.assertIsNone(subscription._flusher)
+
+        # and flushes again once restarted
+        received.clear()
+        subscription.start()
+        subscription.notifyupdate("1|1.10010|")
+        self.assertTrue(received.wait(5))
+        subscription.stop()
+
+
+class TestStreamReader(unittest.TestCase):
+
+    LINES = ["1,1|1.10000|\u00a3 sterling|", "PROBE", "2,1|{\"dealReference\":\"\u20ac\"}||", "LOOP"]
+
+    def test_lines_split_across_reads(self):
+        data = "\r\n".join(self.LINES).encode("utf-8")
+        # every chunk size splits lines, CRLFs and multi-byte characters somewhere
+        for chunk_size in range(1, 12):
+            reader = StreamReader(io.BytesIO(data), chunk_size=chunk_size)
+            # the last line has no line break, it comes out at the end of the stream
+            self.assertEqual(reader.readlines(), self.LINES, chunk_size)
+            self.assertEqual(reader.readline(), "")
+
+    def test_burst_in_one_read(self):
+        reader = StreamReader(io.BytesIO("".join(line + "\r\n" for line in self.LINES).encode("utf-8")))
+        self.assertEqual([reader.readline() for _ in self.LINES], self.LINES)
+        self.assertEqual(reader.reads, 1)
+        self.assertEqual(reader.readline(), "")
+
+    def test_line_buffer(self):
+        lines = LineBuffer()
+        euro = "\u20ac".encode("utf-8")
+        self.assertEqual(lines.feed(b"PRO"), [])
+        self.assertEqual(lines.feed(b"BE\r"), [])
+        self.assertEqual(lines.feed(b"\n1,1|" + euro[:1]), ["PROBE"])
+        self.assertEqual(lines.feed(euro[1:] + b"|\r\nLO"), ["1,1|\u20ac|"])
+        self.assertEqual(lines.flush(), ["LO"])
+        self.assertEqual(lines.flush(), [])
+
+
+class StubStream(object):
+    """Stream connection, returning what is fed to it until it ends or is closed"""
+
+    def __init__(self, session_id):
+        self._chunks = queue.Queue()
+        self.closed = False
+        self.feed("OK\r\nSessionId:%s\r\n\r\n" % session_id)
+
+    def feed(self, text):
+        self._chunks.put(text.encode("utf-8"))
+
+    def read(self, size):
+        return self._chunks.get()
+
+    def close(self):
+        self.closed = True
+        self._chunks.put(b"")
+
+
+class StubControlConnection(object):
+    """Accepts every control request, recording (session, operation, table) of each, unless
+    failing is set"""
+
+    requests = []
+    failing = False
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+
+    def post(self, path, body):
+        if StubControlConnection.failing:
+            StubControlConnection.failing = False
+            raise IOError("Control request failed: 503 Service Unavailable")
+        lines = body.decode("utf-8").split("\r\n")
+        for line in lines:
+            params = dict(parse_qsl(line))
+            self.requests.append((params["LS_session"], params["LS_op"], params.get("LS_Table")))
+        return "OK\r\n" * len(lines)
+
+    def close(self):
+        pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+class TestRecovery(unittest.TestCase):
+
+    def setUp(self):
+        StubControlConnection.requests = []
+        StubControlConnection.failing = False
+        patcher = mock.patch("trading_ig.lightstreamer.ControlConnection", StubControlConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.streams = []
+        self.client = LSClient("http://push.lightstreamer.test")
+        self.client._call = mock.Mock(side_effect=self.open_stream)
+        self.logins = []
+        self.client.enable_recovery(self.login, initial_delay=0.01, max_attempts=3)
+        self.updates = []
+        self.subscription = Subscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID", "OFFER"])
+        self.subscription.addlistener(lambda item_update: self.updates.append(dict(item_update["values"])))
+
+    def tearDown(self):
+        self.client._closing.set()
+        for stream in self.streams:
+            stream.close()
+        if self.client._stream_connection_thread is not None:
+            self.client._stream_connection_thread.join(5)
+
+    def open_stream(self, base_url, url, body):
+        stream = StubStream("S%d" % (len(self.streams) + 1))
+        self.streams.append(stream)
+        return stream
+
+    def login(self):
+        self.logins.append(True)
+        return "http://push2.lightstreamer.test", "ACC", "CST-cst|XST-xst"
+
+    def test_recover_and_resubscribe(self):
+        self.client.connect()
+        key = self.client.subscribe(self.subscription)
+        self.streams[0].feed("1,1|1.10000|1.10020\r\n")
+        wait_for(lambda: self.updates)
+
+        self.streams[0].feed("SYNC ERROR\r\n")
+        wait_for(lambda: self.client.recovery_stats.recoveries == 1)
+        self.assertEqual(len(self.logins), 1)
+        self.assertEqual(self.client._base_url.netloc, "push2.lightstreamer.test")
+        self.assertEqual(StubControlConnection.requests, [("S1", "add", str(key)), ("S2", "add", str(key))])
+        self.assertEqual(self.client.recovery_stats.last_cause, "SYNC ERROR")
+        self.assertFalse(self.client.recovery_stats.in_outage)
+
+        # the item carries on from its last values
+        self.streams[1].feed("1,1|1.10010|\r\n")
+        wait_for(lambda: len(self.updates) == 2)
+        self.assertEqual(self.updates[1], {"BID": "1.10010", "OFFER": "1.10020"})
+
+    def test_subscribe_while_recovering(self):
+        self.client.connect()
+        first = self.client.subscribe(self.subscription)
+        logging_in = threading.Event()
+        release = threading.Event()
+
+        def login():
+            logging_in.set()
+            release.wait(5)
+            return self.login()
+
+        self.client._session_factory = login
+        self.streams[0].feed("END\r\n")
+        self.assertTrue(logging_in.wait(5))
+        # no session to send them to, they wait for the recovery
+        second = self.client.subscribe(Subscription("MERGE", ["MARKET:CS.D.GBPUSD.MINI.IP"], ["BID"]))
+        third = self.client.subscribe(Subscription("MERGE", ["MARKET:CS.D.USDJPY.MINI.IP"], ["BID"]))
+        self.client.unsubscribe(first)
+        self.assertEqual(StubControlConnection.requests, [("S1", "add", str(first))])
+        release.set()
+
+        wait_for(lambda: self.client.recovery_stats.recoveries == 1)
+        self.assertEqual(StubControlConnection.requests[1:], [("S2", "add", str(second)), ("S2", "add", str(third))])
+        self.assertEqual(sorted(self.client._subscriptions), [second, third])
+
+    def test_failed_resubscribe_abandons_stream(self):
+        self.client.connect()
+        key = self.client.subscribe(self.subscription)
+        StubControlConnection.failing = True
+        self.streams[0].feed("ERROR\r\n")
+
+        wait_for(lambda: self.client.recovery_stats.recoveries == 1)
+        self.assertEqual(len(self.streams), 3)
+        # the session whose subscriptions failed is dropped for another one
+        self.assertTrue(self.streams[1].closed)
+        self.assertEqual(self.client.recovery_stats.failed_attempts, 1)
+        self.assertEqual(StubControlConnection.requests, [("S1", "add", str(key)), ("S3", "add", str(key))])
+
+    def test_give_up_after_max_attempts(self):
+        stream = StubStream("S1")
+        self.streams.append(stream)
+        self.client._call.side_effect = [stream] + [IOError("Connection refused")] * 3
+        self.client.connect()
+        self.client.subscribe(self.subscription)
+        stream.feed("END 31\r\n")
+
+        # recovery runs on the thread of the lost stream, which ends with it
+        self.client._stream_connection_thread.join(5)
+        stats = self.client.recovery_stats
+        self.assertEqual((stats.outages, stats.recoveries, stats.in_outage), (1, 0, False))
+        self.assertEqual(stats.failed_attempts, 3)
+        self.assertEqual(len(self.logins), 3)
+        self.assertEqual(self.client._subscriptions, {})
+        self.assertEqual(self.client._session, {})
+
+
+class TestControlBatch(unittest.TestCase):
+
+    def setUp(self):
+        StubControlConnection.requests = []
+        StubControlConnection.failing = False
+        patcher = mock.patch("trading_ig.lightstreamer.ControlConnection", StubControlConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = LSClient("http://push.lightstreamer.test")
+        self.client._control_url = self.client._base_url
+
+    def test_params_left_as_they_are(self):
+        requests = [{"LS_Table": key, "LS_op": "delete"} for key in range(1, 4)]
+        self.client._session["SessionId"] = "S1"
+        self.assertEqual(self.client._control_batch(requests), ["OK"] * 3)
+        self.assertEqual(requests, [{"LS_Table": key, "LS_op": "delete"} for key in range(1, 4)])
+
+        # sent again to a new session
+        self.client._session["SessionId"] = "S2"
+        self.client._control_batch(requests)
+        self.assertEqual(StubControlConnection.requests,
+                         [(session, "delete", str(key)) for session in ("S1", "S2") for key in range(1, 4)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+MarketCache on its own and behind IGService.load_markets: least recently used markets dropped past
+maxsize, expiry, persistence in SQLite, and epic lists split into requests IG accepts
+
+    python -m unittest tests.test_market_cache
+"""
+import os
+import shutil
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+from trading_ig import IGService
+from trading_ig.marketcache import MAX_EPICS_PER_REQUEST, MarketCache, epic_list, split_epics
+
+
+def epics(count):
+    return ["CS.D.MARKET%03d.MINI.IP" % i for i in range(count)]
+
+
+def details(epic):
+    return {"instrument": {"epic": epic, "name": epic}, "dealingRules": {}, "snapshot": {}}
+
+
+class StubMarkets(object):
+    """Answers the '/markets' requests of IGService, recording the epics of each"""
+
+    def __init__(self):
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def read(self, endpoint, params, version):
+        chunk = params["epics"].split(",")
+        with self._lock:
+            self.requested.append(chunk)
+        return {"marketDetails": [details(epic) for epic in chunk]}
+
+
+class TestSplitEpics(unittest.TestCase):
+
+    def test_epic_list(self):
+        self.assertEqual(epic_list("A, B,,C "), ["A", "B", "C"])
+        self.assertEqual(epic_list(("A", "B")), ["A", "B"])
+
+    def test_split(self):
+        chunks = split_epics(epics(120))
+        self.assertEqual([len(chunk.split(",")) for chunk in chunks],
+                         [MAX_EPICS_PER_REQUEST, MAX_EPICS_PER_REQUEST, 20])
+        self.assertEqual(",".join(chunks), ",".join(epics(120)))
+        self.assertEqual(split_epics("A,B,C", size=2), ["A,B", "C"])
+        self.assertEqual(split_epics([]), [])
+
+
+class TestMarketCache(unittest.TestCase):
+
+    def test_least_recently_used_dropped(self):
+        cache = MarketCache(maxsize=2)
+        cache.put("A", details("A"))
+        cache.put("B", details("B"))
+        cache.get("A")
+        cache.put("C", details("C"))
+        self.assertEqual(len(cache), 2)
+        self.assertIn("A", cache)
+        self.assertNotIn("B", cache)
+        self.assertEqual(cache.missing(["A", "B", "C"]), ["B"])
+
+    def test_expiry(self):
+        cache = MarketCache(ttl=60)
+        with mock.patch("trading_ig.marketcache.time.time", return_value=1000.0):
+            cache.put("A", details("A"))
+        with mock.patch("trading_ig.marketcache.time.time", return_value=1060.0):
+            self.assertEqual(cache.get("A"), details("A"))
+        with mock.patch("trading_ig.marketcache.time.time", return_value=1061.0):
+            self.assertIsNone(cache.get("A"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_persisted(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "markets.db")
+        cache = MarketCache(maxsize=1, path=path)
+        cache.put_many({"A": details("A"), "B": details("B")})
+        # dropped from memory, read back from the database
+        self.assertEqual(cache.get("A"), details("A"))
+        cache.close()
+
+        cache = MarketCache(path=path)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.missing(["A", "B", "C"]), ["C"])
+        cache.invalidate("A")
+        self.assertEqual(cache.missing(["A", "B"]), ["A"])
+
+    def test_from_config(self):
+        self.assertIsNone(MarketCache.from_config(types.SimpleNamespace()))
+        self.assertIsNone(MarketCache.from_config(types.SimpleNamespace(market_cache="False")))
+        cache = MarketCache.from_config(types.SimpleNamespace(market_cache=True, market_cache_size="10"))
+        self.assertEqual((cache.maxsize, cache.path), (10, None))
+
+
+class TestLoadMarkets(unittest.TestCase):
+
+    def service(self, **settings):
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, token_refresh=False, **settings)
+        ig_service = IGService(config)
+        self.addCleanup(ig_service.crud_session.close)
+        self.markets = StubMarkets()
+        ig_service.crud_session.read = self.markets.read
+        return ig_service
+
+    def test_only_missing_fetched(self):
+        ig_service = self.service(market_cache=True)
+        ig_service.load_markets(epics(3))
+        self.markets.requested = []
+        markets = ig_service.load_markets(epics(5))
+        self.assertEqual(self.markets.requested, [epics(5)[3:]])
+        self.assertEqual(markets, {epic: details(epic) for epic in epics(5)})
+        self.assertEqual(list(markets), epics(5))
+
+    def test_more_markets_than_cached(self):
+        ig_service = self.service(market_cache=True, market_cache_size=10)
+        markets = ig_service.load_markets(epics(120))
+        self.assertEqual(markets, {epic: details(epic) for epic in epics(120)})
+        self.assertEqual(len(self.markets.requested), 3)
+        self.assertEqual(len(ig_service.market_cache), 10)
+
+    def test_without_cache(self):
+        ig_service = self.service()
+        self.assertIsNone(ig_service.market_cache)
+        self.assertEqual(ig_service.load_markets(",".join(epics(60))), {epic: details(epic) for epic in epics(60)})
+        self.assertEqual(sorted(len(chunk) for chunk in self.markets.requested), [10, 50])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+MarketSearchIndex lookups, ranking, and markets changing their name, and IGService.search_markets
+answering from the index before calling the API
+
+    python -m unittest tests.test_marketsearch
+"""
+import types
+import unittest
+from unittest import mock
+
+from trading_ig import IGService
+from trading_ig.marketsearch import MarketSearchIndex
+
+MARKETS = [
+    {"epic": "CS.D.EURUSD.MINI.IP", "instrumentName": "EUR/USD Mini", "instrumentType": "CURRENCIES",
+     "expiry": "-", "bid": 1.1, "offer": 1.1002},
+    {"epic": "CS.D.EURUSD.CFD.IP", "instrumentName": "EUR/USD", "instrumentType": "CURRENCIES", "expiry": "-"},
+    {"epic": "CS.D.EURGBP.CFD.IP", "instrumentName": "EUR/GBP", "instrumentType": "CURRENCIES", "expiry": "-"},
+    {"epic": "IX.D.FTSE.DAILY.IP", "instrumentName": "FTSE 100", "instrumentType": "INDICES", "expiry": "DFB"},
+]
+
+
+def epics(markets):
+    return [market["epic"] for market in markets]
+
+
+class TestMarketSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = MarketSearchIndex(MARKETS)
+
+    def test_prefixes_of_every_word(self):
+        self.assertEqual(epics(self.index.search("eur us")), ["CS.D.EURUSD.CFD.IP", "CS.D.EURUSD.MINI.IP"])
+        self.assertEqual(epics(self.index.search("ftse")), ["IX.D.FTSE.DAILY.IP"])
+        self.assertEqual(self.index.search("eur jpy"), [])
+        self.assertEqual(self.index.search(" / "), [])
+
+    def test_whole_summary(self):
+        self.assertEqual(self.index.search("eur mini"), [MARKETS[0]])
+
+    def test_exact_epic_first(self):
+        found = self.index.search("CS.D.EURUSD.MINI.IP")
+        self.assertEqual(epics(found), ["CS.D.EURUSD.MINI.IP"])
+        found = self.index.search("cs.d.eurusd.mini.ip ")
+        self.assertEqual(epics(found), ["CS.D.EURUSD.MINI.IP"])
+        # markets whose name starts with the term next, then the others by name
+        self.assertEqual(epics(self.index.search("eur")),
+                         ["CS.D.EURGBP.CFD.IP", "CS.D.EURUSD.CFD.IP", "CS.D.EURUSD.MINI.IP"])
+        self.assertEqual(epics(self.index.search("eur", limit=1)), ["CS.D.EURGBP.CFD.IP"])
+
+    def test_renamed_market(self):
+        self.index.add_markets([{"epic": "IX.D.FTSE.DAILY.IP", "instrumentName": "UK Index"}])
+        self.assertEqual(self.index.search("100"), [])
+        self.assertNotIn("100", self.index._postings)
+        # words of the epic stay
+        self.assertEqual(self.index.search("ftse")[0]["instrumentName"], "UK Index")
+        self.assertEqual(self.index.search("uk ind")[0]["instrumentType"], "INDICES")
+
+    def test_market_details(self):
+        self.index.add_market_details([{
+            "instrument": {"epic": "CS.D.USDJPY.CFD.IP", "name": "USD/JPY", "type": "CURRENCIES", "expiry": "-"},
+            "snapshot": {"bid": 150.1, "offer": 150.12, "marketStatus": "TRADEABLE"}}])
+        market = self.index.search("usd jpy")[0]
+        self.assertEqual((market["instrumentName"], market["instrumentType"]), ("USD/JPY", "CURRENCIES"))
+        self.assertEqual((market["bid"], market["offer"], market["marketStatus"]), (150.1, 150.12, "TRADEABLE"))
+
+    def test_update_keeps_fields(self):
+        self.index.add_markets([{"epic": "CS.D.EURUSD.MINI.IP", "instrumentName": "EUR/USD Mini", "bid": 1.2,
+                                 "offer": None}])
+        market = self.index.search("CS.D.EURUSD.MINI.IP")[0]
+        self.assertEqual((market["bid"], market["offer"], market["expiry"]), (1.2, 1.1002, "-"))
+
+
+class TestSearchMarkets(unittest.TestCase):
+
+    def setUp(self):
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, token_refresh=False)
+        self.ig_service = IGService(config)
+        self.read = mock.Mock(return_value={"markets": [
+            {"epic": "CS.D.USDJPY.CFD.IP", "instrumentName": "USD/JPY", "instrumentType": "CURRENCIES",
+             "expiry": "-", "bid": 150.1}]})
+        self.ig_service.crud_session.read = self.read
+        self.ig_service.search_index = MarketSearchIndex(MARKETS)
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+
+    def test_from_index(self):
+        self.assertEqual(self.ig_service.search_markets("eur us"), {"markets": [MARKETS[1], MARKETS[0]]})
+        self.read.assert_not_called()
+
+    def test_api_when_not_in_index(self):
+        response = self.ig_service.search_markets("usd jpy")
+        self.assertEqual(epics(response["markets"]), ["CS.D.USDJPY.CFD.IP"])
+        self.assertEqual(self.read.call_args[0][1], {"searchTerm": "usd jpy"})
+        # the next search for it is answered locally, in the same shape
+        self.assertEqual(self.ig_service.search_markets("usd jpy"), response)
+        self.assertEqual(self.read.call_count, 1)
+
+    def test_bypass_index(self):
+        self.ig_service.search_markets("eur", use_index=False)
+        self.assertEqual(self.read.call_count, 1)
+        self.ig_service.search_index = None
+        self.ig_service.search_markets("eur")
+        self.assertEqual(self.read.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+MarketNavigationCrawler over a stub navigation tree: nodes fetched again only once they are older
+than max_age, the tree saved between runs, and subtrees dropped when IG removes them
+
+    python -m unittest tests.test_navigation
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from trading_ig.navigation import ROOT, MarketNavigationCrawler
+
+MAX_AGE = 3600
+
+
+def market(epic):
+    return {"epic": epic, "instrumentName": epic}
+
+
+class StubNavigation(object):
+    """Answers the '/marketnavigation' requests of IGService from a dict of nodes, counting them"""
+
+    def __init__(self):
+        self.tree = {
+            ROOT: {"nodes": [{"id": "1", "name": "Indices"}, {"id": "2", "name": "Forex"}], "markets": None},
+            "1": {"nodes": [{"id": "11", "name": "UK"}], "markets": None},
+            "11": {"nodes": None, "markets": [market("IX.D.FTSE.DAILY.IP")]},
+            "2": {"nodes": [{"id": "21", "name": "Majors"}], "markets": None},
+            "21": {"nodes": None, "markets": [market("CS.D.EURUSD.MINI.IP"), market("CS.D.GBPUSD.MINI.IP")]},
+        }
+        self.fetched = []
+        self.failing = set()
+        self._lock = threading.Lock()
+
+    def _node(self, node_id):
+        with self._lock:
+            self.fetched.append(node_id)
+        if node_id in self.failing:
+            raise IOError("error.public-api.failure")
+        return dict(self.tree[node_id])
+
+    def fetch_top_level_navigation_nodes(self):
+        return self._node(ROOT)
+
+    def fetch_sub_nodes_by_node(self, node):
+        return self._node(node)
+
+
+class Clock(object):
+    """Stands for the time module in trading_ig.navigation"""
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class TestCrawler(unittest.TestCase):
+
+    def setUp(self):
+        self.ig_service = StubNavigation()
+        self.clock = Clock()
+        patcher = mock.patch("trading_ig.navigation.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "navigation.json")
+
+    def crawler(self, **kwargs):
+        kwargs.setdefault("max_age", MAX_AGE)
+        return MarketNavigationCrawler(self.ig_service, path=self.path, max_workers=2, **kwargs)
+
+    def test_crawl(self):
+        crawler = self.crawler()
+        self.assertEqual(crawler.crawl(), 5)
+        self.assertEqual(sorted(self.ig_service.fetched), ["1", "11", "2", "21", ROOT])
+        self.assertEqual(sorted(crawler.epics()), ["CS.D.EURUSD.MINI.IP", "CS.D.GBPUSD.MINI.IP", "IX.D.FTSE.DAILY.IP"])
+        self.assertEqual(crawler.path_of("21"), ["Forex", "Majors"])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_max_age(self):
+        self.crawler().crawl()
+        self.ig_service.fetched = []
+
+        # a later run picks the tree up from disk, nothing is due yet
+        crawler = self.crawler()
+        self.assertEqual(len(crawler.nodes), 5)
+        self.assertEqual(crawler.crawl(), 0)
+        self.assertEqual(len(crawler.epics()), 3)
+
+        # only the stale node is fetched, the nodes below it are walked from the stored tree
+        crawler.nodes["2"]["fetched"] -= MAX_AGE + 1
+        self.assertEqual(crawler.crawl(), 1)
+        self.assertEqual(self.ig_service.fetched, ["2"])
+
+        self.clock.now += MAX_AGE + 1
+        self.assertEqual(crawler.crawl(), 5)
+        # unless asked to, whatever the age
+        self.assertEqual(self.crawler().crawl(refresh=True), 5)
+
+    def test_pruning(self):
+        crawler = self.crawler()
+        crawler.crawl()
+        # IG drops the 'Indices' branch and moves 'Majors' under a new node
+        self.ig_service.tree[ROOT]["nodes"] = [{"id": "2", "name": "Forex"}]
+        self.ig_service.tree["2"]["nodes"] = [{"id": "22", "name": "Currencies"}]
+        self.ig_service.tree["22"] = {"nodes": [{"id": "21", "name": "Majors"}], "markets": None}
+
+        crawler.crawl(refresh=True)
+        self.assertEqual(sorted(crawler.nodes), ["2", "21", "22", ROOT])
+        self.assertEqual(sorted(crawler.epics()), ["CS.D.EURUSD.MINI.IP", "CS.D.GBPUSD.MINI.IP"])
+        self.assertEqual(crawler.path_of("21"), ["Forex", "Currencies", "Majors"])
+        # the pruned tree is what was saved
+        self.assertEqual(sorted(self.crawler().nodes), ["2", "21", "22", ROOT])
+
+    def test_failed_node_fetched_next_time(self):
+        self.ig_service.failing.add("2")
+        crawler = self.crawler()
+        self.assertEqual(crawler.crawl(), 3)
+        self.assertEqual(list(crawler.errors), ["2"])
+        self.assertNotIn("21", crawler.nodes)
+
+        self.ig_service.failing.clear()
+        self.ig_service.fetched = []
+        self.assertEqual(crawler.crawl(), 2)
+        self.assertEqual(sorted(self.ig_service.fetched), ["2", "21"])
+        self.assertEqual(crawler.errors, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGService.fetch_historical_prices_by_epic with a price cache, against a local stub of the IG REST
+API serving minute bars
+
+    python -m unittest tests.test_price_cache
+"""
+import json
+import math
+import threading
+import types
+import unittest
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from trading_ig import IGService
+from trading_ig.SessionHandler import IGSessionHandler
+
+EPIC = "CS.D.EURUSD.MINI.IP"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def minute_bars(start, end):
+    """v3 minute bars from start to end, inclusive"""
+    bars = []
+    time = datetime.strptime(start, DATE_FORMAT)
+    while time <= datetime.strptime(end, DATE_FORMAT):
+        bars.append({"snapshotTime": time.strftime("%Y/%m/%d %H:%M:%S"),
+                     "snapshotTimeUTC": time.strftime(DATE_FORMAT),
+                     "openPrice": {"bid": 1.2, "ask": 1.2002}, "lastTradedVolume": time.minute})
+        time += timedelta(minutes=1)
+    return bars
+
+
+def prices_response(query, remaining):
+    """One page of a v3 '/prices/{epic}' response"""
+    bars = minute_bars(query["from"][0], query["to"][0])
+    page_size = int(query["pageSize"][0])
+    page_number = int(query["pageNumber"][0])
+    total_pages = max(1, math.ceil(len(bars) / page_size)) if page_size else 1
+    if page_size:
+        bars = bars[(page_number - 1) * page_size:page_number * page_size]
+    return {"prices": bars, "instrumentType": "CURRENCIES", "metadata": {
+        "allowance": {"remainingAllowance": remaining, "totalAllowance": 10000, "allowanceExpiry": 600000},
+        "size": len(bars),
+        "pageData": {"pageSize": page_size, "pageNumber": page_number, "totalPages": total_pages}}}
+
+
+class StubPricesHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+        self.server.remaining -= 1
+        content = json.dumps(prices_response(parse_qs(url.query), self.server.remaining)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TestPriceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubPricesHandler)
+        self.server.requests = []
+        self.server.remaining = 10000
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, token_refresh=False, price_cache=":memory:")
+        self.ig_service = IGService(config)
+        self.ig_service.crud_session = IGSessionHandler("http://127.0.0.1:%d" % self.server.server_port, config)
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+        self.ig_service.price_cache.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, start, end):
+        return self.ig_service.fetch_historical_prices_by_epic(
+            EPIC, resolution="1Min", start_date=start, end_date=end, pagesize=0)
+
+    def test_hit_same_as_miss(self):
+        miss = self.fetch("2021-01-04T09:00:00", "2021-01-04T09:09:00")
+        self.assertEqual(len(self.server.requests), 1)
+        hit = self.fetch("2021-01-04T09:00:00", "2021-01-04T09:09:00")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(miss, hit)
+        self.assertEqual(hit["instrumentType"], "CURRENCIES")
+        self.assertEqual(hit["metadata"]["size"], 10)
+        self.assertEqual(hit["metadata"]["pageData"], {"pageSize": 0, "pageNumber": 1, "totalPages": 1})
+        self.assertEqual(hit["metadata"]["allowance"]["remainingAllowance"], 9999)
+
+    def test_partial_hit(self):
+        self.fetch("2021-01-04T09:00:00", "2021-01-04T09:04:00")
+        data = self.fetch("2021-01-04T09:00:00", "2021-01-04T09:09:00")
+        # only the missing bars were requested
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(data["prices"], minute_bars("2021-01-04T09:00:00", "2021-01-04T09:09:00"))
+        self.assertEqual(data["instrumentType"], "CURRENCIES")
+        self.assertEqual(data["metadata"]["size"], 10)
+        self.assertEqual(data["metadata"]["allowance"]["remainingAllowance"], 9998)
+
+
+if __name__ == "__main__":
+    unittest.main()
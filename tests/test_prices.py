@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Columnar decoding of historical prices: the same values as flattening the bars with
+pandas.json_normalize, with typed columns, for the time formats of each API version
+
+    python -m unittest tests.test_prices
+"""
+import unittest
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+from trading_ig.prices import PRICE_FIELDS, PRICE_SIDES, prices_to_arrays, prices_to_dataframe
+
+
+def price(bid, ask, last=None):
+    return {"bid": bid, "ask": ask, "lastTraded": last}
+
+
+def bars(times, time_field="snapshotTimeUTC"):
+    prices = []
+    for i, snapshot_time in enumerate(times):
+        prices.append({
+            time_field: snapshot_time,
+            "openPrice": price(1.1 + i, 1.2 + i),
+            "closePrice": price(1.3 + i, 1.4 + i),
+            "highPrice": price(1.5 + i, 1.6 + i, 1.55 + i),
+            "lowPrice": price(1.0 + i, None),
+            "lastTradedVolume": 10 * i if i else None,
+        })
+    return prices
+
+
+@unittest.skipIf(pd is None, "requires numpy and pandas")
+class TestPricesToArrays(unittest.TestCase):
+
+    def reference(self, prices, time_field="snapshotTimeUTC"):
+        """The bars flattened by pandas, with the columns of prices_to_arrays"""
+        flat = pd.json_normalize(prices)
+        frame = pd.DataFrame({"timestamp": pd.to_datetime(flat[time_field]).astype("datetime64[ms]").astype(np.int64)})
+        for name, field in PRICE_FIELDS:
+            for side_name, side in PRICE_SIDES:
+                frame[f"{name}_{side_name}"] = flat[f"{field}.{side}"].astype(np.float64)
+        frame["volume"] = flat["lastTradedVolume"].astype(np.float64)
+        return frame
+
+    def test_same_as_json_normalize(self):
+        prices = bars(["2021-01-04T09:00:00", "2021-01-04T09:01:00", "2021-01-04T09:02:00"])
+        frame = prices_to_dataframe(prices)
+        pd.testing.assert_frame_equal(frame, self.reference(prices))
+        self.assertEqual(frame["timestamp"].dtype, np.int64)
+        self.assertTrue(all(frame[column].dtype == np.float64 for column in frame.columns[1:]))
+        # null prices and volumes
+        self.assertTrue(np.isnan(frame["low_ask"]).all())
+        self.assertTrue(np.isnan(frame["open_last"]).all())
+        self.assertEqual(frame["volume"].tolist()[1:], [10.0, 20.0])
+        self.assertTrue(np.isnan(frame["volume"][0]))
+
+    def test_arrays(self):
+        prices = bars(["2021-01-04T09:00:00", "2021-01-04T09:01:00"])
+        arrays = prices_to_arrays(prices)
+        self.assertEqual(len(arrays), 2 + len(PRICE_FIELDS) * len(PRICE_SIDES))
+        self.assertEqual(arrays["timestamp"].tolist(), [1609750800000, 1609750860000])
+        self.assertEqual(arrays["close_bid"].tolist(), [1.3, 2.3])
+
+    def test_older_time_formats(self):
+        expected = prices_to_arrays(bars(["2021-01-04T09:00:00", "2021-01-04T09:01:00"]))["timestamp"]
+        for times in (["2021/01/04 09:00:00", "2021/01/04 09:01:00"], ["2021:01:04-09:00:00", "2021:01:04-09:01:00"]):
+            arrays = prices_to_arrays(bars(times, time_field="snapshotTime"))
+            self.assertEqual(arrays["timestamp"].tolist(), expected.tolist(), times)
+
+    def test_no_prices(self):
+        frame = prices_to_dataframe([])
+        self.assertEqual(len(frame), 0)
+        self.assertEqual(list(frame.columns), list(self.reference(bars(["2021-01-04T09:00:00"])).columns))
+        self.assertEqual(frame["timestamp"].dtype, np.int64)
+
+
+if __name__ == "__main__":
+    unittest.main()
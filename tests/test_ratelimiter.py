@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGRateLimiter on a fake clock: classification of requests against IG's allowances, refills, giving
+up on the historical allowance, and keeping in step with the allowance IG reports
+
+    python -m unittest tests.test_ratelimiter
+"""
+import json
+import types
+import unittest
+from unittest import mock
+
+from trading_ig.Exceptions import AllowanceExhaustedException
+from trading_ig.ratelimiter import (
+    HISTORICAL, NON_TRADING, ONE_WEEK, TRADING, AllowanceBucket, IGRateLimiter, TokenBucket)
+from trading_ig.SessionHandler import IGSessionHandler
+
+
+class FakeClock(object):
+    """Stands for the time module, sleeping only moves the clock on"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("trading_ig.ratelimiter.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestRequestType(unittest.TestCase):
+
+    def test_trading(self):
+        for method, endpoint in (("POST", "/positions/otc"), ("DELETE", "/positions/otc"),
+                                 ("PUT", "/positions/otc/DIAAAA"), ("POST", "/workingorders/otc"),
+                                 ("DELETE", "/workingorders/otc/DIAAAB")):
+            self.assertEqual(IGRateLimiter.request_type(method, endpoint), TRADING, (method, endpoint))
+
+    def test_non_trading(self):
+        for method, endpoint in (("GET", "/positions/otc"), ("GET", "/positions"), ("GET", "/workingorders"),
+                                 ("GET", "/confirms/REF"), ("POST", "/watchlists"), ("GET", "/markets"),
+                                 ("GET", "/prices/CS.D.EURUSD.MINI.IP")):
+            self.assertEqual(IGRateLimiter.request_type(method, endpoint), NON_TRADING, (method, endpoint))
+
+    def test_historical_cost(self):
+        self.assertEqual(IGRateLimiter.historical_cost("/markets/CS.D.EURUSD.MINI.IP", {}), 0)
+        self.assertEqual(IGRateLimiter.historical_cost("/prices/CS.D.EURUSD.MINI.IP/MINUTE/50", {}), 50)
+        self.assertEqual(
+            IGRateLimiter.historical_cost("/prices/CS.D.EURUSD.MINI.IP", {"max": 10, "pageSize": 20}), 10)
+        self.assertEqual(IGRateLimiter.historical_cost("/prices/CS.D.EURUSD.MINI.IP", {"pageSize": 20}), 20)
+        # not known up front, corrected from the allowance in the response
+        self.assertEqual(IGRateLimiter.historical_cost("/prices/CS.D.EURUSD.MINI.IP", {"pageSize": 0}), 1)
+
+    def test_buckets_taken(self):
+        limiter = IGRateLimiter()
+        reservations = limiter._reservations("GET", "/prices/CS.D.EURUSD.MINI.IP/DAY/5", None)
+        self.assertEqual([(bucket.name, cost) for bucket, cost in reservations], [(NON_TRADING, 1), (HISTORICAL, 5)])
+        buckets = [bucket.name for bucket, _ in limiter._reservations("POST", "/positions/otc", {})]
+        self.assertEqual(buckets, [TRADING])
+
+
+class TestTokenBucket(ClockTestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket("test", 30, 60)
+        for _ in range(30):
+            bucket.acquire()
+        self.assertEqual(self.clock.slept, [])
+        self.assertEqual(bucket.tokens, 0)
+        # a token every 2 seconds
+        bucket.acquire()
+        self.assertEqual(self.clock.slept, [2.0])
+        self.clock.now += 10
+        self.assertEqual(bucket.tokens, 5)
+        # never more than the capacity
+        self.clock.now += 600
+        self.assertEqual(bucket.tokens, 30)
+
+    def test_waiting_callers_in_turn(self):
+        bucket = TokenBucket("test", 2, 1)
+        waits = [bucket._reserve(1) for _ in range(5)]
+        self.assertEqual(waits, [0, 0, 0.5, 1.0, 1.5])
+        self.assertEqual(bucket.tokens, -3)
+
+    def test_max_wait(self):
+        bucket = TokenBucket("test", 1, 10, max_wait=5)
+        bucket.acquire()
+        with self.assertRaises(AllowanceExhaustedException):
+            bucket.acquire()
+        # the reservation was given back
+        self.assertEqual(bucket.tokens, 0)
+        self.clock.now += 6
+        bucket.acquire()
+        self.assertEqual(self.clock.slept, [4.0])
+
+    def test_drain(self):
+        bucket = TokenBucket("test", 10, 60)
+        bucket.drain()
+        bucket.acquire()
+        self.assertEqual(self.clock.slept, [6.0])
+
+
+class TestAllowanceBucket(ClockTestCase):
+
+    def test_reset_at_once(self):
+        bucket = AllowanceBucket(HISTORICAL, 100, ONE_WEEK)
+        bucket.acquire(100)
+        self.clock.now += ONE_WEEK / 2
+        # nothing comes back before the reset
+        self.assertEqual(bucket.tokens, 0)
+        self.clock.now += ONE_WEEK / 2
+        self.assertEqual(bucket.tokens, 100)
+
+    def test_max_wait(self):
+        bucket = AllowanceBucket(HISTORICAL, 100, ONE_WEEK, max_wait=60)
+        bucket.acquire(90)
+        with self.assertRaises(AllowanceExhaustedException):
+            bucket.acquire(20)
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_sync(self):
+        bucket = AllowanceBucket(HISTORICAL, 10000, ONE_WEEK, max_wait=60)
+        bucket.sync(5, 30)
+        self.assertEqual((bucket.tokens, bucket.reset_in), (5, 30))
+        # waits for the reset IG reported, rather than a week
+        bucket.acquire(10)
+        self.assertEqual(self.clock.slept, [30])
+        # 5 points came out of the old allowance, 5 out of the new one
+        self.assertEqual(bucket.tokens, 10000 - 5)
+
+
+class TestRecordAllowance(ClockTestCase):
+
+    def test_from_metadata(self):
+        limiter = IGRateLimiter()
+        limiter.record_allowance({"prices": [], "metadata": {"allowance": {
+            "remainingAllowance": 9000, "totalAllowance": 10000, "allowanceExpiry": 3600}}})
+        self.assertEqual(limiter.historical_allowance, 9000)
+        self.assertEqual(limiter.buckets[HISTORICAL].reset_in, 3600)
+        # v2 responses have it at the top level, and other responses have none
+        limiter.record_allowance({"prices": [], "allowance": {"remainingAllowance": 8000, "allowanceExpiry": 60}})
+        self.assertEqual(limiter.historical_allowance, 8000)
+        limiter.record_allowance({"prices": [], "metadata": {"pageData": {}}})
+        self.assertEqual(limiter.historical_allowance, 8000)
+
+    def test_from_session_response(self):
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       token_refresh=False)
+        session = IGSessionHandler("http://127.0.0.1", config)
+        self.addCleanup(session.close)
+        body = {"prices": [], "metadata": {"allowance": {"remainingAllowance": 42, "allowanceExpiry": 100}}}
+        response = mock.Mock(status_code=200, reason="OK", content=json.dumps(body).encode(), headers={})
+        session._send = mock.Mock(return_value=response)
+
+        session.read("/prices/CS.D.EURUSD.MINI.IP", {"pageSize": 0}, "3")
+        self.assertEqual(session.rate_limiter.historical_allowance, 42)
+        session.read("/markets/CS.D.EURUSD.MINI.IP", {}, "3")
+        self.assertEqual(session.rate_limiter.historical_allowance, 42)
+
+    def test_disabled(self):
+        config = types.SimpleNamespace(rate_limit_enabled="False")
+        self.assertIsNone(IGRateLimiter.from_config(config))
+        config = types.SimpleNamespace(rate_limit_non_trading="10", rate_limit_historical_max_wait="5")
+        limiter = IGRateLimiter.from_config(config)
+        self.assertEqual(limiter.buckets[NON_TRADING].capacity, 10)
+        self.assertEqual(limiter.buckets[HISTORICAL].max_wait, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGSessionHandler shared between threads, with the REST API answered by a stub: logging in again
+once when several requests are rejected with the same token, copy-on-write headers, and the
+background thread renewing v3 tokens before they expire
+
+    python -m unittest tests.test_session_handler
+"""
+import datetime
+import itertools
+import json
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from trading_ig.Exceptions import ApiExceededException, IGExceptionSessionReset
+from trading_ig.SessionHandler import IGSessionHandler
+
+TOKEN_MISSING = {"errorCode": "error.security.client-token-missing"}
+
+
+def config(**settings):
+    """Handler settings, without rate limiting, nor the background refresher unless asked for"""
+    settings.setdefault("token_refresh", False)
+    return types.SimpleNamespace(
+        api_key="key", username="user", password="secret", acc_number="ACC",
+        rate_limit_enabled=False, **settings)
+
+
+ALLOWANCE_EXCEEDED = {"errorCode": "error.public-api.exceeded-account-allowance"}
+
+
+def response(body, status_code=200):
+    return mock.Mock(status_code=status_code, reason="OK", content=json.dumps(body).encode(), headers={})
+
+
+class StubIG(object):
+    """v3 logins and authenticated requests, standing in for IGSessionHandler._send"""
+
+    def __init__(self, expires_in=60):
+        self.expires_in = expires_in
+        self.logins = 0
+        self.refreshes = 0
+        self.refresh_fails = False
+        # (status, body) answers to the next refreshes, before any real one
+        self.refresh_errors = []
+        self.renewed_early = []
+        self.sent_headers = []
+        self.barrier = None
+        # set to hold refreshes until it is set itself
+        self.hold_refresh = None
+        self.refreshing = threading.Event()
+        self._tokens = itertools.count(1)
+        self.access_tokens = set()
+        self.refresh_token = None
+        self._lock = threading.Lock()
+
+    def _oauth(self):
+        n = next(self._tokens)
+        access_token = "access-%d" % n
+        # tokens issued earlier stay valid, requests in flight during a refresh still go through
+        self.access_tokens.add(access_token)
+        self.refresh_token = "refresh-%d" % n
+        return {"access_token": access_token, "refresh_token": self.refresh_token, "scope": "profile",
+                "token_type": "Bearer", "expires_in": str(self.expires_in)}
+
+    def expire(self):
+        """Rejects the access tokens issued so far"""
+        self.access_tokens.clear()
+
+    def send(self, method, endpoint, body=None, params=None, headers=None):
+        if endpoint == "/session":
+            with self._lock:
+                self.logins += 1
+            return response({"clientId": "1", "accountId": "ACC", "oauthToken": self._oauth()})
+        if endpoint == "/session/refresh-token":
+            with self._lock:
+                self.refreshes += 1
+                self.renewed_early.append(datetime.datetime.now() < self.handler._valid_until)
+            self.refreshing.set()
+            if self.hold_refresh is not None:
+                self.hold_refresh.wait(5)
+            if self.refresh_errors:
+                return response(*self.refresh_errors.pop(0))
+            if self.refresh_fails or json.loads(body).get("refresh_token") != self.refresh_token:
+                return response(TOKEN_MISSING, 401)
+            return response(self._oauth())
+        authorization = self.handler.session.headers.get("Authorization")
+        with self._lock:
+            self.sent_headers.append(self.handler.session.headers)
+        if self.barrier is not None:
+            # every request is on the wire before any of them is answered
+            self.barrier.wait(timeout=5)
+        if authorization is None or authorization.split()[-1] not in self.access_tokens:
+            return response(TOKEN_MISSING, 401)
+        return response({"dealReference": "REF"})
+
+    def attach(self, handler):
+        self.handler = handler
+        handler._send = self.send
+        return handler
+
+
+def wait_for(condition, timeout=5):
+    """Polls until condition() holds, or the timeout has passed"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class HandlerTestCase(unittest.TestCase):
+
+    settings = {}
+    expires_in = 60
+
+    def setUp(self):
+        self.ig = StubIG(self.expires_in)
+        self.handler = self.ig.attach(IGSessionHandler("http://127.0.0.1", config(**self.settings)))
+        self.addCleanup(self.handler.close)
+        self.handler.create_session(version="3")
+
+
+class TestResetSession(HandlerTestCase):
+
+    def test_stale_generation(self):
+        generation = self.handler._generation
+        self.handler._reset_session(generation)
+        self.assertEqual(self.ig.logins, 2)
+        # a request sent before that reset has nothing left to do
+        self.handler._reset_session(generation)
+        self.assertEqual(self.ig.logins, 2)
+        self.assertEqual(self.handler._generation, generation + 1)
+
+    def test_concurrent_rejections(self):
+        threads = 8
+        self.ig.expire()
+        self.ig.barrier = threading.Barrier(threads)
+        errors = []
+
+        def deal():
+            try:
+                self.handler.create("/positions/otc", {}, "2")
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=deal) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(5)
+
+        self.assertEqual(len(errors), threads)
+        self.assertTrue(all(isinstance(error, IGExceptionSessionReset) for error in errors))
+        # only the first rejection logs in again
+        self.assertEqual(self.ig.logins, 2)
+        self.ig.barrier = None
+        self.assertEqual(self.handler.create("/positions/otc", {}, "2"), {"dealReference": "REF"})
+
+    def test_headers_copy_on_write(self):
+        self.handler.create("/positions/otc", {}, "2")
+        before = self.ig.sent_headers[-1]
+        self.assertEqual(before["Authorization"], "Bearer access-1")
+
+        self.handler._reset_session()
+        self.handler.create("/positions/otc", {}, "2")
+        # the headers a request was sent with are left as they were
+        self.assertEqual(before["Authorization"], "Bearer access-1")
+        self.assertIsNot(self.ig.sent_headers[-1], before)
+        self.assertEqual(self.ig.sent_headers[-1]["Authorization"], "Bearer access-2")
+        self.assertEqual(self.ig.sent_headers[-1]["X-IG-API-KEY"], "key")
+
+
+class TestRenewSession(HandlerTestCase):
+
+    def setUp(self):
+        super(TestRenewSession, self).setUp()
+        patcher = mock.patch("trading_ig.SessionHandler.TOKEN_REFRESH_RETRY", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def renew(self):
+        self.handler._renew_session(self.handler._valid_until)
+
+    def test_allowance_exceeded_retried(self):
+        self.ig.refresh_errors = [(ALLOWANCE_EXCEEDED, 403)]
+        self.renew()
+        # refreshed on the second attempt, without logging in again
+        self.assertEqual((self.ig.refreshes, self.ig.logins), (2, 1))
+        self.assertEqual(self.handler.session.headers["Authorization"], "Bearer access-2")
+
+    def test_allowance_exceeded_gives_up(self):
+        self.ig.refresh_errors = [(ALLOWANCE_EXCEEDED, 403)] * 3
+        with self.assertRaises(ApiExceededException):
+            self.renew()
+        self.assertEqual((self.ig.refreshes, self.ig.logins), (3, 1))
+        self.assertEqual(self.handler.session.headers["Authorization"], "Bearer access-1")
+
+    def test_other_errors_not_reset(self):
+        self.ig.refresh_errors = [({"errorCode": "error.unexpected"}, 500)]
+        with self.assertRaises(Exception):
+            self.renew()
+        self.assertEqual(self.ig.logins, 1)
+
+    def test_auth_error_reset(self):
+        self.ig.refresh_errors = [({"errorCode": "error.security.oauth-token-invalid"}, 401)]
+        self.renew()
+        self.assertEqual(self.ig.logins, 2)
+        self.assertEqual(self.handler.session.headers["Authorization"], "Bearer access-2")
+
+
+class TestTokenRefresh(HandlerTestCase):
+
+    # renewed 0.8 seconds before the token expires, i.e. 0.2 seconds after it was issued
+    settings = {"token_refresh": True, "token_refresh_margin": 0.8}
+    expires_in = 1
+
+    def test_renews_before_expiry(self):
+        self.assertIsNotNone(self.handler._refresher)
+        self.assertTrue(wait_for(lambda: self.ig.refreshes >= 2))
+        self.assertTrue(all(self.ig.renewed_early))
+        self.assertEqual(self.ig.logins, 1)
+        # requests go out with the renewed token, without waiting for a refresh
+        self.handler.create("/positions/otc", {}, "2")
+        self.assertNotEqual(self.ig.sent_headers[-1]["Authorization"], "Bearer access-1")
+
+    def test_logs_in_again_when_refresh_rejected(self):
+        self.ig.refresh_fails = True
+        self.assertTrue(wait_for(lambda: self.ig.logins >= 2))
+        self.ig.refresh_fails = False
+        self.assertEqual(self.handler.create("/positions/otc", {}, "2"), {"dealReference": "REF"})
+
+    def test_lock_free_during_refresh(self):
+        self.ig.hold_refresh = threading.Event()
+        self.assertTrue(self.ig.refreshing.wait(5))
+        # the refresher is waiting for the refresh response, other threads can still update the
+        # authentication state
+        self.assertTrue(self.handler._lock.acquire(timeout=1))
+        self.handler._lock.release()
+        self.ig.hold_refresh.set()
+        self.assertTrue(wait_for(lambda: self.handler.session.headers["Authorization"] != "Bearer access-1"))
+        self.assertEqual(self.ig.logins, 1)
+
+    def test_stopped(self):
+        refresher = self.handler._refresher
+        self.handler.stop_token_refresh()
+        refresher.join(2)
+        self.assertFalse(refresher.is_alive())
+        refreshes = self.ig.refreshes
+        time.sleep(0.3)
+        self.assertEqual(self.ig.refreshes, refreshes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IGStreamService logging in through a local stub of the IG REST API, for the Lightstreamer
+credentials of v2 and v3 sessions
+
+    python -m unittest tests.test_stream_service
+"""
+import json
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from trading_ig import IGService, IGStreamService
+from trading_ig.SessionHandler import IGSessionHandler
+
+LIGHTSTREAMER_ENDPOINT = "https://demo-apd.marketdatasystems.com"
+
+
+class StubIGHandler(BaseHTTPRequestHandler):
+    """v2 logins return the CST / X-SECURITY-TOKEN headers, v3 logins only OAuth tokens, which
+    'GET /session?fetchSessionTokens=true' exchanges for the headers"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, headers=()):
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = {"accountId": "ACC", "clientId": "1", "lightstreamerEndpoint": LIGHTSTREAMER_ENDPOINT}
+        if self.headers["VERSION"] == "3":
+            body["oauthToken"] = {"access_token": "access", "refresh_token": "refresh", "scope": "profile",
+                                  "token_type": "Bearer", "expires_in": "60"}
+            self._reply(body)
+        else:
+            self._reply(body, [("CST", "cst-v2"), ("X-SECURITY-TOKEN", "xst-v2")])
+
+    def do_GET(self):
+        if self.path == "/session?fetchSessionTokens=true" and self.headers["Authorization"] == "Bearer access":
+            self._reply({"accountId": "ACC"}, [("CST", "cst-v3"), ("X-SECURITY-TOKEN", "xst-v3")])
+        else:
+            self._reply({"errorCode": "error.security.client-token-missing"})
+
+
+class TestStreamCredentials(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubIGHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                       rate_limit_enabled=False, token_refresh=False)
+        self.ig_service = IGService(config)
+        self.ig_service.crud_session = IGSessionHandler("http://127.0.0.1:%d" % self.server.server_port, config)
+        self.stream_service = IGStreamService(self.ig_service)
+        self.stream_service.acc_number = "ACC"
+
+    def tearDown(self):
+        self.ig_service.crud_session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_v2_login(self):
+        self.assertEqual(self.stream_service._stream_credentials('2'),
+                         (LIGHTSTREAMER_ENDPOINT, "ACC", "CST-cst-v2|XST-xst-v2"))
+
+    def test_v3_login(self):
+        self.assertEqual(self.stream_service._stream_credentials('3'),
+                         (LIGHTSTREAMER_ENDPOINT, "ACC", "CST-cst-v3|XST-xst-v3"))
+        self.assertEqual(self.ig_service.crud_session.session.headers["Authorization"], "Bearer access")
+
+    def test_account_of_rest_session(self):
+        self.stream_service.acc_number = None
+        self.assertEqual(self.stream_service._stream_credentials('2')[1], "ACC")
+
+
+if __name__ == "__main__":
+    unittest.main()
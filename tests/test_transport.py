@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+HTTP transport: settings read from the config, pooled keep-alive connections, retries limited to
+connection errors so that a request that may have reached IG is never sent twice, and the optional
+HTTP/2 client
+
+    python -m unittest tests.test_transport
+"""
+import socket
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from urllib3.exceptions import NewConnectionError, ReadTimeoutError
+
+from trading_ig import transport
+from trading_ig.Exceptions import IGException
+from trading_ig.SessionHandler import IGSessionHandler
+from trading_ig.transport import PooledHTTPAdapter, create_http_session, http_settings, http_timeout
+
+
+def config(**settings):
+    return types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                 rate_limit_enabled=False, token_refresh=False, **settings)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Counts requests, answering each after the server's delay"""
+
+    def _answer(self):
+        self.server.requests.append((self.command, self.path))
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.release.wait(self.server.delay)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPSettings(unittest.TestCase):
+
+    def test_defaults(self):
+        settings = http_settings(config())
+        self.assertEqual(settings, transport.HTTPSettings(
+            pool_connections=4, pool_maxsize=16, connect_timeout=5.0, read_timeout=30.0, max_retries=2,
+            keepalive=True, http2=False))
+        self.assertEqual(http_timeout(settings), (5.0, 30.0))
+
+    def test_from_config(self):
+        settings = http_settings(config(http_pool_connections="2", http_pool_maxsize="32", http_connect_timeout="1.5",
+                                        http_read_timeout=10, http_max_retries="0", http_keepalive="False",
+                                        http2="no"))
+        self.assertEqual(settings, transport.HTTPSettings(
+            pool_connections=2, pool_maxsize=32, connect_timeout=1.5, read_timeout=10.0, max_retries=0,
+            keepalive=False, http2=False))
+
+    def test_handler_timeout(self):
+        handler = IGSessionHandler("http://127.0.0.1", config(http_connect_timeout=2, http_read_timeout=7))
+        self.addCleanup(handler.close)
+        handler.session.request = mock.Mock()
+        handler._send("GET", "/accounts", headers={"VERSION": "1"})
+        self.assertEqual(handler.session.request.call_args[1]["timeout"], (2.0, 7.0))
+        self.assertIn("data", handler.session.request.call_args[1])
+
+
+class TestPooledSession(unittest.TestCase):
+
+    def session(self, **settings):
+        session = create_http_session(http_settings(config(**settings)))
+        self.addCleanup(session.close)
+        return session
+
+    def test_adapter(self):
+        session = self.session(http_pool_connections=3, http_pool_maxsize=24)
+        for url in ("https://api.ig.com/gateway/deal", "http://127.0.0.1"):
+            adapter = session.get_adapter(url)
+            self.assertIsInstance(adapter, PooledHTTPAdapter)
+            self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 24)
+            self.assertEqual(adapter.poolmanager.pools._maxsize, 3)
+        options = adapter.poolmanager.connection_pool_kw["socket_options"]
+        self.assertIn((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), options)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), options)
+
+    def test_without_keepalive(self):
+        options = self.session(http_keepalive=False).get_adapter("https://").poolmanager.connection_pool_kw[
+            "socket_options"]
+        self.assertEqual(options, [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)])
+
+    def test_retries_connection_errors_only(self):
+        retry = self.session(http_max_retries=3).get_adapter("https://").max_retries
+        self.assertEqual((retry.total, retry.connect, retry.read, retry.status, retry.other), (3, 3, False, 0, 0))
+        for method in ("GET", "POST", "DELETE"):
+            # nothing was sent, a connection error is retried whatever the method
+            connect_error = NewConnectionError(None, "refused")
+            self.assertEqual(retry.increment(method, "/", error=connect_error).connect, 2)
+            # a read timeout may come after IG acted on the request
+            with self.assertRaises(ReadTimeoutError):
+                retry.increment(method, "/", error=ReadTimeoutError(None, "/", "timed out"))
+
+    def test_connection_error_retried(self):
+        session = self.session(http_max_retries=2)
+        with mock.patch("urllib3.util.connection.create_connection",
+                        side_effect=ConnectionRefusedError("refused")) as create_connection, \
+                mock.patch("urllib3.util.retry.Retry.sleep"):
+            for method in ("GET", "POST"):
+                create_connection.reset_mock()
+                with self.assertRaises(requests.ConnectionError):
+                    session.request(method, "http://127.0.0.1:9/positions/otc", data="{}", timeout=(1, 1))
+                self.assertEqual(create_connection.call_count, 3, method)
+
+
+class TestReadTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        self.server.requests = []
+        self.server.delay = 5
+        self.server.release = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.release.set)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def test_not_retried(self):
+        session = create_http_session(http_settings(config(http_max_retries=3)))
+        self.addCleanup(session.close)
+        for method in ("POST", "GET"):
+            self.server.requests = []
+            with self.assertRaises(requests.ReadTimeout):
+                session.request(method, self.url + "/positions/otc", data="{}", timeout=(1, 0.2))
+            self.assertEqual(self.server.requests, [(method, "/positions/otc")])
+
+    def test_answered(self):
+        self.server.delay = 0
+        session = create_http_session(http_settings(config()))
+        self.addCleanup(session.close)
+        self.assertEqual(session.post(self.url + "/session", data="{}", timeout=(1, 1)).content, b"{}")
+
+
+class TestHTTP2(unittest.TestCase):
+
+    def test_requires_httpx(self):
+        with mock.patch.object(transport, "httpx", None):
+            with self.assertRaisesRegex(IGException, "httpx"):
+                create_http_session(http_settings(config(http2=True)))
+
+    def test_httpx_client(self):
+        httpx = mock.Mock()
+        with mock.patch.object(transport, "httpx", httpx):
+            settings = http_settings(config(http2="True", http_pool_maxsize=8, http_max_retries=1,
+                                            http_connect_timeout=2, http_read_timeout=9))
+            client = create_http_session(settings)
+            timeout = http_timeout(settings)
+        self.assertIs(client, httpx.Client.return_value)
+        kwargs = httpx.HTTPTransport.call_args[1]
+        self.assertTrue(kwargs["http2"])
+        self.assertEqual(kwargs["retries"], 1)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), kwargs["socket_options"])
+        httpx.Limits.assert_called_once_with(max_connections=8, max_keepalive_connections=8)
+        httpx.Client.assert_called_once_with(transport=httpx.HTTPTransport.return_value,
+                                             timeout=httpx.Timeout.return_value)
+        httpx.Timeout.assert_called_with(9.0, connect=2.0)
+        self.assertIs(timeout, httpx.Timeout.return_value)
+
+    def test_handler_sends_content(self):
+        with mock.patch.object(transport, "httpx", mock.Mock()):
+            handler = IGSessionHandler("http://127.0.0.1", config(http2=True))
+        self.addCleanup(handler.close)
+        handler._send("POST", "/accounts", body="{}", headers={"VERSION": "1"})
+        self.assertEqual(handler.session.request.call_args[1]["content"], "{}")
+        self.assertNotIn("data", handler.session.request.call_args[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+JSON decoders: the fastest installed one by default, one picked by the 'json_decoder' setting, and
+errors for decoders that aren't installed or don't exist
+
+    python -m unittest tests.test_utils
+"""
+import json
+import types
+import unittest
+from unittest import mock
+
+from trading_ig.SessionHandler import IGSessionHandler
+from trading_ig.utils import JSON_DECODERS, get_json_decoder
+
+DOCUMENT = b'{"prices": [{"bid": 1.1, "ask": null}], "name": "EUR/USD \\u00e9"}'
+
+
+def orjson_loads(document):
+    return json.loads(document)
+
+
+def ujson_loads(document):
+    return json.loads(document)
+
+
+class TestJsonDecoder(unittest.TestCase):
+
+    def test_fastest_installed(self):
+        with mock.patch.dict(JSON_DECODERS, orjson=orjson_loads, ujson=ujson_loads):
+            self.assertIs(get_json_decoder(), orjson_loads)
+        with mock.patch.dict(JSON_DECODERS, orjson=None, ujson=ujson_loads):
+            self.assertIs(get_json_decoder(), ujson_loads)
+        with mock.patch.dict(JSON_DECODERS, orjson=None, ujson=None):
+            self.assertIs(get_json_decoder(), json.loads)
+
+    def test_by_name(self):
+        with mock.patch.dict(JSON_DECODERS, orjson=orjson_loads, ujson=ujson_loads):
+            self.assertIs(get_json_decoder("ujson"), ujson_loads)
+            self.assertIs(get_json_decoder("json"), json.loads)
+
+    def test_not_installed(self):
+        with mock.patch.dict(JSON_DECODERS, orjson=None):
+            with self.assertRaisesRegex(ValueError, "not installed"):
+                get_json_decoder("orjson")
+
+    def test_unknown(self):
+        with self.assertRaisesRegex(ValueError, "Unknown JSON decoder 'simplejson'"):
+            get_json_decoder("simplejson")
+
+    def test_installed_decoders_agree(self):
+        for name, loads in JSON_DECODERS.items():
+            if loads is not None:
+                self.assertEqual(loads(DOCUMENT), json.loads(DOCUMENT), name)
+                self.assertEqual(loads(DOCUMENT.decode()), json.loads(DOCUMENT), name)
+
+    def test_from_config(self):
+        def handler(**settings):
+            config = types.SimpleNamespace(api_key="key", username="user", password="secret", acc_number="ACC",
+                                           rate_limit_enabled=False, token_refresh=False, **settings)
+            handler = IGSessionHandler("http://127.0.0.1", config)
+            self.addCleanup(handler.close)
+            return handler
+
+        self.assertIs(handler(json_decoder="json").json_loads, json.loads)
+        self.assertIs(handler().json_loads, get_json_decoder())
+        with mock.patch.dict(JSON_DECODERS, ujson=None):
+            with self.assertRaises(ValueError):
+                handler(json_decoder="ujson")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,920 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+IG Markets REST API Library for Python - asyncio client
+https://labs.ig.com/rest-trading-api-reference
+
+Coroutine counterpart of IGService: every fetch / deal method has the same name, parameters and
+return value, but must be awaited. Many calls can be in flight at once from a single event loop.
+Requires the optional 'aiohttp' package.
+"""  # noqa
+import asyncio
+import functools
+import logging
+import time
+
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
+from trading_ig.utils import conv_datetime, conv_to_ms, conv_resol, get_config_value
+from trading_ig.Exceptions import IGException, NotFoundException
+from trading_ig.AsyncSessionHandler import AsyncIGSessionHandler
+from trading_ig.dealing import CONFIRM_TIMEOUT, BatchResult, batch_request, confirm_poll_delays
+from trading_ig.IGService import IGService
+from trading_ig.marketcache import MarketCache, epic_list, split_epics
+from trading_ig.marketsearch import MarketSearchIndex
+from trading_ig.pricestore import PriceBarStore
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncIGService:
+    D_BASE_URL = IGService.D_BASE_URL
+
+    def __init__(self, config, acc_type="demo"):
+        """Constructor, calls the method required to connect to
+        the API (accepts acc_type = LIVE or DEMO)"""
+
+        try:
+            self.BASE_URL = self.D_BASE_URL[acc_type.lower()]
+        except Exception:
+            raise IGException("Invalid account type '%s', please provide LIVE or DEMO" % acc_type)
+
+        self.crud_session = AsyncIGSessionHandler(self.BASE_URL, config)
+        # optional on-disk store of historical price bars, see trading_ig.pricestore
+        price_cache = get_config_value(config, 'price_cache', None)
+        self.price_cache = PriceBarStore(price_cache) if price_cache else None
+        # optional cache of market details, see trading_ig.marketcache
+        self.market_cache = MarketCache.from_config(config)
+        # optional local index answering search_markets, see IGService.build_search_index
+        self.search_index = None
+        # confirmations streamed from Lightstreamer, see IGStreamService.enable_deal_confirmations
+        self.deal_confirmations = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Closes the underlying HTTP session"""
+        await self.crud_session.close()
+
+    @staticmethod
+    async def _blocking(function, *args):
+        """Runs a blocking call, such as a SQLite query of the caches, in the default executor
+        rather than on the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+    async def _market_cache_call(self, function, *args):
+        """Calls the market cache, in the default executor when it is persisted in SQLite"""
+        if self.market_cache.path is None:
+            # in memory only, quicker than a trip through the executor
+            return function(*args)
+        return await self._blocking(function, *args)
+
+    # -------- PAGING -------- #
+
+    async def _fetch_all_pages(self, endpoint, params, version, key, max_workers=4, wait=0):
+        """
+        Fetches every page of a paginated v2/v3 result set and bundles the records into one object,
+        see IGService._fetch_all_pages. At most max_workers pages are in flight at the same time.
+        """
+        data = await self.crud_session.read(endpoint, dict(params, pageNumber=1), version)
+        total_pages = data["metadata"]["pageData"]["totalPages"]
+        semaphore = asyncio.Semaphore(1 if wait else max(1, max_workers))
+
+        async def fetch_page(page_number):
+            async with semaphore:
+                if wait:
+                    await asyncio.sleep(wait)
+                page = await self.crud_session.read(endpoint, dict(params, pageNumber=page_number), version)
+                return page[key]
+
+        pages = await asyncio.gather(*[fetch_page(n) for n in range(2, total_pages + 1)])
+        records = list(data[key])
+        for page_records in pages:
+            records.extend(page_records)
+        data[key] = records
+        return data
+
+    # -------- END -------- #
+
+    # -------- ACCOUNT ------- #
+
+    async def create_session(self, version):
+        return await self.crud_session.create_session(version=version)
+
+    async def warm_up(self, connections=1):
+        """Opens connections ahead of trading, see IGService.warm_up"""
+        await self.crud_session.warm_up(connections)
+
+    async def fetch_accounts(self):
+        """Returns a list of accounts belonging to the logged-in client"""
+        version = "1"
+        params = {}
+        endpoint = "/accounts"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_account_preferences(self):
+        """Gets the preferences for the logged in account"""
+        version = "1"
+        params = {}
+        endpoint = "/accounts/preferences"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def update_account_preferences(self, trailing_stops_enabled=False):
+        """Updates the account preferences. Currently only one value supported - trailing stops"""
+        version = "1"
+        params = {}
+        endpoint = "/accounts/preferences"
+        params['trailingStopsEnabled'] = 'true' if trailing_stops_enabled else 'false'
+        data = await self.crud_session.update(endpoint, params, version)
+        return data['status']
+
+    async def fetch_account_activity_by_period(self, milliseconds):
+        """Returns the account activity history for the last specified period"""
+        version = "1"
+        milliseconds = conv_to_ms(milliseconds)
+        params = {}
+        url_params = {"milliseconds": milliseconds}
+        endpoint = "/history/activity/{milliseconds}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_account_activity_by_date(self, from_date: datetime, to_date: datetime):
+        """Returns the account activity history for period between the specified dates"""
+        version = "1"
+        if from_date is None or to_date is None:
+            raise IGException("Both from_date and to_date must be specified")
+        if from_date > to_date:
+            raise IGException("from_date must be before to_date")
+
+        params = {}
+        url_params = {
+            "fromDate": from_date.strftime('%d-%m-%Y'),
+            "toDate": to_date.strftime('%d-%m-%Y')
+        }
+        endpoint = "/history/activity/{fromDate}/{toDate}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_account_activity_v2(
+            self,
+            from_date: datetime = None,
+            to_date: datetime = None,
+            max_span_seconds: int = None,
+            page_size: int = 20,
+            max_workers: int = 4):
+        """Returns the account activity history (v2), see IGService.fetch_account_activity_v2"""
+        version = "2"
+        params = {}
+        if from_date:
+            params["from"] = from_date.strftime('%Y-%m-%dT%H:%M:%S')
+        if to_date:
+            params["to"] = to_date.strftime('%Y-%m-%dT%H:%M:%S')
+        if max_span_seconds:
+            params["maxSpanSeconds"] = max_span_seconds
+        params["pageSize"] = page_size
+        endpoint = "/history/activity/"
+        return await self._fetch_all_pages(endpoint, params, version, "activities", max_workers=max_workers)
+
+    async def fetch_account_activity(
+            self,
+            from_date: datetime = None,
+            to_date: datetime = None,
+            detailed=False,
+            deal_id: str = None,
+            fiql_filter: str = None,
+            page_size: int = 50):
+        """Returns the account activity history (v3), see IGService.fetch_account_activity"""
+        version = "3"
+        params = {}
+        if from_date:
+            params["from"] = from_date.strftime('%Y-%m-%dT%H:%M:%S')
+        if to_date:
+            params["to"] = to_date.strftime('%Y-%m-%dT%H:%M:%S')
+        if detailed:
+            params["detailed"] = "true"
+        if deal_id:
+            params["dealId"] = deal_id
+        if fiql_filter:
+            params["filter"] = fiql_filter
+
+        params["pageSize"] = page_size
+        endpoint = "/history/activity/"
+        data = {}
+        activities = []
+        more_results = True
+
+        while more_results:
+            data = await self.crud_session.read(endpoint, params, version)
+            activities.extend(data["activities"])
+            paging = data["metadata"]["paging"]
+            if paging["next"] is None:
+                more_results = False
+            else:
+                parse_result = urlparse(paging["next"])
+                query = parse_qs(parse_result.query)
+                logging.debug(f"fetch_account_activity() next query: '{query}'")
+                if 'from' in query:
+                    params["from"] = query["from"][0]
+                else:
+                    del params["from"]
+                if 'to' in query:
+                    params["to"] = query["to"][0]
+                else:
+                    del params["to"]
+
+        data["activities"] = activities
+        return data
+
+    async def fetch_transaction_history_by_type_and_period(self, milliseconds, trans_type):
+        """Returns the transaction history for the specified transaction
+        type and period"""
+        version = "1"
+        milliseconds = conv_to_ms(milliseconds)
+        params = {}
+        url_params = {"milliseconds": milliseconds, "trans_type": trans_type}
+        endpoint = "/history/transactions/{trans_type}/{milliseconds}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_transaction_history(
+        self,
+        trans_type=None,
+        from_date=None,
+        to_date=None,
+        max_span_seconds=None,
+        page_size=None,
+        page_number=None
+    ):
+        """Returns the transaction history for the specified transaction
+        type and period"""
+        version = "2"
+        params = {}
+        if trans_type:
+            params["type"] = trans_type
+        if from_date:
+            if hasattr(from_date, "isoformat"):
+                from_date = from_date.isoformat()
+            params["from"] = from_date
+        if to_date:
+            if hasattr(to_date, "isoformat"):
+                to_date = to_date.isoformat()
+            params["to"] = to_date
+        if max_span_seconds:
+            params["maxSpanSeconds"] = max_span_seconds
+        if page_size:
+            params["pageSize"] = page_size
+        if page_number:
+            params["pageNumber"] = page_number
+
+        endpoint = "/history/transactions"
+
+        return await self.crud_session.read(endpoint, params, version)
+
+    # -------- END -------- #
+
+    # -------- DEALING -------- #
+
+    async def _poll_not_found(self, endpoint, version, timeout, what):
+        """Reads endpoint until it no longer reports 'not found', see IGService._poll_not_found"""
+        params = {}
+        delays = confirm_poll_delays(timeout)
+        while True:
+            try:
+                return await self.crud_session.read(endpoint, params, version)
+            except NotFoundException:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logger.info("%s not found, retrying in %.2f seconds." % (what, delay))
+                await asyncio.sleep(delay)
+
+    async def fetch_deal_by_deal_reference(self, deal_reference, timeout=CONFIRM_TIMEOUT):
+        """Returns a deal confirmation for the given deal reference"""
+        version = "1"
+        url_params = {"deal_reference": deal_reference}
+        endpoint = "/confirms/{deal_reference}".format(**url_params)
+        deadline = time.monotonic() + timeout
+        if self.deal_confirmations is not None and self.deal_confirmations.active:
+            confirmation = await self.deal_confirmations.wait_async(
+                deal_reference, min(self.deal_confirmations.timeout, timeout))
+            if confirmation is not None:
+                return confirmation
+            logger.info("No streamed confirmation for %s, polling." % deal_reference)
+        return await self._poll_not_found(
+            endpoint, version, max(0, deadline - time.monotonic()), "Deal reference %s" % deal_reference)
+
+    async def fetch_open_position_by_deal_id(self, deal_id, timeout=CONFIRM_TIMEOUT):
+        """Return the open position by deal id for the active account"""
+        version = "2"
+        url_params = {"deal_id": deal_id}
+        endpoint = "/positions/{deal_id}".format(**url_params)
+        return await self._poll_not_found(endpoint, version, timeout, "Deal id %s" % deal_id)
+
+    async def fetch_open_positions(self, version='2'):
+        """Returns all open positions for the active account. Supports both v1 and v2"""
+        params = {}
+        endpoint = "/positions"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def close_open_position(
+        self,
+        deal_id,
+        direction,
+        epic,
+        expiry,
+        level,
+        order_type,
+        quote_id,
+        size
+    ):
+        """Closes one or more OTC positions"""
+        version = "1"
+        params = {
+            "dealId": deal_id,
+            "direction": direction,
+            "epic": epic,
+            "expiry": expiry,
+            "level": level,
+            "orderType": order_type,
+            "quoteId": quote_id,
+            "size": size,
+        }
+        endpoint = "/positions/otc"
+        data = await self.crud_session.delete(endpoint, params, version)
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def create_open_position(
+        self,
+        currency_code,
+        direction,
+        epic,
+        expiry,
+        force_open,
+        guaranteed_stop,
+        level,
+        limit_distance,
+        limit_level,
+        order_type,
+        quote_id,
+        size,
+        stop_distance,
+        stop_level,
+        trailing_stop,
+        trailing_stop_increment
+    ):
+        """Creates an OTC position"""
+        version = "2"
+        params = {
+            "currencyCode": currency_code,
+            "direction": direction,
+            "epic": epic,
+            "expiry": expiry,
+            "forceOpen": force_open,
+            "guaranteedStop": guaranteed_stop,
+            "level": level,
+            "limitDistance": limit_distance,
+            "limitLevel": limit_level,
+            "orderType": order_type,
+            "quoteId": quote_id,
+            "size": size,
+            "stopDistance": stop_distance,
+            "stopLevel": stop_level,
+            "trailingStop": trailing_stop,
+            "trailingStopIncrement": trailing_stop_increment,
+        }
+
+        endpoint = "/positions/otc"
+
+        data = await self.crud_session.create(endpoint, params, version)
+
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def create_open_position_from_template(self, template, **fields):
+        """Creates an OTC position from an order template, see IGService.create_open_position_from_template"""
+        version = "2"
+        endpoint = "/positions/otc"
+        data = await self.crud_session.create(endpoint, template.render(**fields), version)
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def _submit_order(self, order):
+        """Sends a BatchOrder and returns its deal reference"""
+        method, endpoint, version, params = batch_request(order)
+        if method == "DELETE":
+            data = await self.crud_session.delete(endpoint, params, version)
+        else:
+            data = await self.crud_session.create(endpoint, params, version)
+        return data["dealReference"]
+
+    async def execute_orders(self, orders, max_workers=8, confirm=True):
+        """
+        Deals a batch of orders concurrently, see IGService.execute_orders. At most max_workers
+        requests are in flight at the same time
+        :rtype: list of trading_ig.dealing.BatchResult
+        """
+        orders = list(orders)
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        references = await asyncio.gather(
+            *[limited(self._submit_order(order)) for order in orders], return_exceptions=True)
+        # a cancelled request gives a CancelledError, which isn't an Exception
+        errors = [reference if isinstance(reference, BaseException) else None for reference in references]
+        references = [None if error is not None else reference for reference, error in zip(references, errors)]
+
+        confirmations = [None] * len(orders)
+        if confirm:
+            pending = [index for index, reference in enumerate(references) if reference is not None]
+            results = await asyncio.gather(
+                *[limited(self.fetch_deal_by_deal_reference(references[index])) for index in pending],
+                return_exceptions=True)
+            for index, result in zip(pending, results):
+                if isinstance(result, BaseException):
+                    errors[index] = result
+                else:
+                    confirmations[index] = result
+
+        failed = sum(error is not None for error in errors)
+        if failed:
+            logger.warning(f"{failed} of {len(orders)} orders failed")
+        return [BatchResult(*result) for result in zip(orders, references, confirmations, errors)]
+
+    async def update_open_position(
+            self,
+            limit_level,
+            stop_level,
+            deal_id,
+            guaranteed_stop=False,
+            trailing_stop=False,
+            trailing_stop_distance=None,
+            trailing_stop_increment=None,
+            version='2'):
+        """Updates an OTC position"""
+        params = {}
+        if limit_level is not None:
+            params["limitLevel"] = limit_level
+        if stop_level is not None:
+            params["stopLevel"] = stop_level
+        if guaranteed_stop:
+            params["guaranteedStop"] = 'true'
+        if trailing_stop:
+            params["trailingStop"] = 'true'
+        if trailing_stop_distance is not None:
+            params["trailingStopDistance"] = trailing_stop_distance
+        if trailing_stop_increment is not None:
+            params["trailingStopIncrement"] = trailing_stop_increment
+
+        url_params = {"deal_id": deal_id}
+        endpoint = "/positions/otc/{deal_id}".format(**url_params)
+        data = await self.crud_session.update(endpoint, params, version)
+
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def fetch_working_orders(self, version='2'):
+        """Returns all open working orders for the active account"""
+        params = {}
+        endpoint = "/workingorders"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def create_working_order(
+        self,
+        currency_code,
+        direction,
+        epic,
+        expiry,
+        guaranteed_stop,
+        level,
+        size,
+        time_in_force,
+        order_type,
+        limit_distance=None,
+        limit_level=None,
+        stop_distance=None,
+        stop_level=None,
+        good_till_date=None,
+        deal_reference=None,
+        force_open=False,
+    ):
+        """Creates an OTC working order"""
+        version = "2"
+        if good_till_date is not None and type(good_till_date) is not int:
+            good_till_date = conv_datetime(good_till_date, version)
+
+        params = {
+            "currencyCode": currency_code,
+            "direction": direction,
+            "epic": epic,
+            "expiry": expiry,
+            "guaranteedStop": guaranteed_stop,
+            "level": level,
+            "size": size,
+            "timeInForce": time_in_force,
+            "type": order_type,
+        }
+        if limit_distance:
+            params["limitDistance"] = limit_distance
+        if limit_level:
+            params["limitLevel"] = limit_level
+        if stop_distance:
+            params["stopDistance"] = stop_distance
+        if stop_level:
+            params["stopLevel"] = stop_level
+        if deal_reference:
+            params["dealReference"] = deal_reference
+        if force_open:
+            params["force_open"] = 'true'
+        if good_till_date:
+            params["goodTillDate"] = good_till_date
+
+        endpoint = "/workingorders/otc"
+
+        data = await self.crud_session.create(endpoint, params, version)
+
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def delete_working_order(self, deal_id):
+        """Deletes an OTC working order"""
+        version = "2"
+        params = {}
+        url_params = {"deal_id": deal_id}
+        endpoint = "/workingorders/otc/{deal_id}".format(**url_params)
+        data = await self.crud_session.delete(endpoint, params, version)
+
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    async def update_working_order(
+        self,
+        good_till_date,
+        level,
+        limit_distance,
+        limit_level,
+        stop_distance,
+        stop_level,
+        guaranteed_stop,
+        time_in_force,
+        order_type,
+        deal_id,
+    ):
+        """Updates an OTC working order"""
+        version = "2"
+        if good_till_date is not None and type(good_till_date) is not int:
+            good_till_date = conv_datetime(good_till_date, version)
+        params = {
+            "goodTillDate": good_till_date,
+            "limitDistance": limit_distance,
+            "level": level,
+            "limitLevel": limit_level,
+            "stopDistance": stop_distance,
+            "stopLevel": stop_level,
+            "guaranteedStop": guaranteed_stop,
+            "timeInForce": time_in_force,
+            "type": order_type,
+        }
+        url_params = {"deal_id": deal_id}
+        endpoint = "/workingorders/otc/{deal_id}".format(**url_params)
+        data = await self.crud_session.update(endpoint, params, version)
+
+        deal_reference = data["dealReference"]
+        return await self.fetch_deal_by_deal_reference(deal_reference)
+
+    # -------- END -------- #
+
+    # -------- MARKETS -------- #
+
+    async def fetch_client_sentiment_by_instrument(self, market_id):
+        """Returns the client sentiment for the given instrument's market"""
+        version = "1"
+        params = {}
+        if isinstance(market_id, (list,)):
+            market_ids = ",".join(market_id)
+            url_params = {"market_ids": market_ids}
+            endpoint = "/clientsentiment/?marketIds={market_ids}".format(**url_params)
+        else:
+            url_params = {"market_id": market_id}
+            endpoint = "/clientsentiment/{market_id}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_related_client_sentiment_by_instrument(self, market_id):
+        """Returns a list of related (also traded) client sentiment for
+        the given instrument's market"""
+        version = "1"
+        params = {}
+        url_params = {"market_id": market_id}
+        endpoint = "/clientsentiment/related/{market_id}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_top_level_navigation_nodes(self):
+        """Returns all top-level nodes (market categories) in the market
+        navigation hierarchy."""
+        version = "1"
+        params = {}
+        endpoint = "/marketnavigation"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_sub_nodes_by_node(self, node):
+        """Returns all sub-nodes of the given node in the market
+        navigation hierarchy"""
+        version = "1"
+        params = {}
+        url_params = {"node": node}
+        endpoint = "/marketnavigation/{node}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def fetch_market_by_epic(self, epic, use_cache=True):
+        """Returns the details of the given market, see IGService.fetch_market_by_epic"""
+        if use_cache and self.market_cache is not None:
+            details = await self._market_cache_call(self.market_cache.get, epic)
+            if details is not None:
+                return details
+        version = "3"
+        params = {}
+        url_params = {"epic": epic}
+        endpoint = "/markets/{epic}".format(**url_params)
+        details = await self.crud_session.read(endpoint, params, version)
+        if self.market_cache is not None:
+            await self._market_cache_call(self.market_cache.put, epic, details)
+        if self.search_index is not None:
+            self.search_index.add_market_details([details])
+        return details
+
+    async def fetch_markets_by_epics(self, epics, detailed=True, version='2', max_workers=4):
+        """Returns the details of the given markets, see IGService.fetch_markets_by_epics"""
+        endpoint = "/markets"
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def fetch_chunk(chunk):
+            params = {"epics": chunk}
+            if version == '2':
+                params["filter"] = 'ALL' if detailed else 'SNAPSHOT_ONLY'
+            async with semaphore:
+                data = await self.crud_session.read(endpoint, params, version)
+            return data['marketDetails']
+
+        chunks = await asyncio.gather(*[fetch_chunk(chunk) for chunk in split_epics(epics)])
+        markets = [market for chunk in chunks for market in chunk]
+        if version == '2' and detailed:
+            if self.market_cache is not None:
+                await self._market_cache_call(
+                    self.market_cache.put_many, {market["instrument"]["epic"]: market for market in markets})
+            if self.search_index is not None:
+                self.search_index.add_market_details(markets)
+        return markets
+
+    async def load_markets(self, epics, max_workers=4):
+        """Returns market details by epic, from the market cache where possible, see IGService.load_markets"""
+        epics = epic_list(epics)
+        if self.market_cache is None:
+            markets = await self.fetch_markets_by_epics(epics, max_workers=max_workers)
+            return {market["instrument"]["epic"]: market for market in markets}
+
+        def cached():
+            return {epic: self.market_cache.get(epic) for epic in epics}
+
+        markets = await self._market_cache_call(cached)
+        missing = [epic for epic, details in markets.items() if details is None]
+        if missing:
+            logger.info(f"Fetching details of {len(missing)} of {len(epics)} markets")
+            fetched = await self.fetch_markets_by_epics(missing, max_workers=max_workers)
+            markets.update((market["instrument"]["epic"], market) for market in fetched)
+        return markets
+
+    def build_search_index(self, crawler):
+        """
+        Builds the local market search index consulted by search_markets, see
+        IGService.build_search_index. The navigation tree is crawled with the blocking IGService,
+        pass its crawler here
+        :type crawler: trading_ig.navigation.MarketNavigationCrawler
+        :rtype: trading_ig.marketsearch.MarketSearchIndex
+        """
+        index = MarketSearchIndex.from_navigation(crawler)
+        if self.search_index is not None:
+            index.add_markets(self.search_index.markets.values())
+        self.search_index = index
+        logger.info(f"Market search index built with {len(index)} markets")
+        return index
+
+    async def search_markets(self, search_term, use_index=True):
+        """Returns all markets matching the search term, from the search index if it has any, see
+        IGService.search_markets"""
+        if use_index and self.search_index is not None:
+            markets = self.search_index.search(search_term)
+            if markets:
+                return {"markets": markets}
+        version = "1"
+        endpoint = "/markets"
+        params = {"searchTerm": search_term}
+        response = await self.crud_session.read(endpoint, params, version)
+        if self.search_index is not None:
+            self.search_index.add_markets(response.get("markets") or [])
+        return response
+
+    async def fetch_historical_prices_by_epic(
+        self,
+        epic,
+        start_date=None,
+        end_date=None,
+        numpoints=None,
+        pagesize=20,
+        format=None,
+        wait=1,
+        resolution=None,
+        max_workers=4
+    ):
+        """Fetches historical prices for the given epic, see IGService.fetch_historical_prices_by_epic"""
+        version = "3"
+        params = {}
+        if resolution:
+            params["resolution"] = conv_resol(resolution)
+        if start_date:
+            params["from"] = start_date
+        if end_date:
+            params["to"] = end_date
+        if numpoints:
+            params["max"] = numpoints
+        params["pageSize"] = pagesize
+        url_params = {"epic": epic}
+        endpoint = "/prices/{epic}".format(**url_params)
+        if self.price_cache is not None and resolution and start_date and end_date and not numpoints:
+            data = await self._fetch_cached_prices(
+                epic, params, endpoint, version, max_workers=max_workers, wait=wait)
+        else:
+            data = await self._fetch_all_pages(
+                endpoint, params, version, "prices", max_workers=max_workers, wait=wait)
+
+        if "allowance" in data["metadata"]:
+            IGService.log_allowance(data["metadata"])
+        if format is not None:
+            data["prices"] = format(data["prices"])
+        return data
+
+    async def _fetch_cached_prices(self, epic, params, endpoint, version, max_workers=4, wait=0):
+        """Serves a /prices request from the price cache, see IGService._fetch_cached_prices"""
+        resolution = params["resolution"]
+        missing = await self._blocking(self.price_cache.missing, epic, resolution, params["from"], params["to"])
+        for start, end in missing:
+            logger.debug(f"Price cache miss for {epic} {resolution}: {start} - {end}")
+            interval_params = dict(params, **{"from": start, "to": end})
+            data = await self._fetch_all_pages(
+                endpoint, interval_params, version, "prices", max_workers=max_workers, wait=wait)
+            await self._blocking(
+                self.price_cache.store, epic, resolution, start, end, data["prices"],
+                data.get("instrumentType"), data["metadata"].get("allowance"))
+        return await self._blocking(
+            self.price_cache.load_response, epic, resolution, params["from"], params["to"], params["pageSize"])
+
+    async def fetch_historical_prices_by_epic_and_num_points(self, epic, resolution, numpoints, format=None):
+        """Returns a list of historical prices for the given epic, resolution,
+        number of points"""
+        version = "2"
+        params = {}
+        url_params = {"epic": epic, "resolution": resolution, "numpoints": numpoints}
+        endpoint = "/prices/{epic}/{resolution}/{numpoints}".format(**url_params)
+        data = await self.crud_session.read(endpoint, params, version)
+        if format is not None:
+            data["prices"] = format(data["prices"])
+        return data
+
+    async def fetch_historical_prices_by_epic_and_date_range(
+            self, epic, resolution, start_date, end_date, format=None, version='2'):
+        """Returns a list of historical prices for the given epic, resolution, multiplier and date range,
+        see IGService.fetch_historical_prices_by_epic_and_date_range"""
+        params = {}
+        if version == '1':
+            start_date = conv_datetime(start_date, version)
+            end_date = conv_datetime(end_date, version)
+            params = {"startdate": start_date, "enddate": end_date}
+            url_params = {"epic": epic, "resolution": resolution}
+            endpoint = "/prices/{epic}/{resolution}".format(**url_params)
+        else:
+            url_params = {"epic": epic, "resolution": resolution, "startDate": start_date, "endDate": end_date}
+            endpoint = "/prices/{epic}/{resolution}/{startDate}/{endDate}".format(**url_params)
+        data = await self.crud_session.read(endpoint, params, version)
+        if format is not None:
+            data["prices"] = format(data["prices"])
+        return data
+
+    # -------- END -------- #
+
+    # -------- WATCHLISTS -------- #
+
+    async def fetch_all_watchlists(self):
+        """Returns all watchlists belonging to the active account"""
+        version = "1"
+        params = {}
+        endpoint = "/watchlists"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def create_watchlist(self, name, epics):
+        """Creates a watchlist"""
+        version = "1"
+        params = {"name": name, "epics": epics}
+        endpoint = "/watchlists"
+        return await self.crud_session.create(endpoint, params, version)
+
+    async def delete_watchlist(self, watchlist_id):
+        """Deletes a watchlist"""
+        version = "1"
+        params = {}
+        url_params = {"watchlist_id": watchlist_id}
+        endpoint = "/watchlists/{watchlist_id}".format(**url_params)
+        return await self.crud_session.delete(endpoint, params, version)
+
+    async def fetch_watchlist_markets(self, watchlist_id):
+        """Returns the given watchlist's markets"""
+        version = "1"
+        params = {}
+        url_params = {"watchlist_id": watchlist_id}
+        endpoint = "/watchlists/{watchlist_id}".format(**url_params)
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def add_market_to_watchlist(self, watchlist_id, epic):
+        """Adds a market to a watchlist"""
+        version = "1"
+        params = {"epic": epic}
+        url_params = {"watchlist_id": watchlist_id}
+        endpoint = "/watchlists/{watchlist_id}".format(**url_params)
+        return await self.crud_session.update(endpoint, params, version)
+
+    async def remove_market_from_watchlist(self, watchlist_id, epic):
+        """Remove a market from a watchlist"""
+        version = "1"
+        params = {}
+        url_params = {"watchlist_id": watchlist_id, "epic": epic}
+        endpoint = "/watchlists/{watchlist_id}/{epic}".format(**url_params)
+        return await self.crud_session.delete(endpoint, params, version)
+
+    # -------- END -------- #
+
+    # -------- LOGIN -------- #
+
+    async def logout(self):
+        """Log out of the current session"""
+        version = "1"
+        params = {}
+        endpoint = "/session"
+        await self.crud_session.delete(endpoint, params, version)
+        await self.crud_session.close()
+
+    async def switch_account(self, account_id, default_account):
+        """Switches active accounts, optionally setting the default account"""
+        version = "1"
+        params = {"accountId": account_id, "defaultAccount": default_account}
+        endpoint = "/session"
+        return await self.crud_session.update(endpoint, params, version)
+
+    async def read_session(self, fetch_session_tokens='false'):
+        """Retrieves current session details"""
+        version = "1"
+        params = {"fetchSessionTokens": fetch_session_tokens}
+        endpoint = "/session"
+        return await self.crud_session.read(endpoint, params, version)
+
+    # -------- END -------- #
+
+    # -------- GENERAL -------- #
+
+    async def get_client_apps(self):
+        """Returns a list of client-owned applications"""
+        version = "1"
+        params = {}
+        endpoint = "/operations/application"
+        return await self.crud_session.read(endpoint, params, version)
+
+    async def update_client_app(
+        self,
+        allowance_account_overall,
+        allowance_account_trading,
+        api_key,
+        status
+    ):
+        """Updates an application"""
+        version = "1"
+        params = {
+            "allowanceAccountOverall": allowance_account_overall,
+            "allowanceAccountTrading": allowance_account_trading,
+            "apiKey": api_key,
+            "status": status,
+        }
+        endpoint = "/operations/application"
+        return await self.crud_session.update(endpoint, params, version)
+
+    async def disable_client_app_key(self):
+        """
+        Disables the current application key from processing further requests.
+        Disabled keys may be re-enabled via the My Account section on
+        the IG Web Dealing Platform.
+        """
+        version = "1"
+        params = {}
+        endpoint = "/operations/application/disable"
+        return await self.crud_session.update(endpoint, params, version)
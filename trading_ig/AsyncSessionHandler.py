@@ -0,0 +1,353 @@
+import asyncio
+import json
+import datetime
+import logging
+import threading
+from trading_ig.Exceptions import IGException, ApiExceededException, IGExceptionSessionReset
+from trading_ig.SessionHandler import IGSessionHandler, TOKEN_REFRESH_ATTEMPTS, TOKEN_REFRESH_RETRY
+from trading_ig.ratelimiter import IGRateLimiter
+from trading_ig.transport import http_settings
+from trading_ig.utils import async_retry, get_config_value, get_json_decoder
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncIGSessionHandler(IGSessionHandler):
+    """
+    Asyncio twin of IGSessionHandler: session with CRUD operations as coroutines
+
+    Token handling (CST / X-SECURITY-TOKEN and v3 OAuth) and response checking are shared with the
+    blocking handler, only the transport differs. Requires the optional 'aiohttp' package.
+
+    The underlying aiohttp.ClientSession is created lazily on first use so that it is bound to the
+    running event loop. Call close() (or use the handler as an async context manager) when done.
+
+    v3 access tokens are renewed ahead of expiry by a background task on the same event loop rather
+    than a thread, see IGSessionHandler.
+    """
+
+    def __init__(self, base_url, config):
+        if aiohttp is None:
+            raise IGException("The asyncio client requires the 'aiohttp' package")
+        self.BASE_URL = base_url
+        self.API_KEY = config.api_key
+        self.IG_USERNAME = config.username
+        self.IG_PASSWORD = config.password
+        self.ACC_NUMBER = config.acc_number
+
+        self._refresh_token = None
+        self._valid_until = None
+
+        # guards authentication state shared with the inherited token handling
+        self._lock = threading.RLock()
+        # incremented every time a new session is created, see _reset_session
+        self._generation = 0
+        # only one coroutine at a time may refresh or reset the session
+        self._auth_lock = asyncio.Lock()
+
+        self.rate_limiter = IGRateLimiter.from_config(config)
+        self.json_loads = get_json_decoder(get_config_value(config, 'json_decoder'))
+        self._init_token_refresh(config)
+        self.http_settings = http_settings(config)
+        if self.http_settings.http2:
+            logger.warning("HTTP/2 is not supported by aiohttp, using HTTP/1.1")
+
+        self.session = None
+        self.headers = {
+            "X-IG-API-KEY": self.API_KEY,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json; charset=UTF-8'
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            # pooled keep-alive connections and timeouts, see trading_ig.transport
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.http_settings.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.http_settings.connect_timeout,
+                    sock_read=self.http_settings.read_timeout))
+        return self.session
+
+    async def close(self):
+        """Stops the token refresher and closes the underlying HTTP session"""
+        self.stop_token_refresh()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def warm_up(self, connections=1):
+        """
+        Opens connections to IG ahead of time, see IGSessionHandler.warm_up
+        :param connections: number of connections to open
+        :type connections: int
+        """
+        async def head():
+            async with self._get_session().head(self.BASE_URL) as response:
+                return response.status
+
+        statuses = await asyncio.gather(*[head() for _ in range(connections)])
+        logger.info(f"Warmed up {connections} connection(s) to '{self.BASE_URL}', responses {statuses}")
+
+    def _update_headers(self, headers):
+        """
+        Replaces the default headers with an updated copy, see IGSessionHandler._update_headers
+        :param headers: headers to add or overwrite
+        :type headers: dict
+        """
+        new_headers = dict(self.headers)
+        new_headers.update(headers)
+        self.headers = new_headers
+
+    def _remove_header(self, name):
+        """
+        Removes a header from the default headers, copy-on-write
+        :param name: header name
+        :type name: str
+        """
+        new_headers = dict(self.headers)
+        new_headers.pop(name, None)
+        self.headers = new_headers
+
+    def _headers(self, version, **extra):
+        """Default headers merged with the per-request ones"""
+        headers = dict(self.headers)
+        headers.update(self._request_headers(version, **extra))
+        return headers
+
+    async def refresh_session(self, version='1'):
+        """
+        Refreshes a v3 session. Tokens only last for 60 seconds, so need to be renewed regularly
+        :param version: API method version
+        :type version: str
+        :return: the new OAuth token details
+        :rtype: dict
+        """
+        logger.info(f"Refreshing session '{self.IG_USERNAME}'")
+        params = {"refresh_token": self._refresh_token}
+        endpoint = "/session/refresh-token"
+        data = await self.create(endpoint, params, version, check_session=False)
+        self._handle_oauth(data)
+        return data
+
+    async def _handle_response(self, response, generation=None, method=None, endpoint=None, reset=True):
+        """
+        Checks a CRUD response and returns its parsed body
+        :param response: HTTP response
+        :type response: aiohttp.ClientResponse
+        :param generation: session generation the request was sent with, see _reset_session
+        :type generation: int
+        :param method: HTTP method of the request, used for rate limiting
+        :type method: str
+        :param endpoint: API endpoint of the request, used for rate limiting
+        :type endpoint: str
+        :param reset: whether to log in again when IG has dropped the session. False for requests
+            sent while holding the authentication lock (the token refresh), whose caller resets
+        :type reset: bool
+        """
+        body = await response.read()
+        try:
+            return self._parse_response(response.status, response.reason, body)
+        except ApiExceededException:
+            self._allowance_exceeded(method, endpoint)
+            raise
+        except IGExceptionSessionReset:
+            if reset:
+                await self._reset_session(generation)
+            raise
+
+    async def _throttle(self, method, endpoint, params=None):
+        """Waits until the request can be sent without exceeding an IG allowance"""
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(method, endpoint, params)
+
+    # -------- TOKEN REFRESH -------- #
+
+    def _start_token_refresh(self):
+        """Starts the background refresher task on the running event loop, unless it is already running"""
+        if self._refresher is not None and not self._refresher.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning("No running event loop, tokens will be refreshed on demand")
+            return
+        self._refresher = loop.create_task(self._refresh_loop())
+
+    def stop_token_refresh(self):
+        """Cancels the background refresher task"""
+        if self._refresher is not None:
+            if self._refresher is not asyncio.current_task():
+                self._refresher.cancel()
+            self._refresher = None
+
+    async def _refresh_loop(self):
+        """Renews the access token shortly before it expires, until cancelled or the v3 session is gone"""
+        logger.debug("Token refresher started")
+        while True:
+            delay = self._refresh_delay()
+            if delay is None:
+                break
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await self._renew_session(self._valid_until)
+            except Exception as e:
+                logger.warning(f"Background session refresh failed ({e}), retrying in {TOKEN_REFRESH_RETRY} seconds")
+                await asyncio.sleep(TOKEN_REFRESH_RETRY)
+        if self._refresher is asyncio.current_task():
+            self._refresher = None
+        logger.debug("Token refresher stopped")
+
+    async def _renew_session(self, valid_until):
+        """
+        Refreshes the access token, or logs in again if IG rejects the refresh token, see
+        IGSessionHandler._renew_session
+        :param valid_until: expiry of the token to renew
+        :type valid_until: datetime.datetime
+        """
+        async with self._auth_lock:
+            # another coroutine may have renewed it while we were waiting for the lock
+            if self._valid_until != valid_until or self._refresh_token is None:
+                return
+            generation = self._generation
+            for attempt in range(TOKEN_REFRESH_ATTEMPTS):
+                try:
+                    await self.refresh_session()
+                    return
+                except ApiExceededException:
+                    # the session is still valid, the drained rate limiter holds the next attempt back
+                    if attempt == TOKEN_REFRESH_ATTEMPTS - 1:
+                        raise
+                    logger.info("Refresh rejected for exceeding an allowance, retrying")
+                    if self.rate_limiter is None:
+                        await asyncio.sleep(TOKEN_REFRESH_RETRY)
+                except Exception as e:
+                    if not self._auth_failed(e):
+                        raise
+                    logger.info(f"Refresh failed ({e}), resetting session")
+                    await self._reset_session(generation, locked=True)
+                    return
+
+    # -------- END -------- #
+
+    async def _check_session(self):
+        """
+        Check the v3 session status before making an API request, refreshing it if the access token
+        has expired. See IGSessionHandler._check_session
+        """
+        valid_until = self._valid_until
+        if valid_until is None or datetime.datetime.now() < valid_until:
+            return
+
+        # the background refresher is off, or fell behind
+        logger.info("Current session has expired, refreshing...")
+        await self._renew_session(valid_until)
+
+    async def _reset_session(self, generation=None, locked=False):
+        """
+        Throws the current session away and logs in again
+        :param generation: session generation seen by the failing request. If another coroutine
+            has already reset the session since then, there is nothing left to do
+        :type generation: int
+        :param locked: whether the caller already holds the authentication lock
+        :type locked: bool
+        """
+        if not locked:
+            async with self._auth_lock:
+                return await self._reset_session(generation, locked=True)
+
+        if generation is not None and generation != self._generation:
+            logger.debug("Session already reset by another request")
+            return
+        logger.info("Nuking session, full reset.")
+        self._refresh_token = None
+        self._valid_until = None
+        self._remove_header('Authorization')
+        await self.create_session(version='3')
+
+    async def create_session(self, version='2'):
+        """
+        Creates a session, obtaining tokens for subsequent API access
+        :param version: API method version
+        :type version: str
+        :return: JSON response body, parsed into dict
+        :rtype: dict
+        """
+        if version == '3' and self.ACC_NUMBER is None:
+            raise IGException('Account number must be set for v3 sessions')
+
+        logger.info(f"Creating new v{version} session for user '{self.IG_USERNAME}' at '{self.BASE_URL}'")
+        params = {"identifier": self.IG_USERNAME, "password": self.IG_PASSWORD}
+        url = self._url("/session")
+        async with self._get_session().post(url, data=json.dumps(params), headers=self._headers(version)) as response:
+            body = await response.read()
+            self.handle_session_tokens(response)
+        payload = self._manage_login_payload(body)
+        self._generation += 1
+        return payload
+
+    async def create(self, endpoint, params, version, check_session=True):
+        """Create = POST"""
+        if check_session:
+            await self._check_session()
+        url = self._url(endpoint)
+        generation = self._generation
+        await self._throttle('POST', endpoint)
+
+        async with self._get_session().post(url, data=self._encode(params), headers=self._headers(version)) as response:
+            logger.info(f"POST '{endpoint}', resp {response.status}")
+            # without the session check, this is the token refresh, run under the authentication
+            # lock: _renew_session resets the session itself if it fails
+            return await self._handle_response(response, generation, 'POST', endpoint, reset=check_session)
+
+    @async_retry((ApiExceededException, IGExceptionSessionReset), delay=2, tries=5, backoff=2, logger=logger)
+    async def read(self, endpoint, params, version):
+        """Read = GET"""
+        await self._check_session()
+        url = self._url(endpoint)
+        generation = self._generation
+        await self._throttle('GET', endpoint, params)
+
+        async with self._get_session().get(url, params=params, headers=self._headers(version)) as response:
+            # handle 'read_session' with 'fetchSessionTokens=true'
+            self.handle_session_tokens(response)
+            logger.info(f"GET '{endpoint}', resp {response.status}")
+            data = await self._handle_response(response, generation, 'GET', endpoint)
+        self._record_allowance(endpoint, data)
+        return data
+
+    async def update(self, endpoint, params, version):
+        """Update = PUT"""
+        await self._check_session()
+        url = self._url(endpoint)
+        generation = self._generation
+        await self._throttle('PUT', endpoint)
+
+        async with self._get_session().put(url, data=self._encode(params), headers=self._headers(version)) as response:
+            logger.info(f"PUT '{endpoint}', resp {response.status}")
+            return await self._handle_response(response, generation, 'PUT', endpoint)
+
+    async def delete(self, endpoint, params, version):
+        """Delete = POST"""
+        await self._check_session()
+        url = self._url(endpoint)
+        generation = self._generation
+        await self._throttle('DELETE', endpoint)
+
+        headers = self._headers(version, _method='DELETE')
+        async with self._get_session().post(url, data=self._encode(params), headers=headers) as response:
+            logger.info(f"DELETE (POST) '{endpoint}', resp {response.status}")
+            return await self._handle_response(response, generation, 'DELETE', endpoint)
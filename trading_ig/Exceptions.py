@@ -7,4 +7,13 @@ class IGException(Exception):
     pass
 
 class IGExceptionSessionReset(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class AllowanceExhaustedException(IGException):
+    """Raised when an API allowance won't be available again within the configured wait"""
+    pass
+
+class NotFoundException(IGException):
+    """Raised when IG reports that the confirmation of a deal doesn't exist (yet), while the deal is
+    still being processed"""
+    pass
@@ -8,17 +8,27 @@ Original version by Lewis Barber - 2014 - https://uk.linkedin.com/in/lewisbarber
 Modified by Femto Trader - 2014-2015 - https://github.com/femtotrader/
 """  # noqa
 import logging
+import operator
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from trading_ig.utils import create_logger
 
 from urllib.parse import urlparse, parse_qs
 from datetime import timedelta, datetime
-from trading_ig.utils import conv_datetime, conv_to_ms
-from trading_ig.Exceptions import IGException
+from trading_ig.utils import conv_datetime, conv_to_ms, conv_resol, get_config_value
+from trading_ig.Exceptions import IGException, NotFoundException
 from trading_ig.SessionHandler import IGSessionHandler
+from trading_ig.backfill import HistoricalBackfill
+from trading_ig.dealing import CONFIRM_TIMEOUT, BatchResult, batch_request, confirm_poll_delays
+from trading_ig.marketcache import MarketCache, epic_list, split_epics
+from trading_ig.marketsearch import MarketSearchIndex
+from trading_ig.navigation import MarketNavigationCrawler
+from trading_ig.pricestore import PriceBarStore
 
 logger = create_logger("rest", "log_rest.log")
 
+NAN = float("nan")
+
 class IGService:
     D_BASE_URL = {
         "live": "https://api.ig.com/gateway/deal",
@@ -40,6 +50,19 @@ class IGService:
 
         self.crud_session = IGSessionHandler(self.BASE_URL, config)
 
+        # optional on-disk store of historical price bars, see trading_ig.pricestore
+        price_cache = get_config_value(config, 'price_cache', None)
+        self.price_cache = PriceBarStore(price_cache) if price_cache else None
+
+        # optional cache of market details, see trading_ig.marketcache
+        self.market_cache = MarketCache.from_config(config)
+
+        # optional local index answering search_markets, see build_search_index
+        self.search_index = None
+
+        # confirmations streamed from Lightstreamer, see IGStreamService.enable_deal_confirmations
+        self.deal_confirmations = None
+
     # --------- END -------- #
 
     # ------ DATAFRAME TOOLS -------- #
@@ -47,38 +70,109 @@ class IGService:
     @staticmethod
     def colname_unique(d_cols):
         """Returns a set of column names (unique)"""
-        s = set()
-        for _, lst in d_cols.items():
-            for colname in lst:
-                s.add(colname)
-        return s
+        return set().union(*d_cols.values())
 
     @staticmethod
     def expand_columns(data, d_cols, flag_col_prefix=False, col_overlap_allowed=None):
-        """Expand columns"""
+        """
+        Expand columns
+
+        The nested records of each column are read in a single pass, and all of their
+        sub-columns are built as one frame, rather than mapping a lambda over the column once per
+        sub-column. Missing (NaN) entries give NaN values in every expanded column
+        """
         if col_overlap_allowed is None:
             col_overlap_allowed = []
         for (col_lev1, lst_col) in d_cols.items():
             ser = data[col_lev1]
             del data[col_lev1]
+            colnames = []
             for col in lst_col:
                 if col not in data.columns or col in col_overlap_allowed:
                     if flag_col_prefix:
-                        colname = col_lev1 + "_" + col
+                        colnames.append(col_lev1 + "_" + col)
                     else:
-                        colname = col
-                    data[colname] = ser.map(lambda x: x[col], na_action='ignore')
+                        colnames.append(col)
                 else:
                     raise (NotImplementedError("col overlap: %r" % col))
+            if not lst_col:
+                continue
+            if len(lst_col) == 1:
+                # itemgetter returns a bare value rather than a tuple for a single key
+                getter = lambda x, key=lst_col[0]: (x[key],)  # noqa: E731
+            else:
+                getter = operator.itemgetter(*lst_col)
+            missing = (NAN,) * len(lst_col)
+            records = ser.tolist()
+            try:
+                rows = [getter(x) if isinstance(x, dict) else missing for x in records]
+            except KeyError:
+                # some records lack a sub-column
+                rows = [tuple(x.get(col, NAN) for col in lst_col) if isinstance(x, dict) else missing
+                        for x in records]
+            expanded = type(data)(rows, columns=colnames, index=ser.index)
+            for colname in colnames:
+                data[colname] = expanded[colname]
         return data
 
     # -------- END ------- #
 
+    # -------- PAGING -------- #
+
+    def _fetch_all_pages(self, endpoint, params, version, key, max_workers=4, wait=0):
+        """
+        Fetches every page of a paginated v2/v3 result set and bundles the records into one object.
+
+        The first page is fetched on its own to learn 'metadata.pageData.totalPages', the remaining
+        pages are then fetched concurrently through a bounded worker pool (requests are still paced
+        by the session's rate limiter) and reassembled in page order.
+
+        :param endpoint: API endpoint
+        :type endpoint: str
+        :param params: query parameters, without 'pageNumber'
+        :type params: dict
+        :param version: API method version
+        :type version: str
+        :param key: name of the list of records in each page, e.g. 'prices'
+        :type key: str
+        :param max_workers: maximum number of pages fetched at the same time
+        :type max_workers: int
+        :param wait: seconds to wait between pages. Fetches pages one at a time if set
+        :type wait: int
+        :return: first page, with the records of all pages under key
+        :rtype: dict
+        """
+        data = self.crud_session.read(endpoint, dict(params, pageNumber=1), version)
+        records = list(data[key])
+        total_pages = data["metadata"]["pageData"]["totalPages"]
+
+        def fetch_page(page_number):
+            if wait:
+                time.sleep(wait)
+            page = self.crud_session.read(endpoint, dict(params, pageNumber=page_number), version)
+            return page[key]
+
+        if total_pages > 1:
+            workers = 1 if wait else max(1, min(max_workers, total_pages - 1))
+            logger.debug(f"Fetching {total_pages - 1} more pages of '{endpoint}' with {workers} workers")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for page_records in executor.map(fetch_page, range(2, total_pages + 1)):
+                    records.extend(page_records)
+
+        data[key] = records
+        return data
+
+    # -------- END -------- #
+
     # -------- ACCOUNT ------- #
 
     def create_session(self, version):
         return self.crud_session.create_session(version=version)
 
+    def warm_up(self, connections=1):
+        """Opens dealing connections ahead of trading, see IGSessionHandler.warm_up"""
+        self.crud_session.warm_up(connections)
+
     def fetch_accounts(self):
         """Returns a list of accounts belonging to the logged-in client"""
         version = "1"
@@ -150,13 +244,14 @@ class IGService:
             from_date: datetime = None,
             to_date: datetime = None,
             max_span_seconds: int = None,
-            page_size: int = 20):
+            page_size: int = 20,
+            max_workers: int = 4):
 
         """
         Returns the account activity history (v2)
 
         If the result set spans multiple 'pages', this method will automatically get all the results and
-        bundle them into one object.
+        bundle them into one object. Pages after the first are fetched concurrently.
 
         :param from_date: start date and time. Optional
         :type from_date: datetime
@@ -168,8 +263,8 @@ class IGService:
         :type max_span_seconds: int
         :param page_size: number of records per page. Default 20. Optional. Use 0 to turn off paging
         :type page_size: int
-        :param session: session object. Optional
-        :type session: Session
+        :param max_workers: maximum number of pages fetched at the same time. Default 4. Optional
+        :type max_workers: int
         :return: results set
         :rtype: Pandas DataFrame if configured, otherwise a dict
         """
@@ -184,25 +279,7 @@ class IGService:
             params["maxSpanSeconds"] = max_span_seconds
         params["pageSize"] = page_size
         endpoint = "/history/activity/"
-        data = {}
-        activities = []
-        pagenumber = 1
-        more_results = True
-
-        while more_results:
-            params["pageNumber"] = pagenumber
-            data = self.crud_session.read(endpoint, params,version)
-            data = self.parse_response(response.text)
-            activities.extend(data["activities"])
-            page_data = data["metadata"]["pageData"]
-            if page_data["totalPages"] == 0 or \
-                    (page_data["pageNumber"] == page_data["totalPages"]):
-                more_results = False
-            else:
-                pagenumber += 1
-
-        data["activities"] = activities
-        return data
+        return self._fetch_all_pages(endpoint, params, version, "activities", max_workers=max_workers)
 
     def fetch_account_activity(
             self,
@@ -352,38 +429,51 @@ class IGService:
 
     # -------- DEALING -------- #
 
-    def fetch_deal_by_deal_reference(self, deal_reference):
-        """Returns a deal confirmation for the given deal reference"""
-        version = "1"
+    def _poll_not_found(self, endpoint, version, timeout, what):
+        """
+        Reads endpoint until it no longer reports 'not found'. Polls are close together at first and
+        back off up to half a second, see dealing.confirm_poll_delays
+        """
         params = {}
+        delays = confirm_poll_delays(timeout)
+        while True:
+            try:
+                return self.crud_session.read(endpoint, params, version)
+            except NotFoundException:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logger.info("%s not found, retrying in %.2f seconds." % (what, delay))
+                time.sleep(delay)
+
+    def fetch_deal_by_deal_reference(self, deal_reference, timeout=CONFIRM_TIMEOUT):
+        """
+        Returns a deal confirmation for the given deal reference
+        :param deal_reference: deal reference
+        :type deal_reference: str
+        :param timeout: how long to wait for the confirmation to be available, in seconds, on the
+            stream and then polling altogether
+        :type timeout: float
+        """
+        version = "1"
         url_params = {"deal_reference": deal_reference}
         endpoint = "/confirms/{deal_reference}".format(**url_params)
-
-        for i in range(5):
-            data = self.crud_session.read(endpoint, params,version)
-            if response.status_code == 404 or response.status_code == 405:
-                logger.info("Deal reference %s not found, retrying." % deal_reference)
-                time.sleep(1)
-            else:
-                break
-        data = self.parse_response(response.text)
-        return data
-
-    def fetch_open_position_by_deal_id(self, deal_id):
+        deadline = time.monotonic() + timeout
+        if self.deal_confirmations is not None and self.deal_confirmations.active:
+            confirmation = self.deal_confirmations.wait(
+                deal_reference, min(self.deal_confirmations.timeout, timeout))
+            if confirmation is not None:
+                return confirmation
+            logger.info("No streamed confirmation for %s, polling." % deal_reference)
+        return self._poll_not_found(
+            endpoint, version, max(0, deadline - time.monotonic()), "Deal reference %s" % deal_reference)
+
+    def fetch_open_position_by_deal_id(self, deal_id, timeout=CONFIRM_TIMEOUT):
         """Return the open position by deal id for the active account"""
         version = "2"
-        params = {}
         url_params = {"deal_id": deal_id}
         endpoint = "/positions/{deal_id}".format(**url_params)
-        for i in range(5):
-            data = self.crud_session.read(endpoint, params,version)
-            if response.status_code == 404:
-                logger.info("Deal id %s not found, retrying." % deal_id)
-                time.sleep(1)
-            else:
-                break
-        data = self.parse_response(response.text)
-        return data
+        return self._poll_not_found(endpoint, version, timeout, "Deal id %s" % deal_id)
 
     def fetch_open_positions(self, version='2'):
         """
@@ -474,6 +564,78 @@ class IGService:
         deal_reference = data["dealReference"]
         return self.fetch_deal_by_deal_reference(deal_reference)
 
+    def create_open_position_from_template(self, template, **fields):
+        """
+        Creates an OTC position from an order template, encoding only the fields that vary between
+        orders. Use warm_up() beforehand so the order goes over an open connection
+        :param template: order with its static fields pre-serialised
+        :type template: trading_ig.dealing.OrderTemplate
+        :param fields: the other create_open_position arguments, e.g. direction and size
+        :return: deal confirmation
+        :rtype: dict
+        """
+        version = "2"
+        endpoint = "/positions/otc"
+        data = self.crud_session.create(endpoint, template.render(**fields), version)
+        deal_reference = data["dealReference"]
+        return self.fetch_deal_by_deal_reference(deal_reference)
+
+    def _submit_order(self, order):
+        """Sends a BatchOrder and returns its deal reference"""
+        method, endpoint, version, params = batch_request(order)
+        if method == "DELETE":
+            data = self.crud_session.delete(endpoint, params, version)
+        else:
+            data = self.crud_session.create(endpoint, params, version)
+        return data["dealReference"]
+
+    def execute_orders(self, orders, max_workers=8, confirm=True):
+        """
+        Deals a batch of orders concurrently. Every order is submitted before any confirmation is
+        fetched, and requests are paced by the trading rate limit. Confirmations are fetched in
+        parallel, from the stream if deal confirmations are enabled (see
+        IGStreamService.enable_deal_confirmations), otherwise by polling '/confirms', which counts
+        against the non-trading allowance.
+        :param orders: orders to deal, see trading_ig.dealing.open_order and close_order
+        :type orders: list of trading_ig.dealing.BatchOrder
+        :param max_workers: maximum number of requests in flight at the same time
+        :type max_workers: int
+        :param confirm: whether to fetch deal confirmations
+        :type confirm: bool
+        :return: one result per order, in the order of orders. A failed order doesn't stop the
+            others: its result has the exception as 'error'
+        :rtype: list of trading_ig.dealing.BatchResult
+        """
+        orders = list(orders)
+        references = [None] * len(orders)
+        confirmations = [None] * len(orders)
+        errors = [None] * len(orders)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            submitted = {executor.submit(self._submit_order, order): index for index, order in enumerate(orders)}
+            confirming = {}
+            # confirmations are queued behind the submissions still waiting for a worker
+            for future in as_completed(submitted):
+                index = submitted[future]
+                try:
+                    references[index] = future.result()
+                except Exception as e:
+                    errors[index] = e
+                    continue
+                if confirm:
+                    confirming[executor.submit(self.fetch_deal_by_deal_reference, references[index])] = index
+            for future in as_completed(confirming):
+                index = confirming[future]
+                try:
+                    confirmations[index] = future.result()
+                except Exception as e:
+                    errors[index] = e
+
+        failed = sum(error is not None for error in errors)
+        if failed:
+            logger.warning(f"{failed} of {len(orders)} orders failed")
+        return [BatchResult(*result) for result in zip(orders, references, confirmations, errors)]
+
     def update_open_position(
             self,
             limit_level,
@@ -658,19 +820,74 @@ class IGService:
         endpoint = "/marketnavigation/{node}".format(**url_params)
         return self.crud_session.read(endpoint, params,version)
 
-    def fetch_market_by_epic(self, epic):
-        """Returns the details of the given market"""
+    def crawl_market_navigation(self, path=None, refresh=False, **kwargs):
+        """
+        Walks the whole market navigation hierarchy, see trading_ig.navigation. With a path, the tree
+        is saved there and later crawls only fetch the nodes that have gone stale
+        :param path: JSON file to keep the tree in. Optional
+        :type path: str
+        :param refresh: fetch every node, even those that aren't stale
+        :type refresh: bool
+        :param kwargs: max_workers, max_age, progress_callback, see MarketNavigationCrawler
+        :return: the crawler, holding the tree. Use its epics() method for all epics
+        :rtype: trading_ig.navigation.MarketNavigationCrawler
+        """
+        crawler = MarketNavigationCrawler(self, path=path, **kwargs)
+        crawler.crawl(refresh=refresh)
+        return crawler
+
+    def build_search_index(self, crawler=None, path=None):
+        """
+        Builds the local market search index consulted by search_markets, see trading_ig.marketsearch.
+        The index holds the markets of the navigation tree, and then every market whose details or
+        search results are fetched
+        :param crawler: crawled navigation tree. Optional, by default the tree is crawled (or loaded
+            from path and refreshed where stale)
+        :type crawler: trading_ig.navigation.MarketNavigationCrawler
+        :param path: JSON file of the navigation tree, see crawl_market_navigation. Optional
+        :type path: str
+        :rtype: trading_ig.marketsearch.MarketSearchIndex
+        """
+        if crawler is None:
+            crawler = self.crawl_market_navigation(path)
+        index = MarketSearchIndex.from_navigation(crawler)
+        if self.search_index is not None:
+            # keep what was learnt from details and searches so far
+            index.add_markets(self.search_index.markets.values())
+        self.search_index = index
+        logger.info(f"Market search index built with {len(index)} markets")
+        return index
+
+    def fetch_market_by_epic(self, epic, use_cache=True):
+        """
+        Returns the details of the given market
+        :param epic: market epic
+        :type epic: str
+        :param use_cache: whether details from the market cache will do, if it is enabled (see
+            trading_ig.marketcache). Pass False for an up to date snapshot
+        :type use_cache: bool
+        """
+        if use_cache and self.market_cache is not None:
+            details = self.market_cache.get(epic)
+            if details is not None:
+                return details
         version = "3"
         params = {}
         url_params = {"epic": epic}
         endpoint = "/markets/{epic}".format(**url_params)
-        return self.crud_session.read(endpoint, params,version)
-
-    def fetch_markets_by_epics(self, epics, detailed=True, version='2'):
+        details = self.crud_session.read(endpoint, params,version)
+        if self.market_cache is not None:
+            self.market_cache.put(epic, details)
+        if self.search_index is not None:
+            self.search_index.add_market_details([details])
+        return details
+
+    def fetch_markets_by_epics(self, epics, detailed=True, version='2', max_workers=4):
         """
-        Returns the details of the given markets
-        :param epics: comma separated list of epics
-        :type epics: str
+        Returns the details of the given markets. IG takes at most 50 epics per request, longer
+        lists are split and the requests sent concurrently
+        :param epics: list of epics, or comma separated string
+        :type epics: list or str
         :param detailed: Whether to return detailed info or snapshot data only. Only supported for
         version 2. Optional, default True
         :type detailed: bool
@@ -678,20 +895,74 @@ class IGService:
         :type session: requests.Session
         :param version: IG API method version. Optional, default '2'
         :type version: str
+        :param max_workers: maximum number of requests in flight at the same time
+        :type max_workers: int
         :return: list of market details
         """
-        params = {"epics": epics}
-        if version == '2':
-            params["filter"] = 'ALL' if detailed else 'SNAPSHOT_ONLY'
         endpoint = "/markets"
-        return self.crud_session.read(endpoint, params,version)['marketDetails']
 
-    def search_markets(self, search_term):
-        """Returns all markets matching the search term"""
+        def fetch_chunk(chunk):
+            params = {"epics": chunk}
+            if version == '2':
+                params["filter"] = 'ALL' if detailed else 'SNAPSHOT_ONLY'
+            return self.crud_session.read(endpoint, params,version)['marketDetails']
+
+        chunks = split_epics(epics)
+        if len(chunks) == 1:
+            markets = fetch_chunk(chunks[0])
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                markets = [market for chunk in executor.map(fetch_chunk, chunks) for market in chunk]
+        if version == '2' and detailed:
+            if self.market_cache is not None:
+                self.market_cache.put_many({market["instrument"]["epic"]: market for market in markets})
+            if self.search_index is not None:
+                self.search_index.add_market_details(markets)
+        return markets
+
+    def load_markets(self, epics, max_workers=4):
+        """
+        Returns the details of the given markets from the market cache, fetching only those that
+        aren't cached (see fetch_markets_by_epics). Without a market cache, all are fetched
+        :param epics: list of epics, or comma separated string
+        :type epics: list or str
+        :return: market details by epic
+        :rtype: dict
+        """
+        epics = epic_list(epics)
+        if self.market_cache is None:
+            markets = self.fetch_markets_by_epics(epics, max_workers=max_workers)
+            return {market["instrument"]["epic"]: market for market in markets}
+        markets = {epic: self.market_cache.get(epic) for epic in epics}
+        missing = [epic for epic, details in markets.items() if details is None]
+        if missing:
+            logger.info(f"Fetching details of {len(missing)} of {len(epics)} markets")
+            # from the responses, the cache may not hold them all when there are more than it keeps
+            fetched = self.fetch_markets_by_epics(missing, max_workers=max_workers)
+            markets.update((market["instrument"]["epic"], market) for market in fetched)
+        return markets
+
+    def search_markets(self, search_term, use_index=True):
+        """
+        Returns all markets matching the search term. With a search index (see build_search_index),
+        the markets are looked up locally and the API is only called when none match. The markets
+        found by the API are added to the index
+        :param search_term: words or word prefixes of instrument names or epics
+        :type search_term: str
+        :param use_index: whether to consult the search index, if there is one
+        :type use_index: bool
+        """
+        if use_index and self.search_index is not None:
+            markets = self.search_index.search(search_term)
+            if markets:
+                return {"markets": markets}
         version = "1"
         endpoint = "/markets"
         params = {"searchTerm": search_term}
-        return self.crud_session.read(endpoint, params,version)
+        response = self.crud_session.read(endpoint, params,version)
+        if self.search_index is not None:
+            self.search_index.add_markets(response.get("markets") or [])
+        return response
 
     def fetch_historical_prices_by_epic(
         self,
@@ -701,7 +972,9 @@ class IGService:
         numpoints=None,
         pagesize=20,
         format=None,
-        wait=1
+        wait=1,
+        resolution=None,
+        max_workers=4
     ):
 
         """
@@ -713,13 +986,15 @@ class IGService:
         prices at 1 minute resolution.
 
         If the result set spans multiple 'pages', this method will automatically
-        get all the results and bundle them into one object.
+        get all the results and bundle them into one object. With wait=0, pages
+        after the first are fetched concurrently.
+
+        If a price cache is configured (see trading_ig.pricestore) and resolution,
+        start_date and end_date are given, bars already downloaded are read from
+        the cache and only the missing intervals are requested from IG.
 
         :param epic: (str) The epic key for which historical prices are being
             requested
-        :param resolution: (str, optional) timescale resolution. Expected values
-            are 1Min, 2Min, 3Min, 5Min, 10Min, 15Min, 30Min, 1H, 2H, 3H, 4H, D,
-            W, M. Default is 1Min
         :param start_date: (datetime, optional) date range start, format
             yyyy-MM-dd'T'HH:mm:ss
         :param end_date: (datetime, optional) date range end, format
@@ -728,15 +1003,24 @@ class IGService:
         :param pagesize: (int, optional) number of data points. Default is 20
         :param session: (Session, optional) session object
         :param format: (function, optional) function to convert the raw
-            JSON response
+            JSON 'prices' list, e.g. trading_ig.prices.prices_to_dataframe
         :param wait: (int, optional) how many seconds to wait between successive
-            calls in a multi-page scenario. Default is 1
+            calls in a multi-page scenario. Default is 1. If set, pages are
+            fetched one at a time. Pass 0 to fetch them concurrently, requests
+            are still paced by the session's rate limiter
+        :param resolution: (str, optional) timescale resolution. Expected values
+            are 1Min, 2Min, 3Min, 5Min, 10Min, 15Min, 30Min, 1H, 2H, 3H, 4H, D,
+            W, M. Default is 1Min
+        :param max_workers: (int, optional) maximum number of pages fetched at
+            the same time. Default is 4
         :returns: Pandas DataFrame if configured, otherwise a dict
         :raises Exception: raises an exception if any error is encountered
         """
 
         version = "3"
         params = {}
+        if resolution:
+            params["resolution"] = conv_resol(resolution)
         if start_date:
             params["from"] = start_date
         if end_date:
@@ -746,36 +1030,49 @@ class IGService:
         params["pageSize"] = pagesize
         url_params = {"epic": epic}
         endpoint = "/prices/{epic}".format(**url_params)
-        prices = []
-        pagenumber = 1
-        more_results = True
-
-        while more_results:
-            params["pageNumber"] = pagenumber
-            data = self.crud_session.read(endpoint, params,version)
-            prices.extend(data["prices"])
-            page_data = data["metadata"]["pageData"]
-            if page_data["totalPages"] == 0 or \
-                    (page_data["pageNumber"] == page_data["totalPages"]):
-                more_results = False
-            else:
-                pagenumber += 1
-            time.sleep(wait)
-
-        data["prices"] = prices
+        if self.price_cache is not None and resolution and start_date and end_date and not numpoints:
+            data = self._fetch_cached_prices(
+                epic, params, endpoint, version, max_workers=max_workers, wait=wait)
+        else:
+            data = self._fetch_all_pages(endpoint, params, version, "prices", max_workers=max_workers, wait=wait)
 
-        self.log_allowance(data["metadata"])
+        if "allowance" in data["metadata"]:
+            self.log_allowance(data["metadata"])
+        if format is not None:
+            data["prices"] = format(data["prices"])
         return data
 
+    def _fetch_cached_prices(self, epic, params, endpoint, version, max_workers=4, wait=0):
+        """
+        Serves a /prices request from the price cache, requesting only the intervals that haven't
+        been downloaded yet from IG
+        :return: price data, shaped as if it all came from IG, see PriceBarStore.load_response
+        :rtype: dict
+        """
+        resolution = params["resolution"]
+        for start, end in self.price_cache.missing(epic, resolution, params["from"], params["to"]):
+            logger.debug(f"Price cache miss for {epic} {resolution}: {start} - {end}")
+            interval_params = dict(params, **{"from": start, "to": end})
+            data = self._fetch_all_pages(
+                endpoint, interval_params, version, "prices", max_workers=max_workers, wait=wait)
+            self.price_cache.store(
+                epic, resolution, start, end, data["prices"],
+                data.get("instrumentType"), data["metadata"].get("allowance"))
+        return self.price_cache.load_response(epic, resolution, params["from"], params["to"], params["pageSize"])
+
     def fetch_historical_prices_by_epic_and_num_points(self, epic, resolution,numpoints,format=None):
         """Returns a list of historical prices for the given epic, resolution,
-        number of points"""
+        number of points. format optionally converts the 'prices' list, e.g.
+        trading_ig.prices.prices_to_dataframe"""
         version = "2"
         resolution = resolution
         params = {}
         url_params = {"epic": epic, "resolution": resolution, "numpoints": numpoints}
         endpoint = "/prices/{epic}/{resolution}/{numpoints}".format(**url_params)
-        return self.crud_session.read(endpoint, params,version)
+        data = self.crud_session.read(endpoint, params,version)
+        if format is not None:
+            data["prices"] = format(data["prices"])
+        return data
 
     def fetch_historical_prices_by_epic_and_date_range(self, epic, resolution, start_date, end_date, format=None, version='2'):
         """
@@ -793,7 +1090,8 @@ class IGService:
         :type end_date: str
         :param session: HTTP session
         :type session: requests.Session
-        :param format: function defining how the historic price data should be converted into a Dataframe
+        :param format: function defining how the historic price data should be converted into a Dataframe,
+            e.g. trading_ig.prices.prices_to_dataframe. Optional, default None (no conversion)
         :type format: function
         :param version: API method version
         :type version: str
@@ -812,15 +1110,86 @@ class IGService:
             url_params = {"epic": epic, "resolution": resolution, "startDate": start_date, "endDate": end_date}
             endpoint = "/prices/{epic}/{resolution}/{startDate}/{endDate}".format(**url_params)
         data = self.crud_session.read(endpoint, params,version)
-        del self.session.headers["VERSION"]
+        if format is not None:
+            data["prices"] = format(data["prices"])
         return data
 
-    def log_allowance(self, data):
+    def iter_backfill_historical_prices(
+            self,
+            jobs,
+            max_workers=4,
+            chunk_points=1000,
+            max_retries=3,
+            progress_callback=None):
+        """
+        Backfills historical prices for many epics at once, yielding the results per job as they
+        complete.
+
+        Long date ranges are split into chunks of at most chunk_points bars, and chunks are fetched
+        across a worker pool under the historical data allowance. Failed chunks are retried.
+
+        :param jobs: (epic, resolution, start_date, end_date) tuples or trading_ig.backfill.BackfillJob.
+            Dates are datetimes or strings formatted yyyy-MM-dd'T'HH:mm:ss
+        :type jobs: list
+        :param max_workers: maximum number of chunks fetched at the same time. Default 4
+        :type max_workers: int
+        :param chunk_points: maximum number of data points per request. Default 1000
+        :type chunk_points: int
+        :param max_retries: how many times a failed chunk is retried. Default 3
+        :type max_retries: int
+        :param progress_callback: called with a trading_ig.backfill.BackfillProgress after every
+            chunk, including the remaining allowance. Optional
+        :type progress_callback: function
+        :return: generator of trading_ig.backfill.BackfillResult
+        """
+        backfill = HistoricalBackfill(
+            self,
+            max_workers=max_workers,
+            chunk_points=chunk_points,
+            max_retries=max_retries,
+            progress_callback=progress_callback)
+        return backfill.run(jobs)
+
+    def backfill_historical_prices(
+            self,
+            jobs,
+            max_workers=4,
+            chunk_points=1000,
+            max_retries=3,
+            progress_callback=None):
+        """
+        Backfills historical prices for many epics at once, see iter_backfill_historical_prices
+        :return: one trading_ig.backfill.BackfillResult per job, in the order of jobs
+        :rtype: list
+        """
+        # jobs may be a generator, which can only be read once
+        jobs = list(jobs)
+        backfill = HistoricalBackfill(
+            self,
+            max_workers=max_workers,
+            chunk_points=chunk_points,
+            max_retries=max_retries,
+            progress_callback=progress_callback)
+        results = [None] * len(jobs)
+        for index, result in backfill.run_indexed(jobs):
+            results[index] = result
+        return results
+
+    @staticmethod
+    def log_allowance(data):
+        """
+        Logs the historical price data allowance returned with price data
+        :param data: 'metadata' portion of the response body
+        :type data: dict
+        :return: remaining allowance (data points) and when it will be reset
+        :rtype: tuple
+        """
         remaining_allowance = data['allowance']['remainingAllowance']
         allowance_expiry_secs = data['allowance']['allowanceExpiry']
         allowance_expiry = datetime.today() + timedelta(seconds=allowance_expiry_secs)
         logger.info("Historic price data allowance: %s remaining until %s" %
                     (remaining_allowance, allowance_expiry))
+        return remaining_allowance, allowance_expiry
 
     # -------- END -------- #
 
@@ -881,8 +1250,9 @@ class IGService:
         version = "1"
         params = {}
         endpoint = "/session"
+        self.crud_session.stop_token_refresh()
         self.crud_session.delete(endpoint, params,version)
-        self.session.close()
+        self.crud_session.close()
 
     def switch_account(self, account_id, default_account):
         """Switches active accounts, optionally setting the default account"""
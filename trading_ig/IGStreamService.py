@@ -3,50 +3,101 @@
 
 from __future__ import absolute_import, division, print_function
 import json
-import sys
 import traceback
 import logging
 
+from .confirmations import CONFIRM_STREAM_TIMEOUT, DealConfirmationRegistry
+from .Exceptions import IGException
 from .lightstreamer import LSClient
 
 logger = logging.getLogger(__name__)
 
 
 class IGStreamService(object):
-    def __init__(self, ig_service):
+    def __init__(self, ig_service, dispatcher=None):
+        """
+        :param ig_service: logged in IGService
+        :param dispatcher: calls subscription listeners off the thread reading the stream. Optional
+        :type dispatcher: trading_ig.lightstreamer.Dispatcher
+        """
         self.ig_service = ig_service
+        self.dispatcher = dispatcher
         self.lightstreamerEndpoint = None
         self.acc_number = None
         self.ls_client = None
+        self.deal_confirmations = None
 
-    def create_session(self, version='2'):
+    def _stream_credentials(self, version='2'):
+        """
+        Logs in through the REST API, for fresh session tokens
+        :return: Lightstreamer endpoint, user and password
+        :rtype: tuple
+        """
         session_response = self.ig_service.crud_session.create_session(version=version)
         # if we have created a v3 session, we also need the session tokens
         if version == '3':
-            self.ig_service.crude_session.read_session(fetch_session_tokens='true')
+            self.ig_service.read_session(fetch_session_tokens='true')
         self.lightstreamerEndpoint = json.loads(session_response.text)['lightstreamerEndpoint']
-        
-        cst = session_response.headers['CST']
-        xsecuritytoken = session_response.headers['X-SECURITY-TOKEN'] 
+
+        # a v3 login only returns OAuth tokens, the session handler keeps the CST / X-SECURITY-TOKEN
+        # of whichever response carried them
+        headers = self.ig_service.crud_session.session.headers
+        cst = headers['CST']
+        xsecuritytoken = headers['X-SECURITY-TOKEN']
         ls_password = f"CST-{cst}|XST-{xsecuritytoken}"
+        return self.lightstreamerEndpoint, self._account_number(), ls_password
+
+    def _account_number(self):
+        """The account streamed, acc_number if set, otherwise the account of the REST session"""
+        return self.acc_number or self.ig_service.crud_session.ACC_NUMBER
+
+    def create_session(self, version='2', recover=False):
+        """
+        Logs in and connects to Lightstreamer
+        :param version: API version of the REST session
+        :type version: str
+        :param recover: whether a lost stream session is re-created (logging in again) with all its
+            subscriptions, see LSClient.enable_recovery. Outages are recorded in
+            ls_client.recovery_stats. Off by default, the stream then ends with the session
+        :type recover: bool
+        :raises IGException: if the connection to Lightstreamer fails
+        """
+        endpoint, user, ls_password = self._stream_credentials(version)
 
         # Establishing a new connection to Lightstreamer Server
-        logger.info("Starting connection with %s" % self.lightstreamerEndpoint)
-        self.ls_client = LSClient(self.lightstreamerEndpoint, adapter_set="", user=self.acc_number, password=ls_password)
+        logger.info("Starting connection with %s" % endpoint)
+        self.ls_client = LSClient(endpoint, adapter_set="", user=user, password=ls_password,
+                                  dispatcher=self.dispatcher)
+        if recover:
+            self.ls_client.enable_recovery(lambda: self._stream_credentials(version))
         try:
             self.ls_client.connect()
-            return
-        except Exception:
+        except Exception as e:
             logger.error("Unable to connect to Lightstreamer Server")
             logger.error(traceback.format_exc())
-            sys.exit(1)
+            raise IGException("Unable to connect to Lightstreamer Server") from e
+
+    def enable_deal_confirmations(self, timeout=CONFIRM_STREAM_TIMEOUT):
+        """
+        Subscribes to the account's TRADE updates, and makes the IGService wait for deal
+        confirmations on the stream rather than polling REST (which remains the fallback)
+        :param timeout: seconds to wait for a streamed confirmation before falling back to REST
+        :type timeout: float
+        :rtype: trading_ig.confirmations.DealConfirmationRegistry
+        """
+        self.deal_confirmations = DealConfirmationRegistry(self.ls_client, self._account_number(), timeout=timeout)
+        self.deal_confirmations.start()
+        self.ig_service.deal_confirmations = self.deal_confirmations
+        return self.deal_confirmations
 
     def unsubscribe_all(self):
-        # To avoid a RuntimeError: dictionary changed size during iteration
-        subscriptions = self.ls_client._subscriptions.copy()
-        for subcription_key in subscriptions:
-            self.ls_client.unsubscribe(subcription_key)
+        # All in a few batched control requests, rather than one request per subscription
+        self.ls_client.unsubscribe_many(list(self.ls_client._subscriptions))
 
     def disconnect(self):
+        if self.deal_confirmations is not None:
+            self.ig_service.deal_confirmations = None
+            self.deal_confirmations.stop()
+            self.deal_confirmations = None
         self.unsubscribe_all()
         self.ls_client.disconnect()
@@ -1,15 +1,67 @@
-from requests import Session
 from retry import retry
 import json
+import re
+import threading
+import time
 # from datetime import datetime
 import datetime
-from trading_ig.Exceptions import IGException, ApiExceededException, IGExceptionSessionReset
-from trading_ig.utils import create_logger
+from concurrent.futures import ThreadPoolExecutor
+from trading_ig.Exceptions import IGException, ApiExceededException, IGExceptionSessionReset, NotFoundException
+from trading_ig.ratelimiter import IGRateLimiter
+from trading_ig.transport import create_http_session, http_settings, http_timeout
+from trading_ig.utils import create_logger, get_config_value, get_json_decoder
 
 logger = create_logger("session_handler", "log_session_handler.log")
 
+# errorCode values of rejected requests that count against a per-minute allowance. We don't check
+# for the historical data allowance - it only gets reset once a week
+API_LIMIT_ERRORS = (
+    'exceeded-api-key-allowance',
+    'exceeded-account-allowance',
+    'exceeded-account-trading-allowance',
+)
+# errorCode prefix of requests rejected for their authentication, e.g. a refresh token IG no longer accepts
+AUTH_ERROR = 'error.security.'
+# errorCode values of deal confirmations IG hasn't got yet, polled again until the deal is processed
+DEAL_NOT_FOUND_ERRORS = (
+    'error.confirms.deal-not-found',
+)
+
+# endpoints sent over the dedicated dealing connection
+DEALING_ENDPOINTS = re.compile(r"^/(positions/otc|workingorders/otc|confirms/)")
+
+# seconds before a v3 access token expires that the background refresher renews it
+TOKEN_REFRESH_MARGIN = 15
+# seconds to wait before trying again when a background refresh has failed
+TOKEN_REFRESH_RETRY = 2
+# attempts at a token refresh rejected for exceeding an allowance, before giving up
+TOKEN_REFRESH_ATTEMPTS = 3
+
 class IGSessionHandler:
-    """Session with CRUD operation"""
+    """
+    Session with CRUD operation
+
+    The handler is safe to share between threads: the API version and other per-call headers are
+    sent with each request rather than stored on the shared session, and authentication headers are
+    replaced copy-on-write under a lock, so a request in flight never sees a half-updated header set.
+
+    Requests are paced by an IGRateLimiter (configured with the optional 'rate_limit_*' settings),
+    so they wait for capacity instead of exceeding IG's allowances.
+
+    Response bodies are decoded once, straight from bytes, with the fastest JSON library installed
+    (orjson, ujson, or the standard library). The optional 'json_decoder' setting picks one explicitly.
+
+    v3 access tokens only last for 60 seconds. A background thread renews them 'token_refresh_margin'
+    seconds (default 15) before they expire, so requests never wait for a refresh. It can be switched
+    off with 'token_refresh = False', in which case tokens are refreshed before the first request
+    after they have expired.
+
+    Connections are pooled and kept alive, with connect / read timeouts on every request. See
+    trading_ig.transport for the optional 'http_*' settings, including HTTP/2. Dealing requests
+    (orders and deal confirmations) have a connection pool of their own, so they never queue behind
+    slow requests such as price history, and it can be warmed up ahead of trading with warm_up().
+    Set 'dealing_connection = False' to share a single pool.
+    """
 
     def __init__(self, base_url, config):
         self.BASE_URL = base_url
@@ -21,7 +73,23 @@ class IGSessionHandler:
         self._refresh_token = None
         self._valid_until = None
 
-        self.session = Session()
+        # guards authentication state (headers, tokens) and session resets
+        self._lock = threading.RLock()
+        # one token refresh at a time. Held instead of _lock while the refresh request is sent
+        self._renew_lock = threading.Lock()
+        # incremented every time a new session is created, see _reset_session
+        self._generation = 0
+
+        self.rate_limiter = IGRateLimiter.from_config(config)
+        self.json_loads = get_json_decoder(get_config_value(config, 'json_decoder'))
+        self._init_token_refresh(config)
+
+        self.http_settings = http_settings(config)
+        self.timeout = http_timeout(self.http_settings)
+        self.session = create_http_session(self.http_settings)
+        self.dealing_session = None
+        if str(get_config_value(config, 'dealing_connection', True)).lower() not in ('false', '0', 'no'):
+            self.dealing_session = create_http_session(self.http_settings)
 
         self.session.headers.update({
             "X-IG-API-KEY": self.API_KEY,
@@ -37,11 +105,209 @@ class IGSessionHandler:
         """
         access_token = oauth['access_token']
         token_type = oauth['token_type']
-        self.session.headers.update({'Authorization': f"{token_type} {access_token}"})
-        self._refresh_token = oauth['refresh_token']
         validity = int(oauth['expires_in'])
-        self._valid_until = datetime.datetime.now() + datetime.timedelta(seconds=validity)
+        with self._lock:
+            self._update_headers({'Authorization': f"{token_type} {access_token}"})
+            self._refresh_token = oauth['refresh_token']
+            self._valid_until = datetime.datetime.now() + datetime.timedelta(seconds=validity)
+            if self.token_refresh:
+                self._start_token_refresh()
+
+    # -------- TOKEN REFRESH -------- #
+
+    def _init_token_refresh(self, config):
+        """Reads the optional 'token_refresh' and 'token_refresh_margin' settings"""
+        enabled = get_config_value(config, 'token_refresh', True)
+        self.token_refresh = str(enabled).lower() not in ('false', '0', 'no')
+        self.token_refresh_margin = float(get_config_value(config, 'token_refresh_margin', TOKEN_REFRESH_MARGIN))
+        self._refresher = None
+        self._refresher_stop = None
 
+    def _refresh_delay(self):
+        """Seconds until the access token is due for renewal, or None without a v3 session"""
+        if self._valid_until is None or self._refresh_token is None:
+            return None
+        remaining = (self._valid_until - datetime.datetime.now()).total_seconds()
+        return remaining - self.token_refresh_margin
+
+    def _start_token_refresh(self):
+        """Starts the background refresher thread, unless it is already running"""
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher_stop = threading.Event()
+            self._refresher = threading.Thread(
+                target=self._refresh_loop,
+                args=(self._refresher_stop,),
+                name=f"ig-token-refresh-{self.IG_USERNAME}",
+                daemon=True)
+            self._refresher.start()
+
+    def stop_token_refresh(self):
+        """Stops the background refresher thread, e.g. when logging out"""
+        with self._lock:
+            if self._refresher_stop is not None:
+                self._refresher_stop.set()
+            self._refresher = None
+            self._refresher_stop = None
+
+    def _refresh_loop(self, stop):
+        """Renews the access token shortly before it expires, until stopped or the v3 session is gone"""
+        logger.debug("Token refresher started")
+        while not stop.is_set():
+            with self._lock:
+                delay = self._refresh_delay()
+                if delay is None:
+                    if self._refresher_stop is stop:
+                        self._refresher = None
+                        self._refresher_stop = None
+                    break
+                valid_until = self._valid_until
+            if delay > 0:
+                stop.wait(delay)
+                continue
+            try:
+                self._renew_session(valid_until)
+            except Exception as e:
+                logger.warning(f"Background session refresh failed ({e}), retrying in {TOKEN_REFRESH_RETRY} seconds")
+                stop.wait(TOKEN_REFRESH_RETRY)
+        logger.debug("Token refresher stopped")
+
+    def _renew_session(self, valid_until):
+        """
+        Refreshes the access token, or logs in again if IG rejects the refresh token. A refresh
+        rejected for exceeding an allowance is retried instead. Nothing is done if the token has
+        already been renewed since valid_until was read
+        :param valid_until: expiry of the token to renew
+        :type valid_until: datetime.datetime
+        """
+        with self._renew_lock:
+            with self._lock:
+                # another thread may have renewed it while we were waiting for the lock
+                if self._valid_until != valid_until or self._refresh_token is None:
+                    return
+                generation = self._generation
+                refresh_token = self._refresh_token
+            # requests go on with the current token while the refresh is sent
+            for attempt in range(TOKEN_REFRESH_ATTEMPTS):
+                try:
+                    data = self._request_refresh(refresh_token)
+                    break
+                except ApiExceededException:
+                    # the session is still valid. The rate limiter has been drained, so the next
+                    # attempt waits for capacity
+                    if attempt == TOKEN_REFRESH_ATTEMPTS - 1:
+                        raise
+                    logger.info("Refresh rejected for exceeding an allowance, retrying")
+                    if self.rate_limiter is None:
+                        time.sleep(TOKEN_REFRESH_RETRY)
+                except Exception as e:
+                    if not self._auth_failed(e):
+                        raise
+                    logger.info(f"Refresh failed ({e}), resetting session")
+                    self._reset_session(generation)
+                    return
+            with self._lock:
+                if generation != self._generation:
+                    logger.debug("Session reset during the refresh, new tokens dropped")
+                    return
+                self._handle_oauth(data)
+
+    # -------- END -------- #
+
+    def _update_headers(self, headers):
+        """
+        Replaces the shared session headers with an updated copy. Requests being prepared on other
+        threads keep using the previous dict, so they never see a partially updated set of headers.
+        :param headers: headers to add or overwrite
+        :type headers: dict
+        """
+        with self._lock:
+            new_headers = self.session.headers.copy()
+            new_headers.update(headers)
+            self.session.headers = new_headers
+
+    def _remove_header(self, name):
+        """
+        Removes a header from the shared session headers, copy-on-write
+        :param name: header name
+        :type name: str
+        """
+        with self._lock:
+            new_headers = self.session.headers.copy()
+            new_headers.pop(name, None)
+            self.session.headers = new_headers
+
+    @staticmethod
+    def _request_headers(version, **extra):
+        """
+        Headers that only apply to a single request
+        :param version: API method version
+        :type version: str
+        :return: headers to pass alongside the request
+        :rtype: dict
+        """
+        headers = {'VERSION': version}
+        headers.update(extra)
+        return headers
+
+
+    @staticmethod
+    def _encode(params):
+        """JSON request body. Bodies that are already serialised (see dealing.OrderTemplate) are sent as is"""
+        if isinstance(params, (str, bytes)):
+            return params
+        return json.dumps(params)
+
+    def _send(self, method, endpoint, body=None, params=None, headers=None):
+        """
+        Sends a request over the pooled HTTP session, with the configured timeouts
+        :param method: HTTP method
+        :type method: str
+        :param endpoint: API endpoint
+        :type endpoint: str
+        :param body: JSON encoded request body
+        :type body: str
+        :param params: query string parameters
+        :type params: dict
+        :param headers: per-request headers, see _request_headers
+        :type headers: dict
+        """
+        session = self.session
+        if self.dealing_session is not None and DEALING_ENDPOINTS.match(endpoint):
+            # authentication headers live on the main session
+            headers = dict(self.session.headers, **headers)
+            session = self.dealing_session
+        # httpx takes a raw body as 'content', requests as 'data'
+        body_arg = 'content' if self.http_settings.http2 else 'data'
+        return session.request(
+            method, self._url(endpoint), params=params, headers=headers, timeout=self.timeout,
+            **{body_arg: body})
+
+    def warm_up(self, connections=1):
+        """
+        Opens connections to IG ahead of time, so that the next requests don't pay for the TCP and
+        TLS handshakes. Uses the dealing connection pool, if there is one. Idle connections are
+        eventually closed by the server, call again after a quiet period
+        :param connections: number of connections to open
+        :type connections: int
+        """
+        session = self.dealing_session if self.dealing_session is not None else self.session
+
+        def head(_):
+            # any response will do, it only has to go over the connection
+            return session.request('HEAD', self.BASE_URL, timeout=self.timeout).status_code
+
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            statuses = list(executor.map(head, range(connections)))
+        logger.info(f"Warmed up {connections} connection(s) to '{self.BASE_URL}', responses {statuses}")
+
+    def close(self):
+        """Stops the token refresher and closes the HTTP connections"""
+        self.stop_token_refresh()
+        self.session.close()
+        if self.dealing_session is not None:
+            self.dealing_session.close()
 
     def refresh_session(self, version='1'):
         """
@@ -50,15 +316,25 @@ class IGSessionHandler:
         :type session: requests.Session
         :param version: API method version
         :type version: str
-        :return: HTTP status code
-        :rtype: int
+        :return: JSON response body, parsed into dict
+        :rtype: dict
+        """
+        data = self._request_refresh(self._refresh_token, version)
+        self._handle_oauth(data)
+        return data
+
+    def _request_refresh(self, refresh_token, version='1'):
+        """
+        Exchanges a refresh token for new v3 tokens, without applying them
+        :param refresh_token: refresh token of the current session
+        :type refresh_token: str
+        :return: 'oauth' style JSON response body, parsed into dict
+        :rtype: dict
         """
         logger.info(f"Refreshing session '{self.IG_USERNAME}'")
-        params = {"refresh_token": self._refresh_token}
+        params = {"refresh_token": refresh_token}
         endpoint = "/session/refresh-token"
-        response = self.create(endpoint, params,version)
-        self._handle_oauth(json.loads(response.text))
-        return response.status_code
+        return self.create(endpoint, params, version, check_session=False)
 
     def handle_session_tokens(self, response):
         """
@@ -68,10 +344,13 @@ class IGSessionHandler:
         :param session: HTTP session object
         :type session: requests.Session
         """
+        tokens = {}
         if "CST" in response.headers:
-            self.session.headers['CST'] = response.headers['CST']
+            tokens['CST'] = response.headers['CST']
         if "X-SECURITY-TOKEN" in response.headers:
-            self.session.headers['X-SECURITY-TOKEN'] = response.headers['X-SECURITY-TOKEN']
+            tokens['X-SECURITY-TOKEN'] = response.headers['X-SECURITY-TOKEN']
+        if tokens:
+            self._update_headers(tokens)
 
     def _manage_headers(self, response):
         """
@@ -82,40 +361,106 @@ class IGSessionHandler:
         # handle v1 and v2 logins
         self.handle_session_tokens(response)
         # handle v3 logins
-        if response.text:
-            self.session.headers.update({'IG-ACCOUNT-ID': self.ACC_NUMBER})
-            payload = json.loads(response.text)
-            if 'oauthToken' in payload:
-                self._handle_oauth(payload['oauthToken'])
+        self._manage_login_payload(response.content)
 
-    
-    def _api_limit_hit(self, response_text):
-        # note we don't check for historical data allowance - it only gets reset once a week
-        return 'exceeded-api-key-allowance' in response_text or \
-               'exceeded-account-allowance' in response_text or \
-               'exceeded-account-trading-allowance' in response_text
-
-    def _handle_response(self, response):
-        """Creates a CRUD request and returns response"""
-        if response.status_code >= 500:
-            raise (IGException(f"Server problem: status code: {response.status_code}, reason: {response.reason}"))
-
-        response.encoding = 'utf-8'
-        if self._api_limit_hit(response.text):
-            logger.debug("_handle_response > allowance exceeded")
-            self._reset_session()
-            raise ApiExceededException()
-        
-        response_json = json.loads(response.text)
+    def _manage_login_payload(self, body):
+        """
+        Picks up the account id and v3 OAuth tokens from a session creation response body
+        :param body: HTTP response body
+        :type body: bytes or str
+        :return: JSON response body, parsed into dict (empty if there is no body)
+        :rtype: dict
+        """
+        if not body:
+            return {}
+        self._update_headers({'IG-ACCOUNT-ID': self.ACC_NUMBER})
+        payload = self.json_loads(body)
+        if 'oauthToken' in payload:
+            self._handle_oauth(payload['oauthToken'])
+        return payload
+
+    @staticmethod
+    def _auth_failed(error):
+        """Whether a failed request was rejected for its authentication, which logging in again fixes"""
+        return isinstance(error, IGExceptionSessionReset) or str(error).startswith(AUTH_ERROR)
+
+    @staticmethod
+    def _api_limit_hit(error_code):
+        """Whether an errorCode reports a per-minute allowance as exceeded"""
+        return any(error in error_code for error in API_LIMIT_ERRORS)
+
+    def _parse_response(self, status_code, reason, body):
+        """
+        Checks a CRUD response for IG errors and returns its parsed body. Transport independent, so it
+        is shared with the asyncio session handler
+        :param status_code: HTTP status code
+        :type status_code: int
+        :param reason: HTTP reason phrase
+        :type reason: str
+        :param body: HTTP response body, decoded as UTF-8 if bytes
+        :type body: bytes or str
+        :return: JSON response body, parsed into dict
+        :rtype: dict
+        """
+        if status_code >= 500:
+            raise (IGException(f"Server problem: status code: {status_code}, reason: {reason}"))
+
+        response_json = self.json_loads(body)
         if "errorCode" in response_json:
-            if "error.security.client-token-missing" in response_json["errorCode"]:
+            if self._api_limit_hit(response_json["errorCode"]):
+                logger.debug("_handle_response > allowance exceeded")
+                raise ApiExceededException()
+            elif "error.security.client-token-missing" in response_json["errorCode"]:
                 logger.debug("_handle_response > token is missing")
-                self._reset_session()
                 raise IGExceptionSessionReset()
+            elif response_json["errorCode"] in DEAL_NOT_FOUND_ERRORS:
+                logger.debug("_handle_response > not found")
+                raise NotFoundException(response_json["errorCode"])
             else:
                 logger.debug("_handle_response > other error")
                 raise Exception(response_json["errorCode"])
         return response_json
+
+    def _handle_response(self, response, generation=None, method=None, endpoint=None):
+        """
+        Checks a CRUD response and returns its parsed body
+        :param response: HTTP response
+        :type response: requests.Response
+        :param generation: session generation the request was sent with, see _reset_session
+        :type generation: int
+        :param method: HTTP method of the request, used for rate limiting
+        :type method: str
+        :param endpoint: API endpoint of the request, used for rate limiting
+        :type endpoint: str
+        """
+        try:
+            # httpx responses have 'reason_phrase' rather than 'reason'
+            reason = getattr(response, 'reason', None) or getattr(response, 'reason_phrase', None)
+            return self._parse_response(response.status_code, reason, response.content)
+        except ApiExceededException:
+            self._allowance_exceeded(method, endpoint)
+            raise
+        except IGExceptionSessionReset:
+            self._reset_session(generation)
+            raise
+
+    def _throttle(self, method, endpoint, params=None):
+        """Waits until the request can be sent without exceeding an IG allowance"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(method, endpoint, params)
+
+    def _allowance_exceeded(self, method, endpoint):
+        """
+        IG rejected a request for exceeding an allowance. The session itself is still valid, so
+        rather than resetting it the rate limiter holds back further requests of that type
+        """
+        if self.rate_limiter is not None and endpoint is not None:
+            self.rate_limiter.exceeded(method, endpoint)
+
+    def _record_allowance(self, endpoint, payload):
+        """Keeps the historical data allowance in step with price responses"""
+        if self.rate_limiter is not None and endpoint.startswith('/prices/'):
+            self.rate_limiter.record_allowance(payload)
         
     def _check_session(self):
         """
@@ -124,25 +469,30 @@ class IGSessionHandler:
             - if possible, the session can be renewed with a special refresh token
             - if not, a new session will be created
         """
-        logger.debug("Checking session status...")
-        if self._valid_until is None or datetime.now() > self._valid_until:
+        valid_until = self._valid_until
+        if valid_until is None or datetime.datetime.now() < valid_until:
             return
-            
-        if self._refresh_token:
-            # we are in a v3,need to refresh
-            try:
-                logger.info("Current session has expired, refreshing...")
-                self.refresh_session()
-            except IGException:
-                logger.info("Refresh failed, resetting session")
-                self._reset_session()
-    
-    def _reset_session(self):
-        logger.info("Nuking session, full reset.")
-        self._refresh_token = None
-        self._valid_until = None
-        self.session.headers.pop('Authorization', None)
-        self.create_session(version='3')
+
+        # the background refresher is off, or fell behind
+        logger.info("Current session has expired, refreshing...")
+        self._renew_session(valid_until)
+
+    def _reset_session(self, generation=None):
+        """
+        Throws the current session away and logs in again
+        :param generation: session generation seen by the failing request. If another thread has
+            already reset the session since then, there is nothing left to do
+        :type generation: int
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                logger.debug("Session already reset by another request")
+                return
+            logger.info("Nuking session, full reset.")
+            self._refresh_token = None
+            self._valid_until = None
+            self._remove_header('Authorization')
+            self.create_session(version='3')
 
     def _url(self, endpoint):
         """Returns url from endpoint and base url"""
@@ -168,53 +518,55 @@ class IGSessionHandler:
 
         logger.info(f"Creating new v{version} session for user '{self.IG_USERNAME}' at '{self.BASE_URL}'")
         params = {"identifier": self.IG_USERNAME, "password": self.IG_PASSWORD}
-        url = self._url("/session")
-        response = self.session.post(url, data=json.dumps(params))
-        self._manage_headers(response)
+        with self._lock:
+            response = self._send('POST', "/session", body=json.dumps(params), headers=self._request_headers(version))
+            self._manage_headers(response)
+            self._generation += 1
         return response
     
-    def create(self, endpoint, params, version):
+    def create(self, endpoint, params, version, check_session=True):
         """Create = POST"""
-        self._check_session()
-        url = self._url(endpoint)
-        
-        self.session.headers.update({'VERSION': version})
-        response = self.session.post(url, data=json.dumps(params))
+        if check_session:
+            self._check_session()
+        generation = self._generation
+        self._throttle('POST', endpoint)
+
+        response = self._send('POST', endpoint, body=self._encode(params), headers=self._request_headers(version))
         logger.info(f"POST '{endpoint}', resp {response.status_code}")
-        return self._handle_response(response)
+        return self._handle_response(response, generation, 'POST', endpoint)
 
     @retry((ApiExceededException, IGExceptionSessionReset), delay=2, tries=5, backoff=2, logger=logger)
     def read(self, endpoint, params, version):
         """Read = GET"""
         self._check_session()
-        url = self._url(endpoint)
-        
-        self.session.headers.update({'VERSION': version})
-        response = self.session.get(url, params=params)
+        generation = self._generation
+        self._throttle('GET', endpoint, params)
+
+        response = self._send('GET', endpoint, params=params, headers=self._request_headers(version))
         # handle 'read_session' with 'fetchSessionTokens=true'
         self.handle_session_tokens(response)
         logger.info(f"GET '{endpoint}', resp {response.status_code}")
-        return self._handle_response(response)
+        data = self._handle_response(response, generation, 'GET', endpoint)
+        self._record_allowance(endpoint, data)
+        return data
 
     def update(self, endpoint, params,version):
         """Update = PUT"""
         self._check_session()
-        url = self._url(endpoint)
-        
-        self.session.headers.update({'VERSION': version})
-        response = self.session.put(url, data=json.dumps(params))
+        generation = self._generation
+        self._throttle('PUT', endpoint)
+
+        response = self._send('PUT', endpoint, body=self._encode(params), headers=self._request_headers(version))
         logger.info(f"PUT '{endpoint}', resp {response.status_code}")
-        return self._handle_response(response)
+        return self._handle_response(response, generation, 'PUT', endpoint)
 
     def delete(self, endpoint, params,version):
         """Delete = POST"""
         self._check_session()
-        url = self._url(endpoint)
-        
-        self.session.headers.update({'VERSION': version})
-        self.session.headers.update({'_method': 'DELETE'})
-        response = self.session.post(url, data=json.dumps(params))
-        logger.info(f"DELETE (POST) '{endpoint}', resp {response.status_code}")
-        del self.session.headers['_method']
+        generation = self._generation
+        self._throttle('DELETE', endpoint)
 
-        return self._handle_response(response)
+        headers = self._request_headers(version, _method='DELETE')
+        response = self._send('POST', endpoint, body=self._encode(params), headers=headers)
+        logger.info(f"DELETE (POST) '{endpoint}', resp {response.status_code}")
+        return self._handle_response(response, generation, 'DELETE', endpoint)
@@ -22,11 +22,13 @@ from .version import (
     __url__,
 )
 
-from .rest import IGService
+from .IGService import IGService
+from .AsyncIGService import AsyncIGService
 from .IGStreamService import IGStreamService
 
 __all__ = [
     "IGService",
+    "AsyncIGService",
     "IGStreamService",
     "__author__",
     "__copyright__",
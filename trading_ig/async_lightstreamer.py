@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Asyncio Lightstreamer client
+
+AsyncLSClient speaks the same text protocol as lightstreamer.LSClient (create_session, bind_session
+and control requests, PROBE / LOOP / END handling) over aiohttp, so the stream runs as a task on the
+event loop of an AsyncIGService instead of on threads of its own. Subscriptions and their item state
+are the same Subscription objects, and their updates can be consumed as async iterators:
+
+    client = AsyncLSClient(lightstreamer_endpoint, user=acc_number, password=ls_password)
+    await client.connect()
+    subscription = Subscription("MERGE", ["MARKET:CS.D.EURUSD.MINI.IP"], ["BID", "OFFER"])
+    updates = client.updates(subscription)
+    await client.subscribe(subscription)
+    async for item_update in updates:
+        print(item_update.value("BID"))
+
+Requires the optional 'aiohttp' package.
+"""
+import asyncio
+import logging
+from collections import Counter
+
+from six.moves.urllib.parse import urlparse as parse_url, urlencode, urljoin
+
+from trading_ig.Exceptions import IGException
+from trading_ig.lightstreamer import (BIND_URL_PATH, CONNECTION_URL_PATH, CONTROL_BATCH_SIZE, CONTROL_URL_PATH,
+                                      END_CMD, ERROR_CMD, LOOP_CMD, OK_CMD, OP_DELETE, OP_DESTROY, PROBE_CMD,
+                                      SYNC_ERROR_CMD, LineBuffer, add_table_params, parse_control_response)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+# seconds to wait for a connection to the Lightstreamer server
+CONNECT_TIMEOUT = 10
+
+
+class SubscriptionUpdates(object):
+    """Async iterator over the updates of a Subscription, ending when it is unsubscribed, the
+    session closes or it is closed. With a maxsize, the oldest update is dropped when the consumer
+    falls behind"""
+
+    def __init__(self, maxsize=0, subscription=None):
+        self._queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+        self._subscription = subscription
+        if subscription is not None:
+            subscription.addlistener(self.put)
+
+    def put(self, item_update):
+        """Subscription listener"""
+        if not self.closed:
+            self._push(item_update)
+
+    def _push(self, item_update):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item_update)
+
+    def close(self):
+        """Ends the iteration, once the updates already received are consumed, and stops listening
+        to the subscription"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._subscription is not None:
+            self._subscription.removelistener(self.put)
+            self._subscription = None
+        self._push(None)
+
+    async def aclose(self):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item_update = await self._queue.get()
+        if item_update is None:
+            # ended for good, later calls end straight away too
+            self._queue.put_nowait(None)
+            raise StopAsyncIteration
+        return item_update
+
+
+class AsyncLSClient(object):
+    """Asyncio twin of lightstreamer.LSClient"""
+
+    def __init__(self, base_url, adapter_set="", user="", password="", session=None):
+        """
+        :param base_url: Lightstreamer endpoint, as returned when logging in
+        :type base_url: str
+        :param session: aiohttp session to use, e.g. shared with the REST client. Optional, by
+            default the client creates (and closes) its own
+        :type session: aiohttp.ClientSession
+        """
+        if aiohttp is None:
+            raise IGException("The asyncio Lightstreamer client requires the 'aiohttp' package")
+        self._base_url = parse_url(base_url)
+        self._control_url = self._base_url
+        self._adapter_set = adapter_set
+        self._user = user
+        self._password = password
+        self._http = session
+        self._own_http = session is None
+        self._session = {}
+        self._subscriptions = {}
+        # id of a Subscription -> its SubscriptionUpdates
+        self._updates = {}
+        self._current_subscription_key = 0
+        self._stream = None
+        self._lines = None
+        self._pending = []
+        self._receive_task = None
+        self._bind_counter = 0
+        self.content_length = 1000000000
+        # as LSClient.counters
+        self.counters = Counter()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    def _http_session(self):
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT))
+        return self._http
+
+    async def _call(self, base_url, url, params):
+        """POSTs the non empty params to url, relative to base_url"""
+        data = {k: str(v) for k, v in params.items() if v}
+        return await self._http_session().post(urljoin(base_url.geturl(), url), data=data)
+
+    def _set_control_link_url(self, custom_address=None):
+        if custom_address is None:
+            self._control_url = self._base_url
+        else:
+            parsed_custom_address = parse_url("//" + custom_address)
+            self._control_url = parsed_custom_address._replace(scheme=self._base_url[0])
+
+    async def _control(self, params):
+        """Sends a control request, and returns the response"""
+        return (await self._control_batch([params]))[0]
+
+    async def _control_batch(self, requests):
+        """Sends control requests batched in single POSTs, see LSClient._control_batch, and returns the
+        response to each one, in order. The aiohttp session keeps the connection alive"""
+        url = urljoin(self._control_url.geturl(), CONTROL_URL_PATH)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        responses = []
+        for i in range(0, len(requests), CONTROL_BATCH_SIZE):
+            batch = requests[i:i + CONTROL_BATCH_SIZE]
+            body = "\r\n".join(
+                urlencode({k: v for k, v in dict(params, LS_session=self._session["SessionId"]).items() if v})
+                for params in batch)
+            async with self._http_session().post(url, data=body.encode("utf-8"), headers=headers) as response:
+                batch_responses = parse_control_response(await response.text())
+            batch_responses += [ERROR_CMD] * (len(batch) - len(batch_responses))
+            responses.extend(batch_responses)
+        return responses
+
+    async def _read_lines(self):
+        """Lines received so far on the stream connection, at least one. [] at the end of stream"""
+        if self._pending:
+            lines, self._pending = self._pending, []
+            return lines
+        while True:
+            chunk = await self._stream.content.readany()
+            if not chunk:
+                return self._lines.flush()
+            lines = self._lines.feed(chunk)
+            if lines:
+                return lines
+
+    async def _read_line(self):
+        if not self._pending:
+            self._pending = await self._read_lines()
+            if not self._pending:
+                return ""
+        return self._pending.pop(0)
+
+    async def _open_stream(self, base_url, url, params):
+        """Opens a stream connection, reads the session details and starts receiving updates"""
+        self._stream = await self._call(base_url, url, params)
+        self._lines = LineBuffer()
+        self._pending = []
+        stream_line = await self._read_line()
+        if stream_line != OK_CMD:
+            lines = [stream_line] + self._pending + self._lines.flush()
+            self._close_stream()
+            log.error("Server response error: \n%s", "\n".join(lines))
+            raise IOError("Server response error: {0}".format(" ".join(lines)))
+        while True:
+            line = await self._read_line()
+            if not line:
+                break
+            session_key, session_value = line.split(":", 1)
+            self._session[session_key] = session_value
+        self._set_control_link_url(self._session.get("ControlAddress"))
+        self._receive_task = asyncio.ensure_future(self._receive())
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    async def connect(self):
+        """Creates a new session"""
+        await self._open_stream(self._base_url, CONNECTION_URL_PATH, {
+            "LS_op2": "create",
+            "LS_cid": "mgQkwtwdysogQz2BJ4Ji kOj2Bg",
+            "LS_adapter_set": self._adapter_set,
+            "LS_user": self._user,
+            "LS_password": self._password,
+            "LS_content_length": self.content_length,
+        })
+
+    async def bind(self):
+        """Opens a new stream connection for the current session"""
+        self._bind_counter += 1
+        await self._open_stream(self._control_url, BIND_URL_PATH, {
+            "LS_session": self._session["SessionId"],
+            "LS_content_length": self.content_length,
+        })
+
+    async def _receive(self):
+        rebind = False
+        receive = True
+        counters = self.counters
+        while receive:
+            try:
+                messages = await self._read_lines()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.error("Communication error: %s", e)
+                messages = None
+            if not messages:
+                log.warning("No new message received")
+                break
+
+            counters["reads"] += 1
+            for message in messages:
+                counters["messages"] += 1
+                if message[:1].isdigit():
+                    counters["updates"] += 1
+                    self._forward_update_message(message)
+                elif message == PROBE_CMD:
+                    counters["probes"] += 1
+                elif message.startswith(ERROR_CMD):
+                    counters["errors"] += 1
+                    log.error("ERROR")
+                    receive = False
+                elif message.startswith(LOOP_CMD):
+                    # content length reached, the session goes on with a new stream connection
+                    counters["loops"] += 1
+                    rebind = True
+                    receive = False
+                elif message.startswith(SYNC_ERROR_CMD):
+                    counters["errors"] += 1
+                    log.error("SYNC ERROR")
+                    receive = False
+                elif message.startswith(END_CMD):
+                    log.info("Connection closed by the server")
+                    receive = False
+                elif message and not message.startswith("Preamble"):
+                    self._forward_update_message(message)
+                if not receive:
+                    break
+
+        self._close_stream()
+        if rebind:
+            log.debug("Binding to this active session")
+            try:
+                await self.bind()
+            except (IOError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # nothing left to receive from, end the update iterators rather than leave them waiting
+                log.error("Rebind failed: %s", e)
+                self._close_stream()
+                self._end_session()
+        else:
+            self._end_session()
+
+    def _forward_update_message(self, update_message):
+        table, item = update_message.split(",", 1)
+        subscription = self._subscriptions.get(int(table))
+        if subscription is not None:
+            subscription.notifyupdate(item)
+        else:
+            self.counters["unknown_table"] += 1
+            log.warning("No subscription found for table %s!", table)
+
+    def _end_session(self):
+        """Clears the session, and ends the update iterators"""
+        for updates in self._updates.values():
+            updates.close()
+        self._updates.clear()
+        self._session.clear()
+        self._subscriptions.clear()
+        self._current_subscription_key = 0
+
+    def updates(self, subscription, maxsize=0):
+        """
+        Returns an async iterator over the updates of a subscription. Get it before subscribing, not
+        to miss the snapshot. Closing the iterator stops it listening to the subscription, a later
+        call returns a new one
+        :param subscription: subscription to iterate over
+        :type subscription: trading_ig.lightstreamer.Subscription
+        :param maxsize: updates kept for a consumer that falls behind, oldest dropped first. Default
+            no limit
+        :type maxsize: int
+        :rtype: SubscriptionUpdates
+        """
+        updates = self._updates.get(id(subscription))
+        if updates is None or updates.closed:
+            updates = self._updates[id(subscription)] = SubscriptionUpdates(maxsize, subscription)
+        return updates
+
+    async def subscribe(self, subscription):
+        """Subscribes, see LSClient.subscribe"""
+        return (await self.subscribe_many([subscription]))[0]
+
+    async def subscribe_many(self, subscriptions):
+        """Subscribes with batched control requests, see LSClient.subscribe_many"""
+        keys = []
+        for subscription in subscriptions:
+            self._current_subscription_key += 1
+            self._subscriptions[self._current_subscription_key] = subscription
+            keys.append(self._current_subscription_key)
+        requests = [add_table_params(key, subscription) for key, subscription in zip(keys, subscriptions)]
+        for key, server_response in zip(keys, await self._control_batch(requests)):
+            if server_response != OK_CMD:
+                log.warning("Subscription of table %s failed: %s", key, server_response)
+        return keys
+
+    async def unsubscribe(self, subscription_key):
+        """Unsubscribes, see LSClient.unsubscribe. The update iterator of the subscription ends"""
+        await self.unsubscribe_many([subscription_key])
+
+    async def unsubscribe_many(self, subscription_keys):
+        """Unsubscribes with batched control requests, see LSClient.unsubscribe_many"""
+        keys = [key for key in subscription_keys if key in self._subscriptions]
+        for key in set(subscription_keys) - set(keys):
+            log.warning("No subscription key %s found!", key)
+        if not keys:
+            return
+        server_responses = await self._control_batch([{"LS_Table": key, "LS_op": OP_DELETE} for key in keys])
+        for key, server_response in zip(keys, server_responses):
+            if server_response == OK_CMD:
+                # the session may have ended, and taken the subscription with it, meanwhile
+                subscription = self._subscriptions.pop(key, None)
+                updates = self._updates.pop(id(subscription), None)
+                if updates is not None:
+                    updates.close()
+            else:
+                log.warning("Server error unsubscribing table %s: %s", key, server_response)
+
+    async def wait_closed(self):
+        """Waits until the session ends"""
+        while self._receive_task is not None and not self._receive_task.done():
+            # a rebind replaces the task
+            await asyncio.shield(self._receive_task)
+
+    async def destroy(self):
+        """Ends the session on the server, see LSClient.destroy"""
+        if self._stream is not None:
+            server_response = await self._control({"LS_op": OP_DESTROY})
+            if server_response == OK_CMD:
+                await self.wait_closed()
+            else:
+                log.warning("No connection to Lightstreamer")
+
+    async def disconnect(self):
+        """Closes the stream connection, and the aiohttp session if the client created it"""
+        task, self._receive_task = self._receive_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._close_stream()
+        self._end_session()
+        if self._own_http and self._http is not None:
+            await self._http.close()
+            self._http = None
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Bulk historical price backfill
+
+Splits (epic, resolution, date range) jobs into chunks of a bounded number of data points and
+fetches them across a worker pool with IGService.fetch_historical_prices_by_epic. Requests are paced
+by the session rate limiter, which also keeps track of the weekly historical data allowance.
+"""
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from trading_ig.Exceptions import AllowanceExhaustedException
+from trading_ig.utils import conv_resol
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# finest resolution of the dates in a request
+ONE_SECOND = timedelta(seconds=1)
+
+# approximate bar length per IG resolution, used to size chunks and estimate allowance usage
+RESOLUTION_STEPS = {
+    "SECOND": timedelta(seconds=1),
+    "MINUTE": timedelta(minutes=1),
+    "MINUTE_2": timedelta(minutes=2),
+    "MINUTE_3": timedelta(minutes=3),
+    "MINUTE_5": timedelta(minutes=5),
+    "MINUTE_10": timedelta(minutes=10),
+    "MINUTE_15": timedelta(minutes=15),
+    "MINUTE_30": timedelta(minutes=30),
+    "HOUR": timedelta(hours=1),
+    "HOUR_2": timedelta(hours=2),
+    "HOUR_3": timedelta(hours=3),
+    "HOUR_4": timedelta(hours=4),
+    "DAY": timedelta(days=1),
+    "WEEK": timedelta(weeks=1),
+    "MONTH": timedelta(days=31),
+}
+
+BackfillJob = namedtuple("BackfillJob", ["epic", "resolution", "start_date", "end_date"])
+BackfillJob.__doc__ = """Historical prices to fetch for one epic, resolution and date range"""
+
+BackfillChunk = namedtuple("BackfillChunk", ["job_index", "chunk_index", "start_date", "end_date"])
+
+BackfillResult = namedtuple("BackfillResult", ["job", "prices", "failed_chunks"])
+BackfillResult.__doc__ = """Prices for a job, in time order. failed_chunks lists (chunk, exception)
+for the chunks that could not be fetched, so a job can be partially complete"""
+
+BackfillProgress = namedtuple("BackfillProgress", [
+    "chunks_total",
+    "chunks_done",
+    "chunks_failed",
+    "points_fetched",
+    "remaining_allowance",
+    "allowance_expiry",
+])
+
+
+def resolution_step(resolution):
+    """Returns the approximate length of one bar at the given resolution"""
+    try:
+        return RESOLUTION_STEPS[conv_resol(resolution)]
+    except KeyError:
+        raise ValueError("Unsupported resolution '%s'" % resolution)
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+class HistoricalBackfill(object):
+    """Backfills historical prices for many epics under the historical data allowance"""
+
+    def __init__(
+            self,
+            ig_service,
+            max_workers=4,
+            chunk_points=1000,
+            max_retries=3,
+            retry_delay=2,
+            progress_callback=None):
+        """
+        :param ig_service: logged in IGService
+        :type ig_service: trading_ig.IGService
+        :param max_workers: maximum number of chunks fetched at the same time
+        :type max_workers: int
+        :param chunk_points: maximum number of data points per request
+        :type chunk_points: int
+        :param max_retries: how many times a failed chunk is retried
+        :type max_retries: int
+        :param retry_delay: seconds to wait before the first retry, doubled on every retry
+        :type retry_delay: float
+        :param progress_callback: called with a BackfillProgress after every chunk. Optional
+        :type progress_callback: function
+        """
+        self.ig_service = ig_service
+        self.max_workers = max_workers
+        self.chunk_points = chunk_points
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.progress_callback = progress_callback
+        self.remaining_allowance = None
+        self.allowance_expiry = None
+
+    def split(self, job, job_index=0):
+        """
+        Splits a job into chunks of at most chunk_points bars. Each chunk ends a second before the
+        next one starts, so no bar is left out when the start date isn't on a bar boundary
+        :return: list of BackfillChunk
+        """
+        step = resolution_step(job.resolution)
+        start = _to_datetime(job.start_date)
+        end = _to_datetime(job.end_date)
+        span = step * self.chunk_points
+        chunks = []
+        while start <= end:
+            chunk_end = min(start + span - ONE_SECOND, end)
+            chunks.append(BackfillChunk(job_index, len(chunks), start, chunk_end))
+            start = chunk_end + ONE_SECOND
+        return chunks
+
+    @staticmethod
+    def estimate_points(jobs):
+        """
+        Upper bound of the historical data points needed for the given jobs (market closures make
+        the actual number lower), to plan jobs against the weekly allowance
+        """
+        points = 0
+        for job in jobs:
+            span = _to_datetime(job.end_date) - _to_datetime(job.start_date)
+            points += int(span / resolution_step(job.resolution)) + 1
+        return points
+
+    def plan(self, jobs):
+        """
+        Compares the points needed for jobs with the remaining allowance, as known to the session
+        rate limiter (or from the last backfill)
+        :return: estimated points needed and remaining allowance (None if unknown)
+        :rtype: tuple
+        """
+        remaining = self.remaining_allowance
+        rate_limiter = getattr(self.ig_service.crud_session, "rate_limiter", None)
+        if remaining is None and rate_limiter is not None:
+            remaining = rate_limiter.historical_allowance
+        return self.estimate_points(jobs), remaining
+
+    def expected_points(self, job, chunk):
+        """Upper bound of the data points in a chunk"""
+        span = chunk.end_date - chunk.start_date
+        return min(self.chunk_points, int(span / resolution_step(job.resolution)) + 1)
+
+    def _fetch_chunk(self, job, chunk):
+        rate_limiter = getattr(self.ig_service.crud_session, "rate_limiter", None)
+        if rate_limiter is not None:
+            # a date range request only reserves a single point, so the chunk's points are taken
+            # from the allowance up front, before the request goes out
+            rate_limiter.reserve_historical(self.expected_points(job, chunk))
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.ig_service.fetch_historical_prices_by_epic(
+                    job.epic,
+                    resolution=job.resolution,
+                    start_date=chunk.start_date.strftime(DATE_FORMAT),
+                    end_date=chunk.end_date.strftime(DATE_FORMAT),
+                    pagesize=0,
+                )
+            except AllowanceExhaustedException:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Backfill {job.epic} chunk {chunk.chunk_index} failed ({e}), "
+                               f"retrying in {delay} seconds")
+                time.sleep(delay)
+                delay *= 2
+
+    def _report(self, chunks_total, chunks_done, chunks_failed, points_fetched):
+        if self.progress_callback is not None:
+            self.progress_callback(BackfillProgress(
+                chunks_total, chunks_done, chunks_failed, points_fetched,
+                self.remaining_allowance, self.allowance_expiry))
+
+    def run(self, jobs):
+        """
+        Backfills the given jobs, yielding a BackfillResult for each job as soon as all of its
+        chunks are done. Once the historical allowance is exhausted, outstanding chunks are
+        reported as failed rather than waiting for the weekly reset
+        :param jobs: jobs to run
+        :type jobs: list of BackfillJob or (epic, resolution, start_date, end_date) tuples
+        """
+        for _, result in self.run_indexed(jobs):
+            yield result
+
+    def run_indexed(self, jobs):
+        """
+        Same as run, yielding (index of the job in jobs, BackfillResult) pairs, which tell apart
+        identical jobs
+        """
+        jobs = [BackfillJob(*job) for job in jobs]
+        chunks = [chunk for index, job in enumerate(jobs) for chunk in self.split(job, index)]
+        pending = {index: 0 for index in range(len(jobs))}
+        for chunk in chunks:
+            pending[chunk.job_index] += 1
+        prices = {index: {} for index in range(len(jobs))}
+        failed = {index: [] for index in range(len(jobs))}
+
+        needed, remaining = self.plan(jobs)
+        logger.info(f"Backfilling {len(jobs)} jobs in {len(chunks)} chunks, up to {needed} points "
+                    f"(remaining allowance: {remaining})")
+
+        chunks_done = 0
+        chunks_failed = 0
+        points_fetched = 0
+        exhausted = None
+
+        # jobs without any chunk (empty date range) are complete straight away
+        for index in [index for index, count in pending.items() if count == 0]:
+            yield index, BackfillResult(jobs[index], [], [])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for chunk in chunks:
+                futures[executor.submit(self._fetch_chunk, jobs[chunk.job_index], chunk)] = chunk
+
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    data = future.result()
+                except CancelledError:
+                    failed[chunk.job_index].append((chunk, exhausted))
+                    chunks_failed += 1
+                except Exception as e:
+                    if isinstance(e, AllowanceExhaustedException) and exhausted is None:
+                        logger.warning(f"Historical data allowance exhausted, cancelling outstanding chunks: {e}")
+                        exhausted = e
+                        for other in futures:
+                            other.cancel()
+                    failed[chunk.job_index].append((chunk, e))
+                    chunks_failed += 1
+                else:
+                    for price in data["prices"]:
+                        key = price.get("snapshotTimeUTC", price.get("snapshotTime"))
+                        prices[chunk.job_index][key] = price
+                    points_fetched += len(data["prices"])
+                    if "metadata" in data and "allowance" in data["metadata"]:
+                        self.remaining_allowance, self.allowance_expiry = \
+                            self.ig_service.log_allowance(data["metadata"])
+                chunks_done += 1
+                self._report(len(chunks), chunks_done, chunks_failed, points_fetched)
+
+                pending[chunk.job_index] -= 1
+                if pending[chunk.job_index] == 0:
+                    job_prices = [prices[chunk.job_index][key] for key in sorted(prices[chunk.job_index])]
+                    del prices[chunk.job_index]
+                    yield chunk.job_index, BackfillResult(jobs[chunk.job_index], job_prices, failed[chunk.job_index])
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Deal confirmations from the Lightstreamer TRADE subscription
+
+IG pushes deal confirmations (CONFIRMS) and open position updates (OPU) on the 'TRADE:<account>'
+item as soon as a deal is processed. DealConfirmationRegistry subscribes to it and hands them out by
+deal reference, so confirming a deal takes one streamed update instead of polling '/confirms'.
+Updates that arrive before anyone asks for them are kept, since the stream is often faster than
+the REST call that returned the deal reference.
+
+    registry = ig_stream_service.enable_deal_confirmations()
+    ig_service.create_open_position(...)   # now waits on the stream, REST only on timeout
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, TimeoutError
+
+from trading_ig.lightstreamer import BLOCK, Subscription
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for a streamed confirmation before falling back to REST
+CONFIRM_STREAM_TIMEOUT = 2
+# updates nobody has asked for yet, kept per kind (oldest dropped first)
+MAX_BUFFERED = 1000
+
+CONFIRMS = "CONFIRMS"
+OPU = "OPU"
+TRADE_FIELDS = [CONFIRMS, OPU, "WOU"]
+
+
+class DealConfirmationRegistry(object):
+    """Futures for deal confirmations and open position updates, resolved from the TRADE stream"""
+
+    def __init__(self, ls_client, acc_number, timeout=CONFIRM_STREAM_TIMEOUT):
+        """
+        :param ls_client: connected Lightstreamer client
+        :type ls_client: trading_ig.lightstreamer.LSClient
+        :param acc_number: account whose deals are confirmed
+        :type acc_number: str
+        :param timeout: default seconds to wait for a streamed update
+        :type timeout: float
+        """
+        self.ls_client = ls_client
+        self.acc_number = acc_number
+        self.timeout = timeout
+        self.subscription_key = None
+        self._lock = threading.Lock()
+        # (kind, key) -> Future
+        self._futures = {}
+        # kind -> {key: update} for updates nobody was waiting for
+        self._buffered = {CONFIRMS: OrderedDict(), OPU: OrderedDict()}
+        # Lightstreamer repeats the previous value of a field that hasn't changed
+        self._last_raw = {}
+
+    @property
+    def active(self):
+        return self.subscription_key is not None
+
+    def start(self):
+        """Subscribes to the TRADE item of the account"""
+        subscription = Subscription(
+            mode="DISTINCT",
+            items=["TRADE:" + self.acc_number],
+            fields=TRADE_FIELDS,
+        )
+        subscription.addlistener(self.on_trade_update)
+        dispatcher = getattr(self.ls_client, "dispatcher", None)
+        if dispatcher is not None:
+            # every confirmation counts, none may be dropped or conflated
+            dispatcher.register(subscription, overflow=BLOCK)
+        self.subscription_key = self.ls_client.subscribe(subscription)
+        logger.info(f"Listening for deal confirmations on TRADE:{self.acc_number}")
+        return self.subscription_key
+
+    def stop(self):
+        """Unsubscribes, and fails every pending wait over to REST"""
+        if self.subscription_key is not None:
+            self.ls_client.unsubscribe(self.subscription_key)
+            self.subscription_key = None
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future in futures:
+            future.cancel()
+
+    def on_trade_update(self, item_update):
+        """Subscription listener, resolves the futures waiting for the updates in a TRADE event"""
+        for kind, key_field in ((CONFIRMS, "dealReference"), (OPU, "dealId")):
+            raw = item_update.value(kind)
+            if not raw or raw == self._last_raw.get(kind):
+                continue
+            self._last_raw[kind] = raw
+            try:
+                update = json.loads(raw)
+            except ValueError:
+                logger.warning(f"Unreadable {kind} update: {raw}")
+                continue
+            self._resolve(kind, update.get(key_field), update)
+            if kind == OPU and update.get("dealReference"):
+                # positions can be awaited by deal reference too, e.g. before the deal id is known
+                self._resolve(kind, update["dealReference"], update)
+
+    def _resolve(self, kind, key, update):
+        if key is None:
+            return
+        with self._lock:
+            future = self._futures.pop((kind, key), None)
+            if future is None:
+                buffered = self._buffered[kind]
+                buffered[key] = update
+                if len(buffered) > MAX_BUFFERED:
+                    buffered.popitem(last=False)
+                return
+        logger.debug(f"{kind} for {key} received")
+        if future.set_running_or_notify_cancel():
+            future.set_result(update)
+
+    def future(self, key, kind=CONFIRMS):
+        """
+        Returns a future resolved with the next update for a deal
+        :param key: deal reference (CONFIRMS), or deal id or deal reference (OPU)
+        :type key: str
+        :param kind: CONFIRMS or OPU
+        :type kind: str
+        :rtype: concurrent.futures.Future
+        """
+        with self._lock:
+            update = self._buffered[kind].pop(key, None)
+            if update is None:
+                return self._futures.setdefault((kind, key), Future())
+        future = Future()
+        future.set_result(update)
+        return future
+
+    def _forget(self, kind, key, future):
+        with self._lock:
+            if self._futures.get((kind, key)) is future:
+                del self._futures[(kind, key)]
+
+    def wait(self, key, timeout=None, kind=CONFIRMS):
+        """
+        Waits for the update of a deal
+        :param timeout: seconds to wait, default the registry timeout
+        :type timeout: float
+        :return: the streamed update, parsed, or None if it didn't arrive in time
+        :rtype: dict
+        """
+        future = self.future(key, kind)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except (TimeoutError, CancelledError):
+            self._forget(kind, key, future)
+            return None
+
+    async def wait_async(self, key, timeout=None, kind=CONFIRMS):
+        """Coroutine counterpart of wait"""
+        future = self.future(key, kind)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self._forget(kind, key, future)
+            return None
+        except asyncio.CancelledError:
+            # stop() cancels pending futures, anything else is the caller being cancelled
+            if not future.cancelled():
+                raise
+            return None
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Latency sensitive dealing helpers
+
+OrderTemplate serialises the fields that stay the same from one order to the next (epic, currency,
+order type, ...) once, so that placing an order only encodes the few fields that change.
+
+confirm_poll_delays drives the polling of '/confirms': most deals are confirmed within a few hundred
+milliseconds, so the first polls are close together and the delay only grows if the confirmation
+takes longer.
+
+BatchOrder and BatchResult are the input and output of IGService.execute_orders, which deals many
+orders at once.
+"""
+import json
+from collections import namedtuple
+
+# seconds before the first confirmation poll is repeated, the longest delay between polls, and how
+# long to keep polling before giving up
+CONFIRM_POLL_INITIAL = 0.05
+CONFIRM_POLL_MAX = 0.5
+CONFIRM_TIMEOUT = 5
+
+# create_open_position arguments and the IG field they are sent as
+POSITION_FIELDS = {
+    "currency_code": "currencyCode",
+    "direction": "direction",
+    "epic": "epic",
+    "expiry": "expiry",
+    "force_open": "forceOpen",
+    "guaranteed_stop": "guaranteedStop",
+    "level": "level",
+    "limit_distance": "limitDistance",
+    "limit_level": "limitLevel",
+    "order_type": "orderType",
+    "quote_id": "quoteId",
+    "size": "size",
+    "stop_distance": "stopDistance",
+    "stop_level": "stopLevel",
+    "trailing_stop": "trailingStop",
+    "trailing_stop_increment": "trailingStopIncrement",
+}
+
+
+# close_open_position arguments and the IG field they are sent as
+CLOSE_FIELDS = {
+    "deal_id": "dealId",
+    "direction": "direction",
+    "epic": "epic",
+    "expiry": "expiry",
+    "level": "level",
+    "order_type": "orderType",
+    "quote_id": "quoteId",
+    "size": "size",
+}
+
+OPEN = "open"
+CLOSE = "close"
+
+BatchOrder = namedtuple("BatchOrder", ["action", "params"])
+BatchOrder.__doc__ = """One order of a batch: action is OPEN or CLOSE, params the keyword arguments of
+create_open_position or close_open_position. Arguments left out are sent as null"""
+
+BatchResult = namedtuple("BatchResult", ["order", "deal_reference", "confirmation", "error"])
+BatchResult.__doc__ = """Outcome of a BatchOrder. error is the exception raised while submitting or
+confirming the order, or None. A deal IG rejected has a confirmation with dealStatus 'REJECTED'"""
+
+
+def open_order(**params):
+    """BatchOrder opening a position, with the create_open_position arguments"""
+    return BatchOrder(OPEN, params)
+
+
+def close_order(**params):
+    """BatchOrder closing a position, with the close_open_position arguments"""
+    return BatchOrder(CLOSE, params)
+
+
+def batch_request(order):
+    """
+    Returns the HTTP method, endpoint, version and body of a BatchOrder
+    :rtype: tuple
+    """
+    if order.action == OPEN:
+        fields, method, version = POSITION_FIELDS, "POST", "2"
+    elif order.action == CLOSE:
+        fields, method, version = CLOSE_FIELDS, "DELETE", "1"
+    else:
+        raise ValueError(f"Unknown order action '{order.action}'")
+    unknown = set(order.params) - set(fields)
+    if unknown:
+        raise TypeError(f"Unknown {order.action} order fields {sorted(unknown)}")
+    body = {field: order.params.get(name) for name, field in fields.items()}
+    return method, "/positions/otc", version, body
+
+
+def confirm_poll_delays(timeout=CONFIRM_TIMEOUT, initial=CONFIRM_POLL_INITIAL, maximum=CONFIRM_POLL_MAX):
+    """
+    Yields the delays between polls for a deal confirmation, doubling from initial up to maximum,
+    until their total would exceed timeout
+    """
+    elapsed = 0
+    delay = initial
+    while elapsed + delay <= timeout:
+        yield delay
+        elapsed += delay
+        delay = min(delay * 2, maximum)
+
+
+class OrderTemplate(object):
+    """
+    Request body for IGService.create_open_position with its static fields serialised up front
+
+        template = OrderTemplate(epic='CS.D.EURUSD.MINI.IP', currency_code='USD', expiry='-',
+                                 order_type='MARKET', force_open=True, guaranteed_stop=False)
+        ig_service.create_open_position_from_template(template, direction='BUY', size=1)
+
+    Fields that are neither given to the template nor when rendering it are sent as null, as
+    create_open_position does.
+    """
+
+    def __init__(self, **fields):
+        """
+        :param fields: static fields, named as the create_open_position arguments
+        """
+        self.static = self._to_ig(fields)
+        self.dynamic = [name for name in POSITION_FIELDS if name not in fields]
+        body = dict(self.static)
+        for name in self.dynamic:
+            body[POSITION_FIELDS[name]] = None
+        self._static_json = json.dumps(self.static)
+        self._null_json = json.dumps(body)
+
+    @staticmethod
+    def _to_ig(fields):
+        try:
+            return {POSITION_FIELDS[name]: value for name, value in fields.items()}
+        except KeyError as e:
+            raise TypeError(f"Unknown order field {e}")
+
+    def render(self, **fields):
+        """
+        Returns the JSON body of an order
+        :param fields: values of the dynamic fields, named as the create_open_position arguments
+        :rtype: str
+        """
+        if not fields:
+            return self._null_json
+        dynamic = {}
+        for name in self.dynamic:
+            dynamic[POSITION_FIELDS[name]] = fields.pop(name, None)
+        if fields:
+            raise TypeError(f"Fields {sorted(fields)} are static in this template or unknown")
+        if not self.static:
+            return json.dumps(dynamic)
+        # splice the dynamic fields into the pre-serialised static ones
+        return self._static_json[:-1] + ", " + json.dumps(dynamic)[1:]
@@ -14,13 +14,21 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import asyncio
+import base64
 import logging
+import random
 import threading
+import time
 import traceback
 import sys
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from six.moves import http_client
+from six.moves.queue import Queue
 
-from six.moves.urllib.request import urlopen as _urlopen
-from six.moves.urllib.parse import urlparse as parse_url, urljoin, urlencode
+from six.moves.urllib.request import getproxies, proxy_bypass, urlopen as _urlopen
+from six.moves.urllib.parse import urlparse as parse_url, unquote, urljoin, urlencode
 
 try:
     from systemd.daemon import notify
@@ -36,6 +44,36 @@ def _iteritems(d):
     return iter(d.items())
 
 
+def add_table_params(table, subscription):
+    """Parameters of the control request subscribing to a table."""
+    return {
+        "LS_Table": table,
+        "LS_op": OP_ADD,
+        "LS_data_adapter": subscription.adapter,
+        "LS_mode": subscription.mode,
+        "LS_schema": " ".join(subscription.field_names),
+        "LS_id": " ".join(subscription.item_names),
+    }
+
+
+def parse_control_response(text):
+    """Split the response to a batch of control requests into the
+    responses to each request, in order. An error takes three lines,
+    ERROR then its code and message, and is returned as one.
+    """
+    lines = [line for line in text.replace("\r\n", "\n").split("\n") if line]
+    responses = []
+    i = 0
+    while i < len(lines):
+        if lines[i] == ERROR_CMD:
+            responses.append(" ".join(lines[i:i + 3]))
+            i += 3
+        else:
+            responses.append(lines[i])
+            i += 1
+    return responses
+
+
 CONNECTION_URL_PATH = "lightstreamer/create_session.txt"
 BIND_URL_PATH = "lightstreamer/bind_session.txt"
 CONTROL_URL_PATH = "lightstreamer/control.txt"
@@ -53,22 +91,109 @@ ERROR_CMD = "ERROR"
 SYNC_ERROR_CMD = "SYNC ERROR"
 OK_CMD = "OK"
 
+# Seconds between systemd watchdog notifications while receiving
+WATCHDOG_INTERVAL = 1
+# Messages between checks of the logging level in the receive loop
+LOG_LEVEL_CHECK_INTERVAL = 4096
+# Bytes read from the stream connection at a time
+STREAM_CHUNK_SIZE = 65536
+
+# Dispatcher overflow policies, for when a subscription queue is full.
+# Wait for room in the queue, holding up the stream connection.
+BLOCK = "block"
+# Discard the oldest update in the queue.
+DROP_OLDEST = "drop_oldest"
+# Queue at most one update per item, a newer update replacing the
+# queued one.
+CONFLATE = "conflate"
+# Updates queued per subscription, and delivered by a worker in a row
+DISPATCH_QUEUE_SIZE = 10000
+DISPATCH_BATCH_SIZE = 100
+# Control requests sent together in a single POST
+CONTROL_BATCH_SIZE = 100
+# Seconds before the first attempt to recover a lost session, and the
+# longest wait between attempts as the delay doubles
+RECOVERY_INITIAL_DELAY = 0.5
+RECOVERY_MAX_DELAY = 60
+
 log = logging.getLogger(__name__)
 
 
+class ItemUpdate(Mapping):
+    """Event passed to Subscription listeners.
+
+    Reads like the {"pos", "name", "values"} dict listeners have always
+    received, but the "values" dict is only built if it is asked for.
+    Listeners on the hot path can read fields straight from the
+    field_values tuple, or with value(field), without any allocation.
+    """
+
+    __slots__ = ("pos", "name", "field_names", "field_values", "_index", "_values")
+
+    _KEYS = ("pos", "name", "values")
+
+    def __init__(self, pos, name, field_names, field_values, index):
+        self.pos = pos
+        self.name = name
+        self.field_names = field_names
+        # Values of all the fields, in field_names order, as of this update
+        self.field_values = field_values
+        self._index = index
+        self._values = None
+
+    @property
+    def values(self):
+        """Field values by field name, built on first access."""
+        if self._values is None:
+            self._values = dict(zip(self.field_names, self.field_values))
+        return self._values
+
+    def value(self, field):
+        """Value of a single field."""
+        return self.field_values[self._index[field]]
+
+    def __getitem__(self, key):
+        if key == "values":
+            values = self._values
+            if values is None:
+                values = self._values = dict(zip(self.field_names, self.field_values))
+            return values
+        if key == "pos":
+            return self.pos
+        if key == "name":
+            return self.name
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    def __repr__(self):
+        return "ItemUpdate(pos={0}, name={1!r}, values={2!r})".format(
+            self.pos, self.name, self.values)
+
+
 class Subscription(object):
     """Represents a Subscription to be submitted to a Lightstreamer Server."""
 
     def __init__(self, mode, items, fields, adapter=""):
         self.item_names = items
+        # Item position -> list of the current field values, in field order
         self._items_map = {}
         self.field_names = fields
+        self._field_count = len(fields)
+        self._field_index = dict((field, i) for i, field in enumerate(fields))
         self.adapter = adapter
         self.mode = mode
         self.snapshot = "true"
         self._listeners = []
+        # Set when the updates are handed to a Dispatcher
+        self._queue = None
 
-    def _decode(self, value, last):
+    @staticmethod
+    def _decode(value, last):
         """Decode the field value according to
         Lightstremar Text Protocol specifications.
         """
@@ -86,42 +211,613 @@ class Subscription(object):
     def addlistener(self, listener):
         self._listeners.append(listener)
 
+    def removelistener(self, listener):
+        # a new list, not to upset a thread delivering updates to the
+        # listeners meanwhile
+        self._listeners = [registered for registered in self._listeners
+                           if registered != listener]
+
+    def _update_item(self, item_line):
+        """Apply an item line to the state of its item, in place,
+        and return the item position.
+        """
+        # Tokenize the item line as sent by Lightstreamer
+        toks = item_line.rstrip("\r\n").split("|", self._field_count)
+        item_pos = int(toks[0])
+        state = self._items_map.get(item_pos)
+        if state is None:
+            state = self._items_map[item_pos] = [None] * self._field_count
+
+        decode = self._decode
+        index = 0
+        for value in toks[1:]:
+            # Unchanged fields come as empty strings and keep their
+            # value, skipped without a call to _decode
+            if value:
+                if value[0] == "^" and value[1:].isdigit():
+                    # ^N, a run of N unchanged fields
+                    index += int(value[1:])
+                    continue
+                state[index] = decode(value, state[index])
+            index += 1
+        return item_pos
+
+    def item_update(self, item_pos):
+        """Make an event, to be passed to listeners, with the current
+        values of an item.
+        """
+        return ItemUpdate(
+            item_pos,
+            self.item_names[item_pos - 1],
+            self.field_names,
+            tuple(self._items_map[item_pos]),
+            self._field_index,
+        )
+
     def notifyupdate(self, item_line):
         """Invoked by LSClient each time Lightstreamer Server pushes
         a new item event.
         """
-        # Tokenize the item line as sent by Lightstreamer
-        toks = item_line.rstrip("\r\n").split("|")
-        undecoded_item = dict(list(zip(self.field_names, toks[1:])))
+        item_pos = self._update_item(item_line)
+        if self._listeners:
+            item_info = self.item_update(item_pos)
+            if self._queue is not None:
+                self._queue.put(item_info)
+                return
 
-        # Retrieve the previous item stored into the map, if present.
-        # Otherwise create a new empty dict.
-        item_pos = int(toks[0])
-        curr_item = self._items_map.get(item_pos, {})
-        # Update the map with new values, merging with the
-        # previous ones if any.
-        self._items_map[item_pos] = dict(
-            [
-                (k, self._decode(v, curr_item.get(k)))
-                for k, v in list(undecoded_item.items())
-            ]
+            # Update each registered listener with new event
+            for on_item_update in self._listeners:
+                on_item_update(item_info)
+
+
+class ConflatingSubscription(Subscription):
+    """MERGE Subscription delivering only the latest state of items.
+
+    Updates are merged into the state of their item without calling
+    the listeners. Each flush then delivers one update per item
+    changed since the previous flush, with its current values, so the
+    work of the listeners is bounded by the number of items however
+    busy the market is. Flushes happen max_frequency times a second on
+    a thread of their own, or when the consumer calls flush() (or
+    poll(), which returns the updates instead) on its own tick.
+    """
+
+    def __init__(self, mode, items, fields, adapter="", max_frequency=None):
+        if mode != "MERGE":
+            raise ValueError("Only MERGE subscriptions can be conflated")
+        super(ConflatingSubscription, self).__init__(mode, items, fields, adapter)
+        self.max_frequency = max_frequency
+        # Positions of the items changed since the last flush
+        self._changed = OrderedDict()
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        self.conflated = 0
+
+    def addlistener(self, listener):
+        super(ConflatingSubscription, self).addlistener(listener)
+        if self.max_frequency:
+            self.start()
+
+    def notifyupdate(self, item_line):
+        """Merge an update into the item state, for the next flush."""
+        with self._lock:
+            item_pos = self._update_item(item_line)
+            if item_pos in self._changed:
+                self.conflated += 1
+            else:
+                self._changed[item_pos] = None
+
+    def poll(self):
+        """Return an update for each item changed since the last call,
+        with its latest values.
+        """
+        with self._lock:
+            changed, self._changed = self._changed, OrderedDict()
+            return [self.item_update(item_pos) for item_pos in changed]
+
+    def flush(self):
+        """Deliver the changed items to the listeners, and return how
+        many there were.
+        """
+        item_updates = self.poll()
+        for item_info in item_updates:
+            if self._queue is not None:
+                self._queue.put(item_info)
+            else:
+                for on_item_update in self._listeners:
+                    on_item_update(item_info)
+        return len(item_updates)
+
+    def _flush_loop(self, stopped):
+        interval = 1.0 / self.max_frequency
+        while not stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Subscription listener failed")
+
+    def start(self):
+        """Start flushing max_frequency times a second."""
+        if self._flusher is not None or not self.max_frequency:
+            return
+        # An event per thread, so that a flusher stopped by one of its
+        # own listeners can't be revived by a restart before it ends
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(
+            name="LS-CONFLATE-THREAD", target=self._flush_loop, args=(self._stopped,)
         )
-        # Make an item info as a new event to be passed to listeners
-        item_info = {
-            "pos": item_pos,
-            "name": self.item_names[item_pos - 1],
-            "values": self._items_map[item_pos],
-        }
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the periodic flushes."""
+        if self._flusher is not None:
+            self._stopped.set()
+            # A listener unsubscribing runs on the flusher, which ends
+            # once the flush returns
+            if threading.current_thread() is not self._flusher:
+                self._flusher.join()
+            self._flusher = None
+
+
+class DispatchQueue(object):
+    """Bounded queue of the updates of a Subscription, waiting for
+    a Dispatcher worker.
+
+    A queue is handed to one worker at a time, so the listeners of a
+    subscription get its updates in order, one after the other.
+    """
+
+    def __init__(self, dispatcher, subscription, maxsize, overflow):
+        if overflow not in (BLOCK, DROP_OLDEST, CONFLATE):
+            raise ValueError("Unknown overflow policy '{0}'".format(overflow))
+        self.dispatcher = dispatcher
+        self.subscription = subscription
+        self.maxsize = maxsize
+        self.overflow = overflow
+        # Item position -> latest update when conflating
+        self._updates = OrderedDict() if overflow == CONFLATE else deque()
+        self._cond = threading.Condition()
+        self._scheduled = False
+        self._closed = False
+        self.delivered = 0
+        self.dropped = 0
+        self.conflated = 0
+
+    def __len__(self):
+        return len(self._updates)
+
+    def put(self, item_update):
+        """Queue an update, called by the thread reading the stream."""
+        with self._cond:
+            if self._closed:
+                return
+            updates = self._updates
+            if self.overflow == CONFLATE:
+                if item_update.pos in updates:
+                    self.conflated += 1
+                # An item keeps its place in the queue, and is delivered
+                # with its latest values
+                updates[item_update.pos] = item_update
+            else:
+                if len(updates) >= self.maxsize:
+                    if self.overflow == DROP_OLDEST:
+                        updates.popleft()
+                        self.dropped += 1
+                    else:
+                        while len(updates) >= self.maxsize and not self._closed:
+                            self._cond.wait()
+                updates.append(item_update)
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            self.dispatcher._schedule(self)
+
+    def _take(self, count):
+        with self._cond:
+            updates = self._updates
+            count = min(count, len(updates))
+            if self.overflow == CONFLATE:
+                batch = [updates.popitem(last=False)[1] for _ in range(count)]
+            else:
+                batch = [updates.popleft() for _ in range(count)]
+            self._cond.notify_all()
+        return batch
+
+    def drain(self):
+        """Deliver a batch of updates to the listeners, called by a
+        Dispatcher worker.
+        """
+        batch = self._take(self.dispatcher.batch_size)
+        loop = self.dispatcher.loop
+        for item_update in batch:
+            for on_item_update in self.subscription._listeners:
+                try:
+                    result = on_item_update(item_update)
+                    if loop is not None and asyncio.iscoroutine(result):
+                        loop.create_task(result)
+                except Exception:
+                    log.exception("Subscription listener failed")
+        with self._cond:
+            self.delivered += len(batch)
+            reschedule = bool(self._updates) and not self._closed
+            self._scheduled = reschedule
+        if reschedule:
+            # Back of the line, behind the other subscriptions
+            self.dispatcher._schedule(self)
+
+    def close(self):
+        """Drop the queued updates, and release a blocked producer."""
+        with self._cond:
+            self._closed = True
+            self._updates.clear()
+            self._cond.notify_all()
+
+
+class Dispatcher(object):
+    """Delivers subscription updates to listeners off the thread
+    reading the stream.
+
+    Each subscription gets a bounded queue, and a pool of worker
+    threads (or an asyncio event loop) calls the listeners. A slow
+    listener then only holds up its own subscription, and with the
+    DROP_OLDEST or CONFLATE overflow policies the stream connection
+    never waits for user code. Only MERGE subscriptions are conflated,
+    DISTINCT, RAW and COMMAND updates are events that a newer one
+    doesn't replace, and the CONFLATE default leaves them to BLOCK.
+
+        dispatcher = Dispatcher(workers=4, overflow=CONFLATE)
+        lightstreamer_client = LSClient(url, dispatcher=dispatcher)
+
+    With an event loop, listeners run in the loop, and listeners that
+    are coroutine functions are run as tasks.
+    """
+
+    def __init__(self, workers=2, maxsize=DISPATCH_QUEUE_SIZE, overflow=BLOCK,
+                 loop=None, batch_size=DISPATCH_BATCH_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.loop = loop
+        self.batch_size = batch_size
+        self._queues = {}
+        self._ready = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def register(self, subscription, maxsize=None, overflow=None):
+        """Hand the updates of a subscription to this dispatcher,
+        optionally with its own queue size and overflow policy.
+        """
+        if overflow is None:
+            overflow = self.overflow
+            if overflow == CONFLATE and subscription.mode != "MERGE":
+                overflow = BLOCK
+        elif overflow == CONFLATE and subscription.mode != "MERGE":
+            raise ValueError("Only MERGE subscriptions can be conflated")
+        queue = DispatchQueue(
+            self,
+            subscription,
+            self.maxsize if maxsize is None else maxsize,
+            overflow,
+        )
+        with self._lock:
+            self._queues[id(subscription)] = queue
+            subscription._queue = queue
+        if self.loop is None:
+            self.start()
+        return queue
+
+    def unregister(self, subscription):
+        """Deliver the updates of a subscription on the stream thread
+        again, dropping those still queued.
+        """
+        with self._lock:
+            queue = self._queues.pop(id(subscription), None)
+            subscription._queue = None
+        if queue is not None:
+            queue.close()
+
+    def stats(self):
+        """Queued, delivered, dropped and conflated updates, per
+        subscription.
+        """
+        with self._lock:
+            queues = list(self._queues.values())
+        return [
+            {
+                "subscription": queue.subscription,
+                "queued": len(queue),
+                "delivered": queue.delivered,
+                "dropped": queue.dropped,
+                "conflated": queue.conflated,
+            }
+            for queue in queues
+        ]
+
+    def _schedule(self, queue):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(queue.drain)
+        else:
+            self._ready.put(queue)
+
+    def _work(self):
+        while True:
+            queue = self._ready.get()
+            if queue is None:
+                break
+            queue.drain()
+
+    def start(self):
+        """Start the worker threads, done on the first registration."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(max(1, self.workers)):
+                thread = threading.Thread(
+                    name="LS-DISPATCH-THREAD-{0}".format(i), target=self._work
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads, after the updates already queued
+        for them.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._ready.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+
+class LineBuffer(object):
+    """Splits the chunks of a Stream Connection into lines."""
 
-        # Update each registered listener with new event
-        for on_item_update in self._listeners:
-            on_item_update(item_info)
+    def __init__(self):
+        # Bytes of a line not complete yet
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Return the lines completed by a chunk, possibly none."""
+        buffer = self._buffer
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            buffer += chunk
+            return []
+        # Lines are only decoded whole, a multi-byte character may
+        # straddle two chunks
+        buffer += chunk[:end + 1]
+        text = buffer.decode("utf-8")
+        del buffer[:]
+        buffer += chunk[end + 1:]
+        lines = text.replace("\r\n", "\n").split("\n")
+        # Nothing follows the last line break
+        lines.pop()
+        return lines
+
+    def flush(self):
+        """Return the last line, at the end of the stream, if it had
+        no line break.
+        """
+        lines = [self._buffer.decode("utf-8").rstrip()] if self._buffer else []
+        del self._buffer[:]
+        return lines
+
+
+class StreamReader(object):
+    """Reads the lines of a Stream Connection in large chunks.
+
+    Rather than a read and a decode per line, each read takes whatever
+    has arrived, up to chunk_size bytes, and all the complete lines in
+    it are decoded and split at once, so a burst of updates costs a
+    few reads instead of one per update.
+    """
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        self._stream = stream
+        # read1 returns what is available instead of waiting for
+        # chunk_size bytes
+        self._read = getattr(stream, "read1", stream.read)
+        self.chunk_size = chunk_size
+        self._lines = LineBuffer()
+        self._pending = []
+        self.reads = 0
+
+    def read_lines(self):
+        """Return the lines received so far, waiting for at least one.
+        An empty list means the stream has ended.
+        """
+        if self._pending:
+            lines, self._pending = self._pending, []
+            return lines
+        while True:
+            chunk = self._read(self.chunk_size)
+            self.reads += 1
+            if not chunk:
+                return self._lines.flush()
+            lines = self._lines.feed(chunk)
+            if lines:
+                return lines
+
+    def readline(self):
+        """Return the next line, or an empty string once the stream
+        has ended.
+        """
+        if not self._pending:
+            self._pending = self.read_lines()
+            if not self._pending:
+                return ""
+        return self._pending.pop(0)
+
+    def readlines(self):
+        """Return all the lines left in the stream."""
+        lines = []
+        while True:
+            batch = self.read_lines()
+            if not batch:
+                return lines
+            lines.extend(batch)
+
+    def close(self):
+        self._stream.close()
+
+
+class ControlConnection(object):
+    """Keep-alive HTTP connection for the control requests of a
+    session, instead of a new connection per request.
+
+    Goes through the proxy that urlopen, and so the stream connection,
+    would use: HTTP_PROXY / HTTPS_PROXY, unless NO_PROXY excludes the
+    server. HTTPS requests are tunnelled through the proxy, plain HTTP
+    requests are forwarded by it.
+    """
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self._connection = None
+        # Proxy headers of forwarded requests, None when sent directly
+        self._forward_headers = None
+        self._lock = threading.Lock()
+
+    def _proxy(self):
+        """Proxy URL for the server, parsed, or None."""
+        proxy = getproxies().get(self.url.scheme)
+        if not proxy or proxy_bypass(self.url.hostname):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return parse_url(proxy)
+
+    def _connect(self):
+        if self._connection is None:
+            if self.url.scheme == "https":
+                connection_class = http_client.HTTPSConnection
+            else:
+                connection_class = http_client.HTTPConnection
+            proxy = self._proxy()
+            if proxy is None:
+                self._connection = connection_class(self.url.netloc, timeout=self.timeout)
+                return self._connection
+
+            proxy_headers = {}
+            if proxy.username:
+                credentials = "{0}:{1}".format(unquote(proxy.username), unquote(proxy.password or ""))
+                proxy_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+                    credentials.encode("utf-8")).decode("ascii")
+            self._connection = connection_class(
+                proxy.hostname, proxy.port or http_client.HTTP_PORT, timeout=self.timeout)
+            if self.url.scheme == "https":
+                self._connection.set_tunnel(self.url.hostname, self.url.port, proxy_headers)
+            else:
+                self._forward_headers = proxy_headers
+        return self._connection
+
+    def post(self, path, body):
+        """Post an url encoded body, return the response text."""
+        path = urljoin(self.url.path or "/", path)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        with self._lock:
+            for attempt in range(2):
+                connection = self._connect()
+                try:
+                    if self._forward_headers is not None:
+                        # The proxy needs the absolute URL
+                        url = "{0}://{1}{2}".format(self.url.scheme, self.url.netloc, path)
+                        connection.request("POST", url, body, dict(headers, **self._forward_headers))
+                    else:
+                        connection.request("POST", path, body, headers)
+                    response = connection.getresponse()
+                    text = response.read().decode("utf-8")
+                except (http_client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # The server closed the idle connection, open another
+                    self._close()
+                    if attempt:
+                        raise
+                    continue
+                except Exception:
+                    self._close()
+                    raise
+                if response.will_close:
+                    self._close()
+                if response.status != 200:
+                    raise IOError("Control request failed: {0} {1}".format(
+                        response.status, response.reason))
+                return text
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            self._forward_headers = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class RecoveryStats(object):
+    """Outages of the stream, and the time it took to recover from
+    them, see LSClient.enable_recovery.
+    """
+
+    def __init__(self):
+        self.outages = 0
+        self.recoveries = 0
+        self.failed_attempts = 0
+        self.last_cause = None
+        self.outage_started = None
+        self.last_outage_seconds = None
+        self.longest_outage_seconds = 0.0
+        self.total_outage_seconds = 0.0
+
+    @property
+    def in_outage(self):
+        return self.outage_started is not None
+
+    def start(self, cause):
+        self.outages += 1
+        self.last_cause = cause
+        self.outage_started = time.time()
+
+    def end(self, recovered):
+        seconds = time.time() - self.outage_started
+        self.outage_started = None
+        self.last_outage_seconds = seconds
+        self.longest_outage_seconds = max(self.longest_outage_seconds, seconds)
+        self.total_outage_seconds += seconds
+        if recovered:
+            self.recoveries += 1
+
+    def as_dict(self):
+        return {
+            "outages": self.outages,
+            "recoveries": self.recoveries,
+            "failed_attempts": self.failed_attempts,
+            "in_outage": self.in_outage,
+            "last_cause": self.last_cause,
+            "last_outage_seconds": self.last_outage_seconds,
+            "longest_outage_seconds": self.longest_outage_seconds,
+            "total_outage_seconds": self.total_outage_seconds,
+        }
 
 
 class LSClient(object):
     """Manages the communication with Lightstreamer Server"""
 
-    def __init__(self, base_url, adapter_set="", user="", password=""):
+    def __init__(self, base_url, adapter_set="", user="", password="", trace_every=0,
+                 dispatcher=None):
+        """trace_every logs one in that many stream messages at INFO
+        level, a sampled trace of the stream that is cheap enough to
+        leave on in production. 0 disables it.
+
+        With a Dispatcher, listeners are called by its workers rather
+        than by the thread reading the stream.
+        """
         self._base_url = parse_url(base_url)
         self._adapter_set = adapter_set
         self._user = user
@@ -130,9 +826,29 @@ class LSClient(object):
         self._subscriptions = {}
         self._current_subscription_key = 0
         self._stream_connection = None
+        self._stream_reader = None
         self._stream_connection_thread = None
+        self._control_connection = None
         self._bind_counter = 0
         self.content_length = 1000000000
+        self.trace_every = trace_every
+        self.dispatcher = dispatcher
+        # Session recovery, see enable_recovery
+        self.recovery = False
+        self.recovery_stats = RecoveryStats()
+        self._session_factory = None
+        self._recovery_delays = (RECOVERY_INITIAL_DELAY, RECOVERY_MAX_DELAY, None)
+        self._closing = threading.Event()
+        # Set while there is no session to send control requests to,
+        # subscriptions then wait for _resubscribe
+        self._recovering = False
+        # Held to change the subscriptions, and to send their control
+        # requests, so that recovery doesn't miss any
+        self._lock = threading.RLock()
+        # Messages received by kind: "messages" in total, "updates",
+        # "probes", "loops", "errors" and "unknown_table" updates, and
+        # the number of "reads" of the stream they took
+        self.counters = Counter()
 
     def _encode_params(self, params):
         """Encode the parameter for HTTP POST submissions, but
@@ -157,32 +873,65 @@ class LSClient(object):
         else:
             parsed_custom_address = parse_url("//" + custom_address)
             self._control_url = parsed_custom_address._replace(scheme=self._base_url[0])
+        if self._control_connection is not None and self._control_connection.url != self._control_url:
+            self._close_control_connection()
+
+    def _close_control_connection(self):
+        if self._control_connection is not None:
+            self._control_connection.close()
+            self._control_connection = None
 
     def _control(self, params):
         """Create a Control Connection to send control commands
         that manage the content of Stream Connection.
         """
-        params["LS_session"] = self._session["SessionId"]
-        response = self._call(self._control_url, CONTROL_URL_PATH, params)
-        return response.readline().decode("utf-8").rstrip()
+        return self._control_batch([params])[0]
+
+    def _control_batch(self, requests):
+        """Send control requests over the keep-alive Control
+        Connection, CONTROL_BATCH_SIZE at a time in the body of a single
+        POST, and return the response to each one, in order.
+        """
+        if self._control_connection is None:
+            self._control_connection = ControlConnection(self._control_url)
+        responses = []
+        for i in range(0, len(requests), CONTROL_BATCH_SIZE):
+            batch = requests[i:i + CONTROL_BATCH_SIZE]
+            # the caller's params are left as they are
+            body = b"\r\n".join(
+                self._encode_params(dict(params, LS_session=self._session["SessionId"]))
+                for params in batch)
+            batch_responses = parse_control_response(
+                self._control_connection.post(CONTROL_URL_PATH, body))
+            if len(batch_responses) != len(batch):
+                # No answer for some requests, e.g. the session is gone
+                batch_responses += [ERROR_CMD] * (len(batch) - len(batch_responses))
+            responses.extend(batch_responses)
+        return responses
+
+    def _open_stream(self, stream_connection):
+        self._stream_connection = stream_connection
+        self._stream_reader = StreamReader(stream_connection)
 
     def _read_from_stream(self):
         """Read a single line of content of the Stream Connection."""
-        line = self._stream_connection.readline().decode("utf-8").rstrip()
-        return line
+        return self._stream_reader.readline()
 
     def connect(self):
         """Establish a connection to Lightstreamer Server to create
         a new session.
         """
+        self._closing.clear()
+        self._create_session()
 
+    def _create_session(self):
         if not notify and sys.platform.startswith('linux'):
             log.warning(
                 "systemd.daemon not available, "
                 "no watchdog notifications will be sent."
             )
 
-        self._stream_connection = self._call(
+        self._open_stream(self._call(
             self._base_url,
             CONNECTION_URL_PATH,
             {
@@ -193,7 +942,7 @@ class LSClient(object):
                 "LS_password": self._password,
                 "LS_content_length": self.content_length,
             },
-        )
+        ))
         stream_line = self._read_from_stream()
         self._handle_stream(stream_line)
 
@@ -201,14 +950,14 @@ class LSClient(object):
         """Replace a completely consumed connection in listening for an active
         Session.
         """
-        self._stream_connection = self._call(
+        self._open_stream(self._call(
             self._control_url,
             BIND_URL_PATH,
             {
                 "LS_session": self._session["SessionId"],
                 "LS_content_length": self.content_length,
             },
-        )
+        ))
 
         self._bind_counter += 1
         stream_line = self._read_from_stream()
@@ -239,10 +988,10 @@ class LSClient(object):
             setattr(self._stream_connection_thread, "active_connection", True)
             self._stream_connection_thread.start()
         else:
-            lines = self._stream_connection.readlines()
+            lines = self._stream_reader.readlines()
             lines.insert(0, stream_line)
-            log.error("Server response error: \n{0}".format("".join(lines)))
-            raise IOError()
+            log.error("Server response error: \n{0}".format("\n".join(lines)))
+            raise IOError("Server response error: {0}".format(" ".join(lines)))
 
     def _join(self):
         """Await the natural STREAM-CONN-THREAD termination."""
@@ -253,10 +1002,117 @@ class LSClient(object):
             self._stream_connection_thread = None
             log.debug("Thread terminated")
 
+    def enable_recovery(self, session_factory=None, initial_delay=RECOVERY_INITIAL_DELAY,
+                        max_delay=RECOVERY_MAX_DELAY, max_attempts=None):
+        """Recover from the loss of the session (SYNC ERROR, END, ERROR,
+        a failed rebind or a broken connection) instead of stopping.
+
+        A new session is created, with fresh credentials from
+        session_factory if given, and every Subscription is added again
+        under its subscription key, with its listeners and the item
+        state it had, so MERGE updates carry on from the last known
+        values. Attempts are retried after initial_delay seconds,
+        doubling up to max_delay, until max_attempts (None for no
+        limit). recovery_stats records the outages.
+
+        session_factory takes no arguments and returns the base url,
+        user and password of the new session, e.g. after logging in
+        again through the REST API.
+        """
+        self.recovery = True
+        self._session_factory = session_factory
+        self._recovery_delays = (initial_delay, max_delay, max_attempts)
+
+    def _recover(self, cause):
+        """Create a new session and subscribe again, retrying with
+        exponential backoff. Runs on the thread of the lost stream,
+        which ends once a new one has started.
+        """
+        stats = self.recovery_stats
+        stats.start(cause)
+        log.warning("Lightstreamer session lost (%s), recovering", cause)
+        with self._lock:
+            self._recovering = True
+        initial_delay, max_delay, max_attempts = self._recovery_delays
+        delay = initial_delay
+        attempt = 0
+        while not self._closing.is_set():
+            attempt += 1
+            try:
+                if self._session_factory is not None:
+                    base_url, self._user, self._password = self._session_factory()
+                    self._base_url = parse_url(base_url)
+                with self._lock:
+                    self._session.clear()
+                    self._close_control_connection()
+                self._create_session()
+                with self._lock:
+                    self._resubscribe()
+                    self._recovering = False
+            except Exception as e:
+                self._abandon_stream()
+                stats.failed_attempts += 1
+                log.warning("Recovery attempt %d failed: %s", attempt, e)
+                if max_attempts is not None and attempt >= max_attempts:
+                    break
+                # Jitter, not to have every client come back at once
+                self._closing.wait(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2, max_delay)
+                continue
+            stats.end(True)
+            log.warning("Lightstreamer session recovered after %.1fs, %d attempt(s)",
+                        stats.last_outage_seconds, attempt)
+            return
+        stats.end(False)
+        log.error("Lightstreamer session not recovered after %d attempt(s)", attempt)
+        with self._lock:
+            self._close_session()
+            self._recovering = False
+
+    def _abandon_stream(self):
+        """Stop the stream of a session that failed half way through
+        recovery, if it was started.
+        """
+        thread = self._stream_connection_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.abandoned = True
+            thread.active_connection = False
+            if self._stream_connection is not None:
+                self._stream_connection.close()
+
+    def _resubscribe(self):
+        """Add every Subscription again, under the same keys, those
+        subscribed during the recovery included.
+        """
+        subscriptions = list(self._subscriptions.items())
+        if not subscriptions:
+            return
+        server_responses = self._control_batch(
+            [add_table_params(key, subscription) for key, subscription in subscriptions]
+        )
+        failed = [key for (key, _), response in zip(subscriptions, server_responses) if response != OK_CMD]
+        if failed:
+            log.warning("Tables %s could not be subscribed again", failed)
+        log.info("Subscribed %d tables again", len(subscriptions) - len(failed))
+
+    def _close_session(self):
+        """Clear internal data structures for session and subscriptions
+        management.
+        """
+        with self._lock:
+            self._close_control_connection()
+            self._session.clear()
+            if self.dispatcher is not None:
+                for subscription in self._subscriptions.values():
+                    self.dispatcher.unregister(subscription)
+            self._subscriptions.clear()
+            self._current_subscription_key = 0
+
     def disconnect(self):
         """Request to close the session previously opened with
         the connect() invocation.
         """
+        self._closing.set()
         if self._stream_connection is not None:
             # Exits stream thread loop, joins and exits stream thread, closes connection
             self._join()
@@ -280,119 +1136,207 @@ class LSClient(object):
 
     def subscribe(self, subscription):
         """"Perform a subscription request to Lightstreamer Server."""
-        # Register the Subscription with a new subscription key
-        self._current_subscription_key += 1
-        self._subscriptions[self._current_subscription_key] = subscription
+        return self.subscribe_many([subscription])[0]
 
-        # Send the control request to perform the subscription
-        server_response = self._control(
-            {
-                "LS_Table": self._current_subscription_key,
-                "LS_op": OP_ADD,
-                "LS_data_adapter": subscription.adapter,
-                "LS_mode": subscription.mode,
-                "LS_schema": " ".join(subscription.field_names),
-                "LS_id": " ".join(subscription.item_names),
-            }
-        )
-        log.debug("Server response ---> <{0}>".format(server_response))
-        return self._current_subscription_key
+    def subscribe_many(self, subscriptions):
+        """Perform the subscription requests of many Subscriptions,
+        batched in as few control requests as possible, and return
+        their subscription keys, in order.
+        """
+        keys = []
+        requests = []
+        with self._lock:
+            for subscription in subscriptions:
+                # Register the Subscription with a new subscription key
+                self._current_subscription_key += 1
+                key = self._current_subscription_key
+                self._subscriptions[key] = subscription
+                # Unless already registered, with options of its own
+                if self.dispatcher is not None and subscription._queue is None:
+                    self.dispatcher.register(subscription)
+                keys.append(key)
+                requests.append(add_table_params(key, subscription))
+
+            if self._recovering:
+                # Subscribed by _resubscribe, once there is a session
+                log.info("Tables %s subscribed once the session is recovered", keys)
+                return keys
+            # Send the control requests to perform the subscriptions
+            server_responses = self._control_batch(requests)
+        for key, server_response in zip(keys, server_responses):
+            log.debug("Server response for table %s ---> <%s>", key, server_response)
+            if server_response != OK_CMD:
+                log.warning("Subscription of table %s failed: %s", key, server_response)
+        return keys
 
     def unsubscribe(self, subcription_key):
         """Unregister the Subscription associated to the
         specified subscription_key.
         """
-        if subcription_key in self._subscriptions:
-            server_response = self._control(
-                {"LS_Table": subcription_key, "LS_op": OP_DELETE}
-            )
-            log.debug("Server response ---> <{0}>".format(server_response))
+        self.unsubscribe_many([subcription_key])
 
-            if server_response == OK_CMD:
-                del self._subscriptions[subcription_key]
-                log.info("Unsubscribed successfully")
+    def unsubscribe_many(self, subscription_keys):
+        """Unregister the Subscriptions associated to many subscription
+        keys, batched in as few control requests as possible.
+        """
+        keys = []
+        unsubscribed = []
+        with self._lock:
+            for subcription_key in subscription_keys:
+                if subcription_key in self._subscriptions:
+                    keys.append(subcription_key)
+                else:
+                    log.warning("No subscription key {0} found!".format(subcription_key))
+            if not keys:
+                return
+            if self._recovering:
+                # The tables went with the lost session, _resubscribe
+                # only has to leave them out
+                server_responses = [OK_CMD] * len(keys)
             else:
-                log.warning("Server error")
-        else:
-            log.warning("No subscription key {0} found!".format(subcription_key))
+                server_responses = self._control_batch(
+                    [{"LS_Table": key, "LS_op": OP_DELETE} for key in keys]
+                )
+            for subcription_key, server_response in zip(keys, server_responses):
+                log.debug("Server response for table %s ---> <%s>", subcription_key, server_response)
+                if server_response == OK_CMD:
+                    unsubscribed.append(self._subscriptions.pop(subcription_key))
+                else:
+                    log.warning("Server error unsubscribing table %s: %s", subcription_key, server_response)
+        for subscription in unsubscribed:
+            if isinstance(subscription, ConflatingSubscription):
+                subscription.stop()
+            if subscription._queue is not None:
+                subscription._queue.dispatcher.unregister(subscription)
+        log.info("Unsubscribed %d of %d tables", len(unsubscribed), len(keys))
 
     def _forward_update_message(self, update_message):
         """Forwards the real time update to the relative
         Subscription instance for further dispatching to its listeners.
         """
-        log.debug("Received update message ---> <{0}>".format(update_message))
-        tok = update_message.split(",", 1)
-        table, item = int(tok[0]), tok[1]
-        if table in self._subscriptions:
-            self._subscriptions[table].notifyupdate(item)
+        table, item = update_message.split(",", 1)
+        subscription = self._subscriptions.get(int(table))
+        if subscription is not None:
+            subscription.notifyupdate(item)
         else:
-            log.warning("No subscription found!")
+            self.counters["unknown_table"] += 1
+            log.warning("No subscription found for table %s!", table)
 
     def _receive(self):
         rebind = False
         receive = True
-        while receive and self._stream_connection_thread.active_connection:
-            log.debug("Waiting for a new message")
+        counters = self.counters
+        trace_every = self.trace_every
+        # Checked now and then rather than on every message, formatting
+        # and filtering log records costs more than parsing an update.
+        debug = log.isEnabledFor(logging.DEBUG)
+        watchdog_due = 0
+        cause = None
+        # The thread keeps to its own stream, even once recovery has
+        # moved on to another one
+        thread = threading.current_thread()
+        reader = self._stream_reader
+        while receive and thread.active_connection:
             try:
-                message = self._read_from_stream()
-                log.debug("Received message ---> <{0}>".format(message))
+                messages = reader.read_lines()
             except Exception:
                 log.error("Communication error")
                 print(traceback.format_exc())
-                message = None
+                messages = None
 
             if notify:
-                notify("WATCHDOG=1")
+                now = time.monotonic()
+                if now >= watchdog_due:
+                    notify("WATCHDOG=1")
+                    watchdog_due = now + WATCHDOG_INTERVAL
 
-            if message is None:
+            if not messages:
                 receive = False
+                cause = "connection lost"
                 log.warning("No new message received")
-            elif message == PROBE_CMD:
-                # Skipping the PROBE message, keep on receiving messages.
-                log.debug("PROBE message")
-            elif message.startswith(ERROR_CMD):
-                # Terminate the receiving loop on ERROR message
-                receive = False
-                log.error("ERROR")
-            elif message.startswith(LOOP_CMD):
-                # Terminate the the receiving loop on LOOP message.
-                # A complete implementation should proceed with
-                # a rebind of the session.
-                log.debug("LOOP")
-                rebind = True
-                receive = False
-            elif message.startswith(SYNC_ERROR_CMD):
-                # Terminate the receiving loop on SYNC ERROR message.
-                # A complete implementation should create a new session
-                # and re-subscribe to all the old items and relative fields.
-                log.error("SYNC ERROR")
-                receive = False
-            elif message.startswith(END_CMD):
-                # Terminate the receiving loop on END message.
-                # The session has been forcibly closed on the server side.
-                # A complete implementation should handle the
-                # "cause_code" if present.
-                log.info("Connection closed by the server")
-                receive = False
-            elif message.startswith("Preamble"):
-                # Skipping Preamble message, keep on receiving messages.
-                log.debug("Preamble")
-            else:
-                self._forward_update_message(message)
+                continue
+
+            counters["reads"] += 1
+            for message in messages:
+                counters["messages"] += 1
+                received = counters["messages"]
+                if received % LOG_LEVEL_CHECK_INTERVAL == 0:
+                    debug = log.isEnabledFor(logging.DEBUG)
+                    trace_every = self.trace_every
+                if debug:
+                    log.debug("Received message ---> <%s>", message)
+                elif trace_every and received % trace_every == 0:
+                    log.info("Sampled message %d ---> <%s>", received, message)
+
+                if message[:1].isdigit():
+                    # Real time update, "<table>,<item>|<field>|..."
+                    counters["updates"] += 1
+                    self._forward_update_message(message)
+                elif message == PROBE_CMD:
+                    # Skipping the PROBE message, keep on receiving messages.
+                    counters["probes"] += 1
+                    debug = log.isEnabledFor(logging.DEBUG)
+                elif message.startswith(ERROR_CMD):
+                    # Terminate the receiving loop on ERROR message
+                    counters["errors"] += 1
+                    receive = False
+                    cause = message
+                    log.error("ERROR")
+                elif message.startswith(LOOP_CMD):
+                    # Terminate the the receiving loop on LOOP message.
+                    # A complete implementation should proceed with
+                    # a rebind of the session.
+                    counters["loops"] += 1
+                    log.debug("LOOP")
+                    rebind = True
+                    receive = False
+                elif message.startswith(SYNC_ERROR_CMD):
+                    # Terminate the receiving loop on SYNC ERROR message.
+                    # With recovery enabled, a new session is created and
+                    # all the old items and relative fields subscribed again.
+                    counters["errors"] += 1
+                    log.error("SYNC ERROR")
+                    receive = False
+                    cause = message
+                elif message.startswith(END_CMD):
+                    # Terminate the receiving loop on END message.
+                    # The session has been forcibly closed on the server side,
+                    # the "cause_code" if present is kept as the cause.
+                    log.info("Connection closed by the server")
+                    receive = False
+                    cause = message
+                elif message.startswith("Preamble"):
+                    # Skipping Preamble message, keep on receiving messages.
+                    log.debug("Preamble")
+                elif message:
+                    self._forward_update_message(message)
+                if not receive:
+                    break
 
+        if getattr(thread, "abandoned", False):
+            reader.close()
+            return
+        # Lost, rather than closed on request
+        recover = self.recovery and thread.active_connection and not self._closing.is_set()
         if not rebind:
             log.debug("Closing connection")
-            # Clear internal data structures for session
-            # and subscriptions management.
-            self._stream_connection.close()
+            reader.close()
             self._stream_connection = None
-            self._session.clear()
-            self._subscriptions.clear()
-            self._current_subscription_key = 0
+            self._stream_reader = None
+            if recover:
+                self._recover(cause)
+            else:
+                self._close_session()
         else:
             log.debug("Binding to this active session")
             self._stream_connection = None
-            self.bind()
+            self._stream_reader = None
+            try:
+                self.bind()
+            except Exception as e:
+                if not recover:
+                    raise
+                self._recover("rebind failed: {0}".format(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Cache of market details
+
+Instrument details and dealing rules (lot size, minimum stop distance, expiry, ...) hardly ever
+change, yet are needed before every order. MarketCache keeps the market details returned by IG in
+memory, least recently used first out, for a limited time, and optionally in a SQLite file so they
+survive restarts. IGService.fetch_market_by_epic answers from the cache, and load_markets fills it
+for many epics at once.
+
+The 'snapshot' part of cached details (prices, market status) is as old as the entry, fetch prices
+with the cache bypassed or from the streaming API.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from trading_ig.utils import get_config_value
+
+logger = logging.getLogger(__name__)
+
+# seconds market details are kept for, and the number of markets kept in memory
+MARKET_CACHE_TTL = 24 * 60 * 60
+MARKET_CACHE_SIZE = 5000
+# most epics IG accepts in one '/markets' request
+MAX_EPICS_PER_REQUEST = 50
+
+
+def epic_list(epics):
+    """Returns epics as a list, whether given as a list or as a comma separated string"""
+    if isinstance(epics, str):
+        return [epic.strip() for epic in epics.split(",") if epic.strip()]
+    return list(epics)
+
+
+def split_epics(epics, size=MAX_EPICS_PER_REQUEST):
+    """
+    Splits epics into chunks IG accepts in one request
+    :param epics: list of epics, or a comma separated string
+    :type epics: list or str
+    :return: list of comma separated strings
+    :rtype: list
+    """
+    epics = epic_list(epics)
+    return [",".join(epics[i:i + size]) for i in range(0, len(epics), size)]
+
+
+class MarketCache(object):
+    """LRU cache of market details by epic, with expiry and optional SQLite persistence"""
+
+    def __init__(self, maxsize=MARKET_CACHE_SIZE, ttl=MARKET_CACHE_TTL, path=None):
+        """
+        :param maxsize: maximum number of markets kept in memory
+        :type maxsize: int
+        :param ttl: seconds before market details are fetched again
+        :type ttl: float
+        :param path: SQLite database file to persist market details in. Optional
+        :type path: str
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # epic -> (fetched time, details), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS markets (epic TEXT PRIMARY KEY, fetched REAL, details TEXT)")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a cache from the optional 'market_cache' settings, or returns None if it isn't enabled.
+        'market_cache' is True for an in-memory cache, or the path of a SQLite file to persist it in.
+        'market_cache_ttl' (seconds) and 'market_cache_size' adjust expiry and size
+        """
+        setting = get_config_value(config, 'market_cache', None)
+        if not setting or str(setting).lower() in ('false', '0', 'no'):
+            return None
+        path = None if str(setting).lower() in ('true', '1', 'yes') else setting
+        return cls(
+            maxsize=int(get_config_value(config, 'market_cache_size', MARKET_CACHE_SIZE)),
+            ttl=float(get_config_value(config, 'market_cache_ttl', MARKET_CACHE_TTL)),
+            path=path,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, epic):
+        return self.get(epic, count=False) is not None
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+    def _expired(self, fetched):
+        return time.time() - fetched > self.ttl
+
+    def _add(self, epic, fetched, details):
+        self._entries[epic] = (fetched, details)
+        self._entries.move_to_end(epic)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _load(self, epic):
+        """Reads an entry from the database into memory"""
+        row = self._conn.execute("SELECT fetched, details FROM markets WHERE epic = ?", (epic,)).fetchone()
+        if row is None or self._expired(row[0]):
+            return None
+        details = json.loads(row[1])
+        self._add(epic, row[0], details)
+        return details
+
+    def get(self, epic, count=True):
+        """
+        Returns the cached details of a market, or None if they aren't cached or have expired
+        :param epic: market epic
+        :type epic: str
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._entries.get(epic)
+            if entry is not None and self._expired(entry[0]):
+                del self._entries[epic]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(epic)
+                details = entry[1]
+            elif self._conn is not None:
+                details = self._load(epic)
+            else:
+                details = None
+            if count:
+                if details is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return details
+
+    def put(self, epic, details):
+        """Caches the details of a market"""
+        self.put_many({epic: details})
+
+    def put_many(self, markets):
+        """
+        Caches the details of many markets
+        :param markets: market details by epic
+        :type markets: dict
+        """
+        fetched = time.time()
+        with self._lock:
+            for epic, details in markets.items():
+                self._add(epic, fetched, details)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO markets VALUES (?, ?, ?)",
+                        [(epic, fetched, json.dumps(details)) for epic, details in markets.items()])
+        logger.debug(f"Cached details of {len(markets)} markets")
+
+    def missing(self, epics):
+        """Returns the epics whose details aren't cached, in the given order"""
+        return [epic for epic in epics if self.get(epic, count=False) is None]
+
+    def invalidate(self, epic=None):
+        """Removes one market, or all of them, from the cache"""
+        with self._lock:
+            if epic is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(epic, None)
+            if self._conn is not None:
+                with self._conn:
+                    if epic is None:
+                        self._conn.execute("DELETE FROM markets")
+                    else:
+                        self._conn.execute("DELETE FROM markets WHERE epic = ?", (epic,))
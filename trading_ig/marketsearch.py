@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+In-memory market search
+
+MarketSearchIndex answers market searches locally, from markets found by the navigation crawler
+(trading_ig.navigation) or fetched as market details. Instrument names and epics are split into
+lower case tokens, and a search matches markets having a token starting with every word of the
+search term, so 'eur us' finds 'EUR/USD' as well as 'CS.D.EURUSD.MINI.IP'. IGService.search_markets
+consults the index first, and only calls the API when nothing matches. Markets are kept as the
+market summaries of IG's search results and navigation nodes, so that a search answered from the
+index looks the same as one answered by IG.
+"""
+import bisect
+import heapq
+import re
+import threading
+
+TOKEN_SEPARATORS = re.compile(r"[^0-9a-z]+")
+# market summary fields taken from the 'instrument' and 'snapshot' of market details
+INSTRUMENT_FIELDS = {"epic": "epic", "instrumentName": "name", "instrumentType": "type", "expiry": "expiry",
+                     "lotSize": "lotSize", "streamingPricesAvailable": "streamingPricesAvailable"}
+SNAPSHOT_FIELDS = ("bid", "offer", "high", "low", "netChange", "percentageChange", "updateTime", "delayTime",
+                   "marketStatus", "scalingFactor")
+
+
+def tokenize(text):
+    """Lower case words of a name or epic"""
+    return [token for token in TOKEN_SEPARATORS.split(text.lower()) if token]
+
+
+def market_summary(details):
+    """
+    Market summary, as in the '/markets?searchTerm=' response, from market details
+    :param details: market details, as returned by IGService.fetch_market_by_epic
+    :type details: dict
+    :rtype: dict
+    """
+    instrument = details["instrument"]
+    snapshot = details.get("snapshot") or {}
+    summary = {field: instrument.get(name) for field, name in INSTRUMENT_FIELDS.items()}
+    summary.update((field, snapshot.get(field)) for field in SNAPSHOT_FIELDS)
+    return summary
+
+
+class MarketSearchIndex(object):
+    """Prefix and token search over market summaries"""
+
+    def __init__(self, markets=None):
+        """
+        :param markets: market summaries to index, with at least 'epic' and 'instrumentName'. They
+            are kept whole, and returned as they are by search
+        :type markets: list of dict
+        """
+        # epic -> market summary
+        self.markets = {}
+        # token -> set of epics
+        self._postings = {}
+        # sorted tokens, for prefix lookups. Rebuilt on the first search after a change
+        self._tokens = []
+        self._dirty = False
+        self._lock = threading.Lock()
+        if markets:
+            self.add_markets(markets)
+
+    def __len__(self):
+        return len(self.markets)
+
+    @classmethod
+    def from_navigation(cls, crawler):
+        """Index of every market in a crawled navigation tree"""
+        return cls(market for _, market in crawler.markets())
+
+    def add_markets(self, markets):
+        """
+        Adds or updates markets
+        :param markets: market summaries, as in navigation nodes or search results
+        :type markets: iterable of dict
+        """
+        with self._lock:
+            for market in markets:
+                self._add(market)
+
+    def add_market_details(self, details):
+        """
+        Adds markets from market details, as returned by IGService.fetch_market_by_epic
+        :param details: market details
+        :type details: iterable of dict
+        """
+        self.add_markets(market_summary(market) for market in details)
+
+    def _add(self, market):
+        epic = market["epic"]
+        tokens = set(tokenize(epic))
+        previous = self.markets.get(epic)
+        if previous is None:
+            summary = dict(market)
+        else:
+            # fields missing from the update keep their previous value
+            summary = dict(previous)
+            summary.update((field, value) for field, value in market.items() if value is not None)
+            # words of a name the market no longer has
+            for token in set(tokenize(previous.get("instrumentName") or "")) - tokens - set(
+                    tokenize(summary.get("instrumentName") or "")):
+                epics = self._postings[token]
+                epics.discard(epic)
+                if not epics:
+                    del self._postings[token]
+                    self._dirty = True
+        self.markets[epic] = summary
+        for token in tokens | set(tokenize(summary.get("instrumentName") or "")):
+            epics = self._postings.get(token)
+            if epics is None:
+                self._postings[token] = epics = set()
+                self._dirty = True
+            epics.add(epic)
+
+    def _prefix_matches(self, prefix):
+        """Epics with a token starting with prefix"""
+        start = bisect.bisect_left(self._tokens, prefix)
+        epics = set()
+        for token in self._tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            epics |= self._postings[token]
+        return epics
+
+    def search(self, search_term, limit=None):
+        """
+        Returns the markets matching every word of search_term. A market whose epic is the search
+        term comes first, then markets whose name starts with the search term, then the others by
+        name
+        :param search_term: words or word prefixes to look for
+        :type search_term: str
+        :param limit: maximum number of results. Optional
+        :type limit: int
+        :rtype: list of dict
+        """
+        words = tokenize(search_term)
+        if not words:
+            return []
+        with self._lock:
+            if self._dirty:
+                self._tokens = sorted(self._postings)
+                self._dirty = False
+            # longest words first, as they usually match the fewest markets, to keep the
+            # intersection small
+            matches = None
+            for word in sorted(words, key=len, reverse=True):
+                epics = self._prefix_matches(word)
+                matches = epics if matches is None else matches & epics
+                if not matches:
+                    return []
+            results = [self.markets[epic] for epic in matches]
+
+        term = search_term.strip().lower()
+
+        def rank(market):
+            name = (market.get("instrumentName") or "").lower()
+            return market["epic"].lower() != term, not name.startswith(term), name, market["epic"]
+
+        if limit and limit < len(results):
+            return heapq.nsmallest(limit, results, key=rank)
+        results.sort(key=rank)
+        return results
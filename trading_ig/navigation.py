@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Market navigation tree crawler
+
+Enumerating every epic means walking IG's '/marketnavigation' hierarchy, thousands of requests for
+the whole tree. MarketNavigationCrawler walks it breadth first across a worker pool (requests are
+paced by the session rate limiter), saves the tree to a JSON file, and on later runs only fetches
+the nodes older than max_age, so a daily refresh re-reads just the parts of the tree that are due.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+ROOT = "root"
+# seconds before a node is fetched again
+NAVIGATION_MAX_AGE = 24 * 60 * 60
+
+
+class MarketNavigationCrawler(object):
+    """Breadth-first crawler of the market navigation tree, with on-disk persistence"""
+
+    def __init__(self, ig_service, path=None, max_workers=4, max_age=NAVIGATION_MAX_AGE, progress_callback=None):
+        """
+        :param ig_service: logged in IGService
+        :type ig_service: trading_ig.IGService
+        :param path: JSON file the tree is loaded from and saved to. Optional
+        :type path: str
+        :param max_workers: maximum number of requests in flight at the same time
+        :type max_workers: int
+        :param max_age: seconds after which a node is considered stale and fetched again
+        :type max_age: float
+        :param progress_callback: called with (nodes fetched, nodes queued) after every node. Optional
+        :type progress_callback: function
+        """
+        self.ig_service = ig_service
+        self.path = path
+        self.max_workers = max_workers
+        self.max_age = max_age
+        self.progress_callback = progress_callback
+        # node id -> {"id", "name", "parent", "children", "markets", "fetched"}
+        self.nodes = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """Reads the tree saved by a previous crawl"""
+        with open(self.path) as f:
+            self.nodes = json.load(f)["nodes"]
+        logger.info(f"Loaded {len(self.nodes)} navigation nodes from {self.path}")
+
+    def save(self):
+        """Writes the tree to path, atomically"""
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w") as f:
+                json.dump({"saved": time.time(), "nodes": self.nodes}, f)
+        os.replace(tmp_path, self.path)
+
+    def _stale(self, node_id, now):
+        node = self.nodes.get(node_id)
+        return node is None or node.get("fetched") is None or now - node["fetched"] > self.max_age
+
+    def _fetch(self, node_id):
+        if node_id == ROOT:
+            return self.ig_service.fetch_top_level_navigation_nodes()
+        return self.ig_service.fetch_sub_nodes_by_node(node_id)
+
+    def _store(self, node_id, response):
+        """Records a fetched node, dropping subtrees of children that have gone"""
+        children = [child["id"] for child in response.get("nodes") or []]
+        with self._lock:
+            node = self.nodes.setdefault(node_id, {"id": node_id, "name": None, "parent": None})
+            for gone in set(node.get("children", [])) - set(children):
+                self._remove(gone)
+            for child in response.get("nodes") or []:
+                entry = self.nodes.setdefault(child["id"], {"id": child["id"], "fetched": None})
+                entry["name"] = child["name"]
+                entry["parent"] = node_id
+            node["children"] = children
+            node["markets"] = response.get("markets") or []
+            node["fetched"] = time.time()
+        return children
+
+    def _remove(self, node_id):
+        node = self.nodes.pop(node_id, None)
+        if node is not None:
+            for child in node.get("children", []):
+                self._remove(child)
+
+    def crawl(self, root=ROOT, refresh=False):
+        """
+        Walks the tree below root breadth first, fetching only the nodes that are stale (or all of
+        them with refresh=True). Nodes that fail are recorded in errors and fetched again next time.
+        The tree is saved when done, or when interrupted
+        :param root: node to start from, default the top of the hierarchy
+        :type root: str
+        :param refresh: fetch every node, even those that aren't stale
+        :type refresh: bool
+        :return: number of nodes fetched
+        :rtype: int
+        """
+        now = time.time()
+        queue = deque([root])
+        fetched = 0
+        self.errors = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                running = {}
+                while queue or running:
+                    # nodes that don't need fetching are walked straight away from the stored tree
+                    while queue and len(running) < self.max_workers:
+                        node_id = queue.popleft()
+                        if refresh or self._stale(node_id, now):
+                            running[executor.submit(self._fetch, node_id)] = node_id
+                        else:
+                            queue.extend(self.nodes[node_id].get("children", []))
+                    if not running:
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        node_id = running.pop(future)
+                        try:
+                            queue.extend(self._store(node_id, future.result()))
+                            fetched += 1
+                        except Exception as e:
+                            logger.warning(f"Navigation node {node_id} failed: {e}")
+                            self.errors[node_id] = e
+                        if self.progress_callback is not None:
+                            self.progress_callback(fetched, len(queue) + len(running))
+        finally:
+            self.save()
+        logger.info(f"Crawled market navigation: {fetched} nodes fetched, {len(self.errors)} failed, "
+                    f"{len(self.nodes)} nodes in tree")
+        return fetched
+
+    def path_of(self, node_id):
+        """Names of the nodes from the top of the hierarchy down to node_id"""
+        names = []
+        node = self.nodes.get(node_id)
+        while node is not None and node["id"] != ROOT:
+            names.append(node["name"])
+            node = self.nodes.get(node["parent"])
+        return names[::-1]
+
+    def markets(self):
+        """
+        Yields every market in the tree, with the id of the node it was found in. A market listed
+        under several nodes is yielded once per node
+        :return: (node id, market) tuples
+        """
+        for node_id, node in list(self.nodes.items()):
+            for market in node.get("markets") or []:
+                yield node_id, market
+
+    def epics(self):
+        """
+        Returns every epic in the tree
+        :return: market summary by epic
+        :rtype: dict
+        """
+        return {market["epic"]: market for _, market in self.markets()}
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Columnar decoding of IG historical price responses
+
+IG returns price bars as a list of objects, each with nested openPrice / closePrice / highPrice /
+lowPrice objects holding bid, ask and lastTraded. These helpers turn that list into one NumPy
+array per field (or a pandas DataFrame with typed columns), without flattening every bar into
+another dict on the way, as pandas.json_normalize does. Either can be passed as the 'format'
+argument of the IGService historical price methods.
+
+They work on the response once the JSON decoder has built it, so each bar is still a dict (with a
+dict per price) in memory before it is decoded: the columns aren't read straight from the
+response bytes.
+
+Requires the optional 'numpy' package ('pandas' as well for prices_to_dataframe).
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+PRICE_FIELDS = (
+    ("open", "openPrice"),
+    ("high", "highPrice"),
+    ("low", "lowPrice"),
+    ("close", "closePrice"),
+)
+
+PRICE_SIDES = (
+    ("bid", "bid"),
+    ("ask", "ask"),
+    ("last", "lastTraded"),
+)
+
+
+def _timestamps(prices):
+    """Bar times as int64 milliseconds since the epoch (UTC where IG provides it)"""
+    if not prices:
+        return np.empty(0, dtype=np.int64)
+    if "snapshotTimeUTC" in prices[0]:
+        times = np.array([bar["snapshotTimeUTC"] for bar in prices])
+    else:
+        # v1 / v2 format '2021/01/04 09:00:00' or '2021:01:04-09:00:00'
+        times = np.array([bar["snapshotTime"] for bar in prices])
+        times = np.char.replace(np.char.replace(times, "/", "-"), " ", "T")
+        if times[0][4] == ":":
+            times = np.array([t[:4] + "-" + t[5:7] + "-" + t[8:10] + "T" + t[11:] for t in times])
+    return times.astype("datetime64[ms]").astype(np.int64)
+
+
+def prices_to_arrays(prices):
+    """
+    Decodes a list of IG price bars into NumPy arrays. The bars are those of the decoded JSON
+    response, the arrays are filled from them one field at a time
+    :param prices: 'prices' element of a historical prices response
+    :type prices: list
+    :return: 'timestamp' (int64, ms since epoch), '<field>_<side>' for each of open / high / low /
+        close and bid / ask / last (float64, NaN where IG sends null) and 'volume' (float64)
+    :rtype: dict of numpy.ndarray
+    """
+    if np is None:
+        raise ImportError("prices_to_arrays requires the 'numpy' package")
+    columns = {"timestamp": _timestamps(prices)}
+    for name, field in PRICE_FIELDS:
+        for side_name, side in PRICE_SIDES:
+            columns[f"{name}_{side_name}"] = np.array([bar[field][side] for bar in prices], dtype=np.float64)
+    columns["volume"] = np.array([bar.get("lastTradedVolume") for bar in prices], dtype=np.float64)
+    return columns
+
+
+def prices_to_dataframe(prices):
+    """
+    Decodes a list of IG price bars into a pandas DataFrame with the columns of prices_to_arrays
+    :param prices: 'prices' element of a historical prices response
+    :type prices: list
+    :rtype: pandas.DataFrame
+    """
+    if pd is None:
+        raise ImportError("prices_to_dataframe requires the 'pandas' package")
+    return pd.DataFrame(prices_to_arrays(prices), copy=False)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Persistent local store for historical price bars
+
+Bars are kept in SQLite, keyed by (epic, resolution, timestamp), together with the time ranges
+that have already been downloaded. IGService.fetch_historical_prices_by_epic consults the store
+first and only requests the missing ranges from IG, which saves historical data allowance.
+The instrument type of each epic and the last allowance reported by IG are kept as well, so
+that responses served from the store have the same shape as those from IG.
+"""
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def to_timestamp(value):
+    """
+    Normalises a datetime, an IG v3 date ('2021-01-04T09:00:00') or snapshot time
+    ('2021/01/04 09:00:00') to the timestamp format used as key in the store
+    """
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+    return value.replace("/", "-").replace(" ", "T")[:19]
+
+
+def bar_timestamp(bar):
+    """Timestamp of a price bar, in the timezone used by the 'from' / 'to' request parameters"""
+    return to_timestamp(bar["snapshotTime"] if "snapshotTime" in bar else bar["snapshotTimeUTC"])
+
+
+class PriceBarStore(object):
+    """SQLite backed store of historical price bars with a record of the downloaded time ranges"""
+
+    def __init__(self, path=":memory:"):
+        """
+        :param path: SQLite database file. Default is an in-memory database
+        :type path: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bars ("
+                "epic TEXT, resolution TEXT, timestamp TEXT, bar TEXT, "
+                "PRIMARY KEY (epic, resolution, timestamp))")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS coverage ("
+                "epic TEXT, resolution TEXT, start TEXT, end TEXT)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS coverage_idx ON coverage (epic, resolution, start)")
+            # details of the last response for each epic and resolution
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "epic TEXT, resolution TEXT, instrument_type TEXT, allowance TEXT, updated REAL, "
+                "PRIMARY KEY (epic, resolution))")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _coverage(self, epic, resolution, start, end):
+        """Downloaded ranges overlapping or touching [start, end], in order"""
+        return self._conn.execute(
+            "SELECT start, end FROM coverage WHERE epic = ? AND resolution = ? AND start <= ? AND end >= ? "
+            "ORDER BY start", (epic, resolution, end, start)).fetchall()
+
+    def missing(self, epic, resolution, start, end):
+        """
+        Returns the parts of [start, end] that haven't been downloaded yet. Gaps include the
+        boundary bars of the neighbouring ranges, so nothing falls between two ranges
+        :return: list of (start, end) timestamps
+        :rtype: list
+        """
+        start, end = to_timestamp(start), to_timestamp(end)
+        gaps = []
+        cursor = start
+        with self._lock:
+            covered = self._coverage(epic, resolution, start, end)
+        for covered_start, covered_end in covered:
+            if covered_start > cursor:
+                gaps.append((cursor, covered_start))
+            cursor = max(cursor, covered_end)
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def store(self, epic, resolution, start, end, bars, instrument_type=None, allowance=None):
+        """
+        Saves the bars downloaded for [start, end] and records the range as downloaded. A range
+        reaching into the future is only recorded up to the last bar, so later bars will still be
+        requested
+        :param instrument_type: 'instrumentType' of the response. Optional
+        :type instrument_type: str
+        :param allowance: 'allowance' of the response metadata. Optional
+        :type allowance: dict
+        """
+        start, end = to_timestamp(start), to_timestamp(end)
+        rows = [(epic, resolution, bar_timestamp(bar), json.dumps(bar)) for bar in bars]
+        if end > datetime.now().strftime(DATE_FORMAT):
+            end = max([row[2] for row in rows], default=None)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?)", rows)
+            if instrument_type is not None or allowance is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (epic, resolution, instrument_type, json.dumps(allowance) if allowance else None, time.time()))
+            if end is None or end < start:
+                return
+            # merge with the ranges it overlaps or touches
+            covered = self._coverage(epic, resolution, start, end)
+            if covered:
+                start = min(start, covered[0][0])
+                end = max(end, max(covered_end for _, covered_end in covered))
+                self._conn.execute(
+                    "DELETE FROM coverage WHERE epic = ? AND resolution = ? AND start >= ? AND end <= ?",
+                    (epic, resolution, start, end))
+            self._conn.execute("INSERT INTO coverage VALUES (?, ?, ?, ?)", (epic, resolution, start, end))
+        logger.debug(f"Stored {len(rows)} {resolution} bars for {epic}, {start} - {end}")
+
+    def load(self, epic, resolution, start, end):
+        """
+        Returns the stored bars in [start, end], in time order
+        :rtype: list of dict
+        """
+        start, end = to_timestamp(start), to_timestamp(end)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT bar FROM bars WHERE epic = ? AND resolution = ? AND timestamp >= ? AND timestamp <= ? "
+                "ORDER BY timestamp", (epic, resolution, start, end)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _allowance(self):
+        """The last allowance reported by IG, for any epic, with its expiry counted down since"""
+        row = self._conn.execute(
+            "SELECT allowance, updated FROM responses WHERE allowance IS NOT NULL "
+            "ORDER BY updated DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        allowance = json.loads(row[0])
+        if "allowanceExpiry" in allowance:
+            elapsed = int(time.time() - row[1])
+            allowance["allowanceExpiry"] = max(0, int(allowance["allowanceExpiry"]) - elapsed)
+        return allowance
+
+    def load_response(self, epic, resolution, start, end, page_size=0):
+        """
+        Returns the stored bars in [start, end] as a v3 '/prices/{epic}' response, like the pages
+        of one bundled by IGService.fetch_historical_prices_by_epic: 'prices', 'instrumentType'
+        and 'metadata' with 'size', 'pageData' and, once IG has reported one, 'allowance'
+        :param page_size: page size of the request, 0 for no paging
+        :type page_size: int
+        :rtype: dict
+        """
+        prices = self.load(epic, resolution, start, end)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT instrument_type FROM responses WHERE epic = ? AND resolution = ?",
+                (epic, resolution)).fetchone()
+            allowance = self._allowance()
+        page_size = int(page_size or 0)
+        metadata = {
+            "size": len(prices),
+            "pageData": {
+                "pageSize": page_size,
+                "pageNumber": 1,
+                "totalPages": max(1, math.ceil(len(prices) / page_size)) if page_size else 1,
+            },
+        }
+        if allowance is not None:
+            metadata["allowance"] = allowance
+        return {"prices": prices, "instrumentType": row[0] if row else None, "metadata": metadata}
+
+    def clear(self, epic=None):
+        """Removes all stored bars, or only those of the given epic"""
+        with self._lock, self._conn:
+            if epic is None:
+                self._conn.execute("DELETE FROM bars")
+                self._conn.execute("DELETE FROM coverage")
+                self._conn.execute("DELETE FROM responses")
+            else:
+                self._conn.execute("DELETE FROM bars WHERE epic = ?", (epic,))
+                self._conn.execute("DELETE FROM coverage WHERE epic = ?", (epic,))
+                self._conn.execute("DELETE FROM responses WHERE epic = ?", (epic,))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Client side throttling for the IG REST API
+
+IG enforces allowances per application and per account (see https://labs.ig.com/faq):
+    - non-trading requests per minute (per account): 30
+    - trading requests per minute (per account): 100
+    - historical price data points per week: 10,000
+
+Instead of hitting an allowance, being rejected and backing off, requests reserve capacity from
+a token bucket before they are sent, and wait just long enough to stay under the limit.
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+
+from trading_ig.Exceptions import AllowanceExhaustedException
+from trading_ig.utils import get_config_value
+
+logger = logging.getLogger(__name__)
+
+NON_TRADING = "non_trading"
+TRADING = "trading"
+HISTORICAL = "historical"
+
+# endpoints where POST / PUT / DELETE counts against the trading allowance
+TRADING_ENDPOINTS = re.compile(r"^/(positions|workingorders)/otc")
+PRICES_ENDPOINTS = re.compile(r"^/prices/")
+# v2 '/prices/{epic}/{resolution}/{numpoints}'
+NUM_POINTS_ENDPOINT = re.compile(r"^/prices/[^/]+/[^/]+/(\d+)$")
+
+ONE_MINUTE = 60
+ONE_WEEK = 7 * 24 * 60 * 60
+
+
+class TokenBucket(object):
+    """
+    Token bucket with continuous refill. Capacity tokens are available at once, and they are
+    replenished at capacity / period tokens per second.
+
+    Callers reserve tokens up front, possibly taking the bucket below zero, and then wait until the
+    reservation is covered. This keeps waiting callers in arrival order without a queue.
+    """
+
+    def __init__(self, name, capacity, period, max_wait=None):
+        """
+        :param name: bucket name, used in logs and errors
+        :type name: str
+        :param capacity: number of tokens available per period
+        :type capacity: float
+        :param period: refill period in seconds
+        :type period: float
+        :param max_wait: longest a caller is allowed to wait, in seconds. If a reservation would
+            take longer, AllowanceExhaustedException is raised instead. None to always wait
+        :type max_wait: float
+        """
+        self.name = name
+        self.capacity = float(capacity)
+        self.period = float(period)
+        self.max_wait = max_wait
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        """Tokens currently available (negative when callers are waiting)"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.capacity / self.period)
+            self._updated = now
+
+    def _wait_time(self, now):
+        """Seconds until the bucket is back to zero tokens"""
+        return -self._tokens * self.period / self.capacity
+
+    def _reserve(self, cost):
+        """Takes cost tokens and returns how long the caller has to wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= cost
+            wait = self._wait_time(now) if self._tokens < 0 else 0
+            if self.max_wait is not None and wait > self.max_wait:
+                self._tokens += cost
+                raise AllowanceExhaustedException(
+                    f"'{self.name}' allowance exhausted, next request possible in {wait:.0f} seconds")
+        if wait > 0:
+            logger.debug(f"'{self.name}' rate limit, waiting {wait:.3f} seconds")
+        return wait
+
+    def acquire(self, cost=1):
+        """
+        Blocks until cost tokens are available
+        :param cost: number of tokens to take
+        :type cost: float
+        """
+        wait = self._reserve(cost)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, cost=1):
+        """
+        Coroutine counterpart of acquire, awaits instead of blocking the event loop
+        :param cost: number of tokens to take
+        :type cost: float
+        """
+        wait = self._reserve(cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def drain(self):
+        """Empties the bucket, used when IG reports the allowance as exceeded anyway"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0)
+
+
+class AllowanceBucket(TokenBucket):
+    """
+    Bucket for allowances that IG resets in one go rather than continuously, i.e. the weekly
+    historical price data allowance. Can be kept in step with the server using the 'allowance'
+    block IG returns with price data.
+    """
+
+    def __init__(self, name, capacity, period, max_wait=None):
+        super(AllowanceBucket, self).__init__(name, capacity, period, max_wait=max_wait)
+        self._reset_at = self._updated + self.period
+
+    def _refill(self, now):
+        if now >= self._reset_at:
+            # callers waiting for the reset have reserved their share of the new allowance
+            self._tokens = self.capacity + min(self._tokens, 0)
+            self._reset_at = now + self.period
+        self._updated = now
+
+    def _wait_time(self, now):
+        return self._reset_at - now
+
+    def sync(self, remaining, expiry_seconds):
+        """
+        Aligns the bucket with the allowance reported by IG
+        :param remaining: remaining allowance
+        :type remaining: int
+        :param expiry_seconds: seconds until the allowance is reset
+        :type expiry_seconds: int
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = float(remaining)
+            self._reset_at = now + float(expiry_seconds)
+            self._updated = now
+
+    @property
+    def reset_in(self):
+        """Seconds until the allowance is reset"""
+        with self._lock:
+            return max(0.0, self._reset_at - time.monotonic())
+
+
+class IGRateLimiter(object):
+    """Schedules REST requests under IG's published allowances"""
+
+    def __init__(
+            self,
+            non_trading_per_minute=30,
+            trading_per_minute=100,
+            historical_points_per_week=10000,
+            historical_max_wait=ONE_MINUTE):
+        """
+        :param non_trading_per_minute: non-trading requests allowed per minute
+        :type non_trading_per_minute: int
+        :param trading_per_minute: trading requests allowed per minute
+        :type trading_per_minute: int
+        :param historical_points_per_week: historical price data points allowed per week
+        :type historical_points_per_week: int
+        :param historical_max_wait: longest to wait for historical allowance before giving up with
+            AllowanceExhaustedException, in seconds. Default 60
+        :type historical_max_wait: float
+        """
+        self.buckets = {
+            NON_TRADING: TokenBucket(NON_TRADING, non_trading_per_minute, ONE_MINUTE),
+            TRADING: TokenBucket(TRADING, trading_per_minute, ONE_MINUTE),
+            HISTORICAL: AllowanceBucket(
+                HISTORICAL, historical_points_per_week, ONE_WEEK, max_wait=historical_max_wait),
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a rate limiter from the optional 'rate_limit_*' config settings, or returns None if
+        rate limiting has been disabled with 'rate_limit_enabled = False'
+        """
+        enabled = get_config_value(config, 'rate_limit_enabled', True)
+        if str(enabled).lower() in ('false', '0', 'no'):
+            return None
+        return cls(
+            non_trading_per_minute=float(get_config_value(config, 'rate_limit_non_trading', 30)),
+            trading_per_minute=float(get_config_value(config, 'rate_limit_trading', 100)),
+            historical_points_per_week=float(get_config_value(config, 'rate_limit_historical', 10000)),
+            historical_max_wait=float(get_config_value(config, 'rate_limit_historical_max_wait', ONE_MINUTE)),
+        )
+
+    @staticmethod
+    def request_type(method, endpoint):
+        """
+        Classifies a request against IG's allowances
+        :param method: HTTP method (GET, POST, PUT or DELETE)
+        :type method: str
+        :param endpoint: API endpoint, e.g. '/positions/otc'
+        :type endpoint: str
+        :return: NON_TRADING or TRADING
+        :rtype: str
+        """
+        if method != 'GET' and TRADING_ENDPOINTS.match(endpoint):
+            return TRADING
+        return NON_TRADING
+
+    @staticmethod
+    def historical_cost(endpoint, params):
+        """
+        Estimates how many historical data points a request will consume, or 0 if the request is
+        not for price history. When the number of points isn't known up front a single point is
+        reserved, and the bucket is corrected from the allowance IG returns with the data
+        """
+        if not PRICES_ENDPOINTS.match(endpoint):
+            return 0
+        match = NUM_POINTS_ENDPOINT.match(endpoint)
+        if match:
+            return int(match.group(1))
+        points = [int(params[key]) for key in ('max', 'pageSize') if params and params.get(key)]
+        return min(points) if points else 1
+
+    def _reservations(self, method, endpoint, params):
+        reservations = [(self.buckets[self.request_type(method, endpoint)], 1)]
+        cost = self.historical_cost(endpoint, params)
+        if cost:
+            reservations.append((self.buckets[HISTORICAL], cost))
+        return reservations
+
+    def acquire(self, method, endpoint, params=None):
+        """Blocks until the request can be sent without exceeding an allowance"""
+        for bucket, cost in self._reservations(method, endpoint, params):
+            bucket.acquire(cost)
+
+    async def acquire_async(self, method, endpoint, params=None):
+        """Coroutine counterpart of acquire"""
+        for bucket, cost in self._reservations(method, endpoint, params):
+            await bucket.acquire_async(cost)
+
+    def reserve_historical(self, points):
+        """
+        Takes historical data points from the allowance ahead of a request whose size isn't known
+        from its parameters, e.g. a date range, for which the request itself only reserves one point
+        :param points: expected number of data points
+        :type points: int
+        :raises AllowanceExhaustedException: if the allowance isn't back within historical_max_wait
+        """
+        self.buckets[HISTORICAL].acquire(points)
+
+    def exceeded(self, method, endpoint):
+        """Called when IG rejects a request for exceeding an allowance"""
+        bucket = self.buckets[self.request_type(method, endpoint)]
+        logger.warning(f"IG reports '{bucket.name}' allowance exceeded, draining bucket")
+        bucket.drain()
+
+    def record_allowance(self, payload):
+        """
+        Keeps the historical data bucket in step with the 'allowance' block of a price response
+        :param payload: parsed price response
+        :type payload: dict
+        """
+        allowance = payload.get('allowance') or payload.get('metadata', {}).get('allowance')
+        if allowance and 'remainingAllowance' in allowance:
+            self.buckets[HISTORICAL].sync(allowance['remainingAllowance'], allowance['allowanceExpiry'])
+
+    @property
+    def historical_allowance(self):
+        """Remaining historical data points, as last known"""
+        return self.buckets[HISTORICAL].tokens
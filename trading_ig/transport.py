@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+HTTP transport settings for the REST session handlers
+
+Connections to IG are pooled and kept alive so that requests, order placement in particular, reuse
+a warm TLS connection instead of paying for a new handshake. All settings are optional and read from
+the config object:
+
+    http_pool_maxsize       connections kept open per host, should be at least the number of threads
+                            making requests at the same time (default 16)
+    http_pool_connections   number of hosts to keep a pool for (default 4)
+    http_connect_timeout    seconds to wait for a connection (default 5)
+    http_read_timeout       seconds to wait for a response (default 30)
+    http_max_retries        retries on connection errors, before anything has been sent (default 2)
+    http_keepalive          TCP keep-alive probes on idle pooled connections (default True)
+    http2                   use HTTP/2 through the optional 'httpx' package, with 'h2' (default False)
+"""
+import socket
+from collections import namedtuple
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from trading_ig.Exceptions import IGException
+from trading_ig.utils import get_config_value
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# seconds a connection may be idle before keep-alive probes are sent, and between probes
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+HTTPSettings = namedtuple("HTTPSettings", [
+    "pool_connections",
+    "pool_maxsize",
+    "connect_timeout",
+    "read_timeout",
+    "max_retries",
+    "keepalive",
+    "http2",
+])
+
+
+def _flag(value):
+    return str(value).lower() not in ('false', '0', 'no')
+
+
+def http_settings(config):
+    """Reads the optional 'http_*' settings from a config object"""
+    return HTTPSettings(
+        pool_connections=int(get_config_value(config, 'http_pool_connections', 4)),
+        pool_maxsize=int(get_config_value(config, 'http_pool_maxsize', 16)),
+        connect_timeout=float(get_config_value(config, 'http_connect_timeout', 5)),
+        read_timeout=float(get_config_value(config, 'http_read_timeout', 30)),
+        max_retries=int(get_config_value(config, 'http_max_retries', 2)),
+        keepalive=_flag(get_config_value(config, 'http_keepalive', True)),
+        http2=_flag(get_config_value(config, 'http2', False)),
+    )
+
+
+def keepalive_socket_options():
+    """TCP options enabling keep-alive probes, where the platform supports them"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                        ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections use TCP keep-alive (and no Nagle delay)"""
+
+    def __init__(self, keepalive=True, **kwargs):
+        self.keepalive = keepalive
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        if self.keepalive:
+            options += keepalive_socket_options()
+        kwargs['socket_options'] = options
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+def create_http_session(settings):
+    """
+    Creates the HTTP session used by IGSessionHandler
+    :param settings: transport settings
+    :type settings: HTTPSettings
+    :return: a requests.Session, or an httpx.Client when HTTP/2 is enabled
+    """
+    if settings.http2:
+        if httpx is None:
+            raise IGException("HTTP/2 requires the 'httpx' package, installed with 'httpx[http2]'")
+        transport = httpx.HTTPTransport(
+            http2=True,
+            retries=settings.max_retries,
+            limits=httpx.Limits(
+                max_connections=settings.pool_maxsize,
+                max_keepalive_connections=settings.pool_maxsize),
+            socket_options=keepalive_socket_options() if settings.keepalive else None)
+        return httpx.Client(transport=transport, timeout=http_timeout(settings))
+
+    # only connection errors are retried: a request that may have reached IG is never sent twice
+    retries = Retry(total=settings.max_retries, connect=settings.max_retries, read=False, status=0, other=0,
+                    backoff_factor=0.1, raise_on_status=False)
+    adapter = PooledHTTPAdapter(
+        keepalive=settings.keepalive,
+        pool_connections=settings.pool_connections,
+        pool_maxsize=settings.pool_maxsize,
+        max_retries=retries)
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def http_timeout(settings):
+    """Timeout to pass with every request of the session created by create_http_session"""
+    if settings.http2:
+        return httpx.Timeout(settings.read_timeout, connect=settings.connect_timeout)
+    return settings.connect_timeout, settings.read_timeout
@@ -1,19 +1,74 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import asyncio
+import functools
+import json
 import logging
 import os
-import logging
 import traceback
 import six
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 logger = logging.getLogger(__name__)
 
 
 DATE_FORMATS = {1: "%Y:%m:%d-%H:%M:%S", 2: "%Y/%m/%d %H:%M:%S", 3: "%Y/%m/%d %H:%M:%S"}
 
+RESOLUTIONS = {
+    "1s": "SECOND",
+    "1Min": "MINUTE",
+    "2Min": "MINUTE_2",
+    "3Min": "MINUTE_3",
+    "5Min": "MINUTE_5",
+    "10Min": "MINUTE_10",
+    "15Min": "MINUTE_15",
+    "30Min": "MINUTE_30",
+    "1H": "HOUR",
+    "2H": "HOUR_2",
+    "3H": "HOUR_3",
+    "4H": "HOUR_4",
+    "D": "DAY",
+    "1D": "DAY",
+    "W": "WEEK",
+    "M": "MONTH",
+}
+
 
 def conv_resol(resolution):
-    return resolution
+    """Converts a pandas style resolution like '1Min' or 'D' to the IG
+    one ('MINUTE', 'DAY'). IG resolutions are returned unchanged"""
+    return RESOLUTIONS.get(resolution, resolution)
+
+
+JSON_DECODERS = {
+    "orjson": orjson.loads if orjson is not None else None,
+    "ujson": ujson.loads if ujson is not None else None,
+    "json": json.loads,
+}
+
+
+def get_json_decoder(name=None):
+    """Returns a function decoding a JSON document from bytes or str.
+    By default the fastest installed library is used (orjson, then ujson,
+    then the standard library json module)"""
+    if name is None:
+        for name in ("orjson", "ujson", "json"):
+            if JSON_DECODERS[name] is not None:
+                return JSON_DECODERS[name]
+    if name not in JSON_DECODERS:
+        raise ValueError("Unknown JSON decoder '%s', expected one of %s" % (name, ", ".join(JSON_DECODERS)))
+    if JSON_DECODERS[name] is None:
+        raise ValueError("JSON decoder '%s' is not installed" % name)
+    return JSON_DECODERS[name]
 
 
 def conv_datetime(dt, version=2):
@@ -43,6 +98,18 @@ def conv_to_ms(td):
         return td
 
 
+def get_config_value(config, key, default=None):
+    """Returns an optional setting from a config object (trading_ig_config.config or
+    ConfigEnvVar), or default if it isn't set"""
+    if isinstance(config, dict):
+        return config.get(key, default)
+    try:
+        value = getattr(config, key)
+    except Exception:
+        return default
+    return default if value is None else value
+
+
 def remove(cache):
     """Remove cache"""
     try:
@@ -61,4 +128,28 @@ def create_logger(logger_name, file_name=None):
     formatter    = logging.Formatter('%(asctime)s(%(levelname)s): %(message)s')
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
-    return logging.getLogger(logger_name)
\ No newline at end of file
+    return logging.getLogger(logger_name)
+
+def async_retry(exceptions, delay=0, tries=-1, backoff=1, logger=None):
+    """Coroutine counterpart of the retry decorator from the 'retry' package,
+    with the same delay / tries / backoff semantics"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            _tries, _delay = tries, delay
+            while _tries:
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    _tries -= 1
+                    if not _tries:
+                        raise
+                    if logger is not None:
+                        logger.warning("%s, retrying in %s seconds..." % (e, _delay))
+                    await asyncio.sleep(_delay)
+                    _delay *= backoff
+
+        return wrapper
+
+    return decorator